@@ -0,0 +1,140 @@
+import math, time
+
+from TwitchCubieBot.Data import Backend, MessageTypes
+from TwitchCubieBot.Sketch import QuantileSketch, ScalableBloomFilter, SpaceSaving
+
+# Backend for channels with so many chatters that keeping every value is too costly.
+# Memory barely grows with the amount of chatters, at the cost of these error bounds:
+# - Quantiles, and thus the median and percentiles, are within `accuracy` times the true value (1% by default).
+#   The mean is exact, the trimmed mean within `accuracy`.
+# - Vote counts are overestimated by at most 1 / `capacity` of the votes (1/64 by default),
+#   and every value with a larger share than that is counted.
+# - Each sender only has one vote per message type, which is their first value rather than their latest.
+#   At most a fraction of `false_positive_rate` of the senders is wrongly seen as having voted already, and ignored.
+#   The filters of the senders start out sized for `expected_senders` per slice, and grow once more senders vote,
+#   by about 1.8 bytes per sender, up to `max_filters` filters per slice and message type.
+#   By default that is 1.5M senders per slice in 2.7 MB. Once even more senders vote, memory no longer grows,
+#   but the false positive rate rises instead, e.g. to about 6% with 2.3M senders in one slice.
+# - Values expire in steps of `max_age` / `slices` seconds, rather than each at their own time.
+
+NUMBERS = MessageTypes.NUMBERS.value
+
+class Slice:
+    # Sketches of the values of one period of `max_age` / `slices` seconds
+    __slots__ = ("start", "sketch", "counters", "filters", "counts")
+
+    def __init__(self, start, accuracy, capacity):
+        self.start = start
+        self.sketch = QuantileSketch(accuracy)
+        self.counters = [SpaceSaving(capacity) for _ in MessageTypes]
+        # Senders who voted in this slice, per message type. Only created once needed.
+        self.filters = [None, None, None]
+        self.counts = [0, 0, 0]
+
+class ApproximateCollection(Backend):
+    """ Backend storing sketches of the values instead of the value of every sender """
+
+    def __init__(self, max_age=30, slices=6, accuracy=0.01, capacity=64, expected_senders=100_000, false_positive_rate=0.01, max_filters=4):
+        self.max_age = max_age
+        self.slices = slices
+        self.accuracy = accuracy
+        self.capacity = capacity
+        # The filter of a slice initially holds `expected_senders` senders with the given false positive rate
+        self.expected_senders = expected_senders
+        self.false_positive_rate = false_positive_rate
+        self.max_filters = max_filters
+        # Slices from old to new
+        self._slices = []
+        # Amount of values removed by clean, and of repeated votes that were ignored, for each message type.
+        # Nothing is ever evicted, as the memory is bounded regardless.
+        self.expired = [0, 0, 0]
+        self.ignored = [0, 0, 0]
+        self.evicted = [0, 0, 0]
+
+    def _slice_length(self):
+        return max(self.max_age / self.slices, 1)
+
+    def set(self, sender, message, message_type, timestamp=None):
+        index = message_type.value
+        # Validated before anything changes, as the sketch has no bucket for infinity or NaN
+        if index == NUMBERS and not math.isfinite(message):
+            raise ValueError(f"Numbers must be finite, not {message}.")
+        if timestamp is None:
+            timestamp = time.time()
+
+        # Ignore senders who voted within the slices that are still kept
+        current = self._slices[-1] if self._slices else None
+        if current is None or timestamp >= current.start + self._slice_length():
+            current = self._rotate(timestamp)
+        if current.filters[index] is None:
+            current.filters[index] = ScalableBloomFilter(self.expected_senders, self.false_positive_rate, self.max_filters)
+        # The positions of the sender in filters of the same size are only computed once
+        cache = {}
+        for _slice in self._slices[:-1]:
+            if _slice.filters[index] is not None and _slice.filters[index].has(sender, cache):
+                self.ignored[index] += 1
+                return
+        if current.filters[index].add(sender, cache):
+            self.ignored[index] += 1
+            return
+
+        if index == NUMBERS:
+            current.sketch.add(message)
+        current.counters[index].add(message)
+        current.counts[index] += 1
+
+    def _rotate(self, timestamp):
+        # Start a new slice, and drop the slices which are entirely older than max_age
+        self._expire(timestamp - self.max_age)
+        length = self._slice_length()
+        _slice = Slice(timestamp - timestamp % length, self.accuracy, self.capacity)
+        self._slices.append(_slice)
+        return _slice
+
+    def _expire(self, cutoff):
+        length = self._slice_length()
+        while self._slices and self._slices[0].start + length <= cutoff:
+            _slice = self._slices.pop(0)
+            for index, count in enumerate(_slice.counts):
+                self.expired[index] += count
+
+    def clean(self, seconds):
+        # Removes the slices of which all values are older than 'seconds' seconds
+        self._expire(time.time() - seconds)
+
+    def _counter(self, index):
+        counter = SpaceSaving(self.capacity)
+        for _slice in self._slices:
+            counter.merge(_slice.counters[index])
+        return counter
+
+    def average(self, method="median"):
+        # Same methods as Collection.average, from the merged sketches
+        sketch = QuantileSketch(self.accuracy)
+        for _slice in self._slices:
+            sketch.merge(_slice.sketch)
+        if method == "mean":
+            return sketch.mean()
+        if method == "trimmed":
+            return sketch.trimmed_mean()
+        if method.startswith("p"):
+            return sketch.quantile(float(method[1:]) / 100)
+        return sketch.quantile(0.5)
+
+    def vote(self, message_type):
+        counter = self._counter(message_type.value)
+        _max = max(counter.counts.values(), default=0)
+        return sorted((value, count / counter.total) for value, count in counter.counts.items() if count == _max)
+
+    def length(self, message_type):
+        return sum(_slice.counts[message_type.value] for _slice in self._slices)
+
+    def clear(self, message_type):
+        # Senders can vote again after a clear, like with a Collection
+        index = message_type.value
+        for _slice in self._slices:
+            _slice.counters[index] = SpaceSaving(self.capacity)
+            _slice.filters[index] = None
+            _slice.counts[index] = 0
+            if index == NUMBERS:
+                _slice.sketch = QuantileSketch(self.accuracy)
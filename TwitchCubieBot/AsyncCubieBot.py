@@ -0,0 +1,197 @@
+from TwitchWebsocket import Message
+import asyncio, logging, signal
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.CubieBot import CubieBot
+from TwitchCubieBot.Outbound import OutboundLimiter
+from TwitchCubieBot.View import View
+
+# asyncio based alternative to the threaded TwitchWebsocket. Requires Python 3.7+.
+# Run using `python -m TwitchCubieBot.AsyncCubieBot`, using the same settings.txt file.
+
+class AsyncConnection:
+    """ Connection to Twitch chat which joins one or more channels, using asyncio streams """
+
+    def __init__(self, host, port, nick, auth, channels, callback, capability=None):
+        self.host = host
+        self.port = port
+        self.nick = nick
+        self.auth = auth
+        # Lowercase channel names without "#"
+        self.channels = channels
+        # Coroutine function called with every received Message
+        self.callback = callback
+        self.capability = capability or []
+
+        self.reader = None
+        self.writer = None
+        self._tasks = []
+        self._stopped = False
+
+    async def run(self):
+        # Connect, and read messages until stopped, reconnecting with an exponential delay on failure.
+        delay = 0
+        while not self._stopped:
+            try:
+                await self.connect()
+                delay = 0
+                await self._receive()
+            except (OSError, asyncio.IncompleteReadError) as error:
+                logger.error(f"[{error.__class__.__name__}: {error}] - Attempting to reconnect in {delay} seconds.")
+            if not self._stopped:
+                await asyncio.sleep(delay)
+                delay = min(max(delay * 2, 1), 512)
+
+    async def connect(self):
+        logger.info("Attempting to initialize connection.")
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self._write("PASS ", self.auth)
+        self._write("NICK ", self.nick.lower())
+        for capability in self.capability:
+            self._write("CAP REQ ", ":twitch.tv/" + capability.lower())
+        await self.writer.drain()
+        # Twitch only allows 20 joins per 10 seconds, so join in the background
+        self._tasks.append(asyncio.ensure_future(self._join_channels()))
+        logger.info("Connection initialized.")
+
+    async def _join_channels(self):
+        for i, channel in enumerate(self.channels):
+            if i > 0:
+                await asyncio.sleep(0.5)
+            self._write("JOIN ", "#" + channel)
+
+    async def _receive(self):
+        while not self._stopped:
+            try:
+                data = await self.reader.readuntil(b"\r\n")
+                line = data[:-2].decode("UTF-8")
+            except UnicodeDecodeError:
+                logger.warning("Received data could not be decoded. Skipping this data.")
+                continue
+            except asyncio.IncompleteReadError:
+                if self._stopped:
+                    return
+                raise
+            if not line:
+                continue
+
+            m = Message(line)
+            if m.type == "PING":
+                self._write("PONG ", "")
+            await self.callback(m)
+
+    def _write(self, command, message):
+        self.writer.write(bytes(f"{command}{message}\r\n", "UTF-8"))
+
+    def send_message(self, message, channel):
+        # Writing is buffered by the transport, so this never waits for the socket.
+        if self.writer is None or self.writer.is_closing():
+            logger.warning(f"Not connected, so the following message was not sent: {message}")
+            return
+        self._write(f"PRIVMSG #{channel} :", message)
+
+    async def stop(self):
+        self._stopped = True
+        for task in self._tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+class AsyncView(View):
+    # View which sends chat messages through the AsyncConnection that joined the channel.
+    def output(self, message, source, channel=None):
+        if source in self.send_to_chat and self.bot.connections:
+            self.send(message, channel)
+
+    def send(self, message, channel=None):
+        self.bot.queue_message(message, self.bot.get_channel(channel).name)
+
+class AsyncCubieBot(CubieBot):
+    def __init__(self, channels_per_connection=50):
+        CubieBot.__init__(self)
+        self.view = AsyncView(self)
+        self.channels_per_connection = channels_per_connection
+        self.connections = []
+        self.connections_by_channel = {}
+        self.limiter = None
+        self._outbound = None
+        self._tasks = []
+
+    async def start(self):
+        # Settings reloading, live results, persistence and metrics, like CubieBot
+        self.start_services()
+
+        # Spread the channels over as many connections as needed
+        self.get_channel()
+        names = list(self.channels)
+        for i in range(0, len(names), self.channels_per_connection):
+            connection = AsyncConnection(self.host, self.port, self.nick, self.auth, names[i:i + self.channels_per_connection], self.handle_message, self.capability)
+            self.connections.append(connection)
+            for name in connection.channels:
+                self.connections_by_channel[name] = connection
+            self._tasks.append(asyncio.ensure_future(connection.run()))
+        self._tasks.append(asyncio.ensure_future(self.expire()))
+
+        # Chat messages are rate limited over all connections, as Twitch limits them per account
+        self.limiter = OutboundLimiter(self.global_message_limit, self.channel_message_limit)
+        self._outbound = asyncio.Event()
+        self._tasks.append(asyncio.ensure_future(self.send_outbound()))
+
+    async def run(self):
+        # Start, and run until stopped.
+        await self.start()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def stop(self):
+        for connection in self.connections:
+            await connection.stop()
+        for task in self._tasks:
+            task.cancel()
+        self.stop_services()
+
+    async def handle_message(self, m):
+        # Parsing and aggregating never waits on the network, so the shared handler can be used directly.
+        # It is looked up on every call, as Metrics replaces it.
+        self.message_handler(m)
+
+    def queue_message(self, message, channel):
+        if self.limiter.put(message, channel):
+            self._outbound.set()
+
+    async def send_outbound(self):
+        while True:
+            item, wait = self.limiter.pop()
+            if item is None:
+                # Wait until either a new message is queued, or a limit allows sending
+                self._outbound.clear()
+                try:
+                    await asyncio.wait_for(self._outbound.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            message, channel = item
+            self.connections_by_channel[channel].send_message(message, channel)
+
+    def join_channels(self):
+        # Each AsyncConnection joins its own channels once connected
+        pass
+
+    async def expire(self, interval=1):
+        # Regularly remove outdated values, so collections stay small even if no commands are used.
+        while True:
+            await asyncio.sleep(interval)
+            for channel in list(self.channels.values()):
+                channel.collection.clean(channel.lookback_time)
+
+if __name__ == "__main__":
+    bot = AsyncCubieBot()
+    bot.update_settings()
+    async def main():
+        # Settings can also be reloaded using `kill -HUP <pid>`, where supported
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, bot.reload_settings)
+        await bot.run()
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        pass
@@ -0,0 +1,259 @@
+from TwitchWebsocket import Message
+import argparse, itertools, logging, sys, time
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional, and only needed for batch analysis: `pip install TwitchCubieBot[batch]`
+    np = None
+
+from TwitchCubieBot.CubieBot import CubieBot
+from TwitchCubieBot.Data import MessageTypes, sorted_average
+from TwitchCubieBot.Parser import parse_fields
+
+# Computes the results of all !vote and !average commands in a recorded chat log, exactly as CubieBot would have live.
+# Run using `python -m TwitchCubieBot.Batch chat.log`, for a log of raw Twitch IRC lines including tags.
+# Message times are taken from the tmi-sent-ts tag, and the settings from settings.txt.
+# MaxValues is applied by keeping the senders with the most recent values. Live, repeating the same value
+# within the same second does not count as more recent, so at the limit a different sender may be evicted.
+# Lines are parsed and classified in Python, at about 130k lines/s on one core, so 10M lines take over a minute.
+
+NUMBERS = MessageTypes.NUMBERS.value
+TEXT = MessageTypes.TEXT.value
+EMOTES = MessageTypes.EMOTES.value
+# Maximum amount of distinct messages of which the classification is remembered
+CLASSIFIED_SIZE = 100_000
+
+class ChannelLog:
+    """ All values found in the messages of one channel, per message type, in the order they were sent """
+
+    def __init__(self, channel):
+        self.channel = channel
+        # Values that have not yet been moved into arrays, as (timestamps, sender ids, values) lists
+        self.pending = [([], [], []) for _ in MessageTypes]
+        # Arrays of earlier chunks, and once finished, one (timestamps, sender ids, values) tuple of arrays per message type
+        self.chunks = [[] for _ in MessageTypes]
+        self.arrays = [None for _ in MessageTypes]
+
+        # Amount of values, the timestamp of the last value, and the amount of values at the last clear, per message type
+        self.length = [0 for _ in MessageTypes]
+        self.last_timestamp = [0 for _ in MessageTypes]
+        self.cleared = [0 for _ in MessageTypes]
+
+    def add(self, index, timestamp, sender, value):
+        timestamps, senders, values = self.pending[index]
+        timestamps.append(timestamp)
+        senders.append(sender)
+        values.append(value)
+        self.length[index] += 1
+        self.last_timestamp[index] = timestamp
+
+    def flush(self):
+        # Move the pending values into arrays, which take far less memory than lists
+        for index, (timestamps, senders, values) in enumerate(self.pending):
+            if timestamps:
+                self.chunks[index].append((np.array(timestamps, dtype=np.int64),
+                                           np.array(senders, dtype=np.int64),
+                                           np.array(values, dtype=np.float64 if index == NUMBERS else np.int64)))
+                self.pending[index] = ([], [], [])
+
+    def finish(self):
+        self.flush()
+        for index, chunks in enumerate(self.chunks):
+            if chunks:
+                self.arrays[index] = tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+            self.chunks[index] = []
+
+    def latest(self, index, cutoff, start, end, max_size=0):
+        # Returns the value of each sender with a value in positions [start, end) sent at or after `cutoff`,
+        # taking the last value of every sender, like a Collection after clean.
+        # If there are more than `max_size` senders, only those who sent a value most recently are kept,
+        # like a Collection evicting the least recent senders once it has MaxValues values.
+        timestamps, senders, values = self.arrays[index]
+        # Timestamps are sorted, so the window starts at the first timestamp at or after the cutoff
+        start = max(start, int(np.searchsorted(timestamps[:end], cutoff, side="left")))
+        # The first occurrence of each sender in the reversed window is their last value
+        _, last = np.unique(senders[start:end][::-1], return_index=True)
+        if max_size and len(last) > max_size:
+            last = np.sort(last)[:max_size]
+        return values[start:end][::-1][last]
+
+class Batch:
+    """ Replays a chat log through the classifiers and settings of a CubieBot, aggregating with NumPy """
+
+    def __init__(self, bot, chunk_size=100_000):
+        if np is None:
+            raise ImportError("Batch analysis requires NumPy, install it using `pip install TwitchCubieBot[batch]`.")
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self.logs = {}
+        # Ids of senders, and of text and emote values, as arrays store integers
+        self.sender_ids = {}
+        self.value_ids = {}
+        self.values = []
+        # (number, letter, emote) tuples by (message, emotes tag)
+        self.classified = {}
+        self.denied_users = bot.denied_users
+        # Time of the current message, in seconds
+        self.time = 0
+        # [time, channel, output] lists in the order of the commands. The output of successful commands is
+        # computed once all values are known, so until then it is a tuple with the arguments for `result`.
+        self.commands = []
+
+    def process(self, lines):
+        # Handle all lines, in chunks of `chunk_size` lines
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, self.chunk_size))
+            if not chunk:
+                break
+            for line in chunk:
+                self.handle(line.rstrip("\r\n"))
+            for log in self.logs.values():
+                log.flush()
+        for log in self.logs.values():
+            log.finish()
+
+    def handle(self, line):
+        # Equivalent of CubieBot.message_handler for a PRIVMSG line
+        parsed = parse_fields(line)
+        if parsed is None:
+            return
+        user, name, message, emotes, sent = parsed
+        if user in self.denied_users:
+            return
+
+        log = self.logs.get(name)
+        if log is None:
+            log = self.logs[name] = ChannelLog(self.bot.get_channel(name))
+        if message[:1] == "!":
+            command = CubieBot.COMMANDS.get(message.partition(" ")[0])
+            if command is not None:
+                self.set_time(sent)
+                if self.command(log, line, message, command):
+                    return
+
+        # Chat repeats the same messages a lot, so each is only classified once
+        key = (message, emotes)
+        found = self.classified.get(key)
+        if found is None:
+            if len(self.classified) >= CLASSIFIED_SIZE:
+                self.classified.clear()
+            found = self.classified[key] = self.bot.classifier.classify(message, emotes)
+        number, letter, emote = found
+        if number is None and letter is None and emote is None:
+            return
+        # The time is only needed for messages with values, and Collection.set stores it rounded to seconds
+        self.set_time(sent)
+        timestamp = round(self.time)
+        sender = self.sender_ids.get(user)
+        if sender is None:
+            sender = self.sender_ids[user] = len(self.sender_ids)
+        if number is not None:
+            log.add(NUMBERS, timestamp, sender, number)
+        if letter is not None:
+            log.add(TEXT, timestamp, sender, self.value_id(letter))
+        if emote is not None:
+            log.add(EMOTES, timestamp, sender, self.value_id(emote))
+        # Polls are few and small, so they are updated as they would be live
+        if log.channel.polls:
+            log.channel.polls.add(user, number, letter, timestamp)
+
+    def set_time(self, sent):
+        # Messages without a tmi-sent-ts tag are assumed to be sent at the time of the previous message
+        if sent:
+            self.time = int(sent) / 1000
+
+    def value_id(self, value):
+        value_id = self.value_ids.get(value)
+        if value_id is None:
+            value_id = self.value_ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def command(self, log, line, message, command):
+        # Handle a command like CubieBot.command_vote and command_average. Returns False if the message
+        # is not handled as a command, due to permissions or the cooldown, so it is checked for values instead.
+        # Cooldowns use the time of the messages rather than a monotonic clock.
+        bot, channel = self.bot, log.channel
+        if not bot.check_command(Message(line), channel, command, self.time):
+            return False
+
+        # Polls are started and stopped right away, as their results only depend on the messages up to now
+        if message.startswith("!vote") and bot.check_poll_command(message):
+            out, _ = bot.update_polls(message, channel, self.time)
+            self.commands.append([self.time, channel.name, out])
+            return True
+
+        if command == "command_average":
+            method, name = bot.check_average_type(message)
+            message_type = MessageTypes.NUMBERS
+            error = "No recent numbers found to take the average from."
+        else:
+            method, name = None, None
+            message_type = bot.check_vote_type(message)
+            error = "No votes found."
+
+        # There are values if any were set since the last clear, and the last of them was not cleaned.
+        # Timestamps are sorted, so that is enough to know whether the command succeeds.
+        index = message_type.value
+        cutoff = self.time - channel.lookback_time
+        if log.length[index] > log.cleared[index] and log.last_timestamp[index] >= cutoff:
+            self.commands.append([self.time, channel.name, (log, message_type, method, name, cutoff, log.cleared[index], log.length[index])])
+            log.cleared[index] = log.length[index]
+        else:
+            self.commands.append([self.time, channel.name, error])
+        return True
+
+    def result(self, log, message_type, method, name, cutoff, start, end):
+        values = log.latest(message_type.value, cutoff, start, end, log.channel.collection.max_size)
+        if method is not None:
+            return self.bot.format_average(sorted_average(np.sort(values).tolist(), method), name)
+
+        keys, counts = np.unique(values, return_counts=True)
+        _max = int(counts.max())
+        if message_type == MessageTypes.NUMBERS:
+            keys = keys.tolist()
+        else:
+            keys = [self.values[key] for key in keys]
+        votes = sorted((key, _max / len(values)) for key, count in zip(keys, counts) if count == _max)
+        return self.bot.format_vote(votes, message_type)
+
+    def results(self):
+        # Returns (time, channel, output) tuples for every command, in order
+        for command in self.commands:
+            if isinstance(command[2], tuple):
+                command[2] = self.result(*command[2])
+        return [tuple(command) for command in self.commands]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the results of all !vote and !average commands in a chat log.")
+    parser.add_argument("path", help="Chat log with one raw Twitch IRC line per line, including tags.")
+    parser.add_argument("--lookback", type=float, help="LookbackTime to use instead of the one in settings.txt.")
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit("Batch analysis requires NumPy, install it using `pip install TwitchCubieBot[batch]`.")
+
+    bot = CubieBot()
+    bot.update_settings()
+    if args.lookback is not None:
+        bot.lookback_time = args.lookback
+        for channel in bot.channels.values():
+            channel.lookback_time = args.lookback
+
+    batch = Batch(bot, args.chunk_size)
+    start = time.perf_counter()
+    with open(args.path, "r", encoding="UTF-8", errors="replace") as f:
+        batch.process(f)
+    results = batch.results()
+    duration = time.perf_counter() - start
+
+    for timestamp, channel, out in results:
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))} #{channel}: {out}")
+    logger.info(f"Processed {args.path} in {duration:.2f} seconds.")
+
+if __name__ == "__main__":
+    main()
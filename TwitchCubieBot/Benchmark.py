@@ -0,0 +1,402 @@
+from TwitchWebsocket import Message
+import argparse, gc, logging, multiprocessing, os, random, subprocess, sys, tempfile, time, timeit, tracemalloc
+
+from TwitchCubieBot.Approximate import ApproximateCollection
+from TwitchCubieBot.CubieBot import CubieBot
+from TwitchCubieBot.Data import Collection, MessageTypes
+from TwitchCubieBot.Metrics import Metrics
+from TwitchCubieBot.Persistence import Persistence
+from TwitchCubieBot.Rolling import Rolling
+from TwitchCubieBot.Shared import SharedStore
+from TwitchCubieBot.Receiver import LeanWebsocket
+from TwitchCubieBot.TestHelpers import DENIED_USERS, EMOTES, StubSocket, generate_chat, generate_log, make_bot, make_line
+
+# Run using `python -m TwitchCubieBot.Benchmark`, optionally with e.g. `--messages 500000 --users 50000`.
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+def bench_handler(lines):
+    # Feed the lines through message_handler, measuring both throughput and per message latency.
+    bot = make_bot()
+    messages = [Message(line) for line in lines]
+    latencies = []
+    start = time.perf_counter()
+    for m in messages:
+        before = time.perf_counter_ns()
+        bot.message_handler(m)
+        latencies.append(time.perf_counter_ns() - before)
+    duration = time.perf_counter() - start
+    latencies.sort()
+
+    # Throughput including the TwitchWebsocket Message parsing
+    start = time.perf_counter()
+    bot = make_bot()
+    for line in lines:
+        bot.message_handler(Message(line))
+    parse_duration = time.perf_counter() - start
+
+    print("message_handler:")
+    print(f"  {len(lines) / duration:>12,.0f} messages/s")
+    print(f"  {len(lines) / parse_duration:>12,.0f} messages/s including Message parsing")
+    print(f"  {percentile(latencies, 50) / 1000:>12.2f} µs p50 latency")
+    print(f"  {percentile(latencies, 99) / 1000:>12.2f} µs p99 latency")
+
+def bench_metrics(number=50_000, repeat=31):
+    # Measure the overhead of collecting metrics, per message.
+    # A few messages are repeated, so the remaining work is constant and the difference is not lost in noise.
+    # Runs with and without metrics alternate, so both are equally affected by e.g. other processes,
+    # and the overhead is the median of the differences between each pair of runs.
+    messages = [Message(make_line("user", text, emotes)) for text, emotes in [("A", ""), ("8/10", ""), ("Kappa", "25:0-4"), ("hello chat", "")]]
+    handlers = []
+    for instrument in (False, True):
+        bot = make_bot()
+        if instrument:
+            bot.metrics = Metrics(bot)
+            bot.metrics.instrument()
+        handlers.append(bot.message_handler)
+    def run(handler):
+        start = time.perf_counter()
+        for _ in range(number // len(messages)):
+            for m in messages:
+                handler(m)
+        return time.perf_counter() - start
+    differences = sorted(run(handlers[1]) - run(handlers[0]) for _ in range(repeat))
+    overhead = differences[repeat // 2] / number * 1e9
+    spread = (differences[repeat * 3 // 4] - differences[repeat // 4]) / number * 1e9
+    print("Metrics:")
+    print(f"  {overhead:>12.0f} ns overhead per message, interquartile range {spread:.0f} ns")
+
+def fill(bot, size, message_type):
+    rng = random.Random(size)
+    for i in range(size):
+        if message_type == MessageTypes.NUMBERS:
+            value = float(rng.randint(0, 100))
+        elif message_type == MessageTypes.EMOTES:
+            value = rng.choice(EMOTES)
+        else:
+            value = rng.choice("ABCD")
+        bot.collection.set(f"user{i}", value, message_type)
+
+def bench_commands(sizes, repeat=5):
+    # Measure !vote and !average latency for collections of different sizes.
+    command = Message(make_line("cubiedev", "!vote", badges="broadcaster/1"))
+    print("Command latency:")
+    for size in sizes:
+        for name, text, message_type in [("!vote", "!vote", MessageTypes.TEXT), ("!vote emotes", "!vote emotes", MessageTypes.EMOTES), ("!average", "!average", MessageTypes.NUMBERS)]:
+            durations = []
+            for _ in range(repeat):
+                bot = make_bot()
+                fill(bot, size, message_type)
+                command.message = text
+                before = time.perf_counter_ns()
+                bot.message_handler(command)
+                durations.append(time.perf_counter_ns() - before)
+            print(f"  {name:<14} {size:>9,} entries: {min(durations) / 1000:>10.2f} µs")
+
+def bench_memory(lines):
+    # Measure peak memory while ingesting the lines.
+    bot = make_bot()
+    messages = [Message(line) for line in lines]
+    tracemalloc.start()
+    for m in messages:
+        bot.message_handler(m)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("Memory:")
+    print(f"  {peak / 1024 / 1024:>12.2f} MiB peak")
+    print(f"  {current / 1024 / 1024:>12.2f} MiB retained by Collection")
+
+def bench_storage(size):
+    # Measure the memory used per stored vote, excluding the sender names themselves.
+    senders = [f"user{i}" for i in range(size)]
+    print("Storage:")
+    for message_type, values in [(MessageTypes.TEXT, "ABCD"), (MessageTypes.NUMBERS, [float(i) for i in range(101)]), (MessageTypes.EMOTES, EMOTES)]:
+        bot = make_bot()
+        collection = bot.collection
+        tracemalloc.start()
+        for i, sender in enumerate(senders):
+            # Create a new value object for every vote, like when parsing chat messages
+            value = values[i % len(values)]
+            collection.set(sender, (" " + value)[1:] if type(value) == str else value * 1, message_type)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {message_type.name:<8} {current / size:>8.1f} bytes per vote")
+
+def bench_repeats(n_senders, repeats=20):
+    # Measure a raid of `n_senders` chatters each repeating the same value, which only refreshes timestamps,
+    # followed by as many new chatters, which evict the raiders as the collection is capped at `n_senders`.
+    collection = Collection(n_senders)
+    raiders = [f"user{i}" for i in range(n_senders)]
+    newcomers = [f"newcomer{i}" for i in range(n_senders)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for sender in raiders:
+            collection.set(sender, "KEKW", MessageTypes.EMOTES)
+    duration = time.perf_counter() - start
+    logging.getLogger("TwitchCubieBot.Data").setLevel(logging.ERROR)
+    for sender in newcomers:
+        collection.set(sender, "LUL", MessageTypes.EMOTES)
+    logging.getLogger("TwitchCubieBot.Data").setLevel(logging.NOTSET)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("Repeated values:")
+    print(f"  {n_senders * repeats / duration:>12,.0f} values/s from {n_senders:,} senders repeating {repeats} times")
+    print(f"  {current / n_senders:>12.1f} bytes per sender after {sum(collection.evicted):,} evictions")
+
+def bench_approximate(n_senders, seed=0):
+    # Compare the accuracy, throughput and memory of an ApproximateCollection with an exact Collection,
+    # for `n_senders` chatters who each send a number and an emote.
+    rng = random.Random(seed)
+    senders = [f"user{i}" for i in range(n_senders)]
+    numbers = [float(round(rng.lognormvariate(4, 0.5))) for _ in senders]
+    # Emotes of which the first is most popular, then the second, and so on
+    emotes = [EMOTES[min(int(rng.expovariate(0.8)), len(EMOTES) - 1)] for _ in senders]
+    print("Approximate:")
+    results = {}
+    for name, create in [("exact", Collection), ("approximate", lambda: ApproximateCollection(max_age=60))]:
+        # Fill the collection twice, once for the throughput and once for the memory, as tracing slows it down
+        for traced in [False, True]:
+            collection = create()
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            for sender, number, emote in zip(senders, numbers, emotes):
+                collection.set(sender, number, MessageTypes.NUMBERS)
+                collection.set(sender, emote, MessageTypes.EMOTES)
+            if not traced:
+                duration = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = [collection.average(), collection.average("p90"), collection.vote(MessageTypes.EMOTES)[0]]
+        print(f"  {name:<12} {n_senders * 2 / duration:>12,.0f} values/s {current / 1024:>10,.0f} KiB")
+    exact, approximate = results["exact"], results["approximate"]
+    for i, method in enumerate(["median", "p90"]):
+        print(f"  {method:<12} {exact[i]:>12g} exact {approximate[i]:>10g} approximate, {abs(approximate[i] - exact[i]) / exact[i]:.2%} error")
+    print(f"  {'vote':<12} {exact[2][0]:>12} {exact[2][1]:.2%} exact, {approximate[2][0]} {approximate[2][1]:.2%} approximate")
+
+def bench_channels(n_channels):
+    # Measure the memory used per joined channel that has not received any messages yet.
+    bot = make_bot()
+    names = [f"#channel{i}" for i in range(n_channels)]
+    tracemalloc.start()
+    bot.update_channels(names, {})
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("Channels:")
+    print(f"  {current / n_channels:>12,.0f} bytes per idle channel")
+
+def bench_restart(size):
+    # Measure the time to snapshot and restore `size` values, half from the snapshot and half from the journal.
+    with tempfile.TemporaryDirectory() as directory:
+        bot = make_bot()
+        bot.persistence = Persistence(bot, directory)
+        bot.persistence.load()
+        fill(bot, size // 2, MessageTypes.TEXT)
+        start = time.perf_counter()
+        bot.persistence.snapshot()
+        snapshot_duration = time.perf_counter() - start
+        fill(bot, size - size // 2, MessageTypes.NUMBERS)
+        bot.persistence.flush()
+
+        # Only the values of configured channels are restored
+        restored = make_bot()
+        restored.get_channel()
+        restored.persistence = Persistence(restored, directory)
+        start = time.perf_counter()
+        count = restored.persistence.load()
+        duration = time.perf_counter() - start
+        assert count == size, f"Restored {count:,} of {size:,} entries"
+    print("Restart:")
+    print(f"  {snapshot_duration * 1000:>12.1f} ms to snapshot {size // 2:,} entries")
+    print(f"  {duration * 1000:>12.1f} ms to restore {size:,} entries")
+
+def bench_rolling(size, seconds=30, repeat=5):
+    # Measure reading the live results of `size` values spread over `seconds` per second buckets.
+    bot = make_bot()
+    collection = bot.collection
+    collection.rolling = Rolling(seconds)
+    now = round(time.time())
+    rng = random.Random(size)
+    for i in range(size):
+        timestamp = now - seconds + 1 + i * seconds // size
+        collection.set(f"user{i}", rng.choice("ABCD"), MessageTypes.TEXT, timestamp)
+        collection.set(f"user{i}", float(rng.randint(0, 100)), MessageTypes.NUMBERS, timestamp)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        collection.rolling.results()
+        durations.append(time.perf_counter() - start)
+    print("Live results:")
+    print(f"  {min(durations) * 1e6:>12.2f} µs for {size:,} values in {seconds} buckets")
+
+def shared_worker(path, lines, partition):
+    # Handle `lines` using a bot storing the values of its partition of the senders in the shared database at `path`.
+    bot = make_bot()
+    bot.shared_database = path
+    bot.shared_partition = partition
+    for line in lines:
+        bot.message_handler(Message(line))
+    bot.shared_store.close()
+
+def bench_shared(lines, workers):
+    # Measure the throughput of multiple processes sharing one database, each receiving all of the chat
+    # and storing the values of part of the senders. This does not scale with the amount of processes,
+    # as each of them still parses every message, and they all write to the same SQLite file.
+    print("Shared database:")
+    for n_workers in workers:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "shared.db")
+            # Create the database up front, so workers don't race to create its tables
+            SharedStore(path).close()
+            processes = [multiprocessing.Process(target=shared_worker, args=(path, lines, (i, n_workers))) for i in range(n_workers)]
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            duration = time.perf_counter() - start
+        print(f"  {n_workers:>2} workers: {len(lines) / duration:>12,.0f} messages/s")
+
+def bench_sharding(lines, workers):
+    # Measure the throughput of receiving a replayed chat stream like CubieBot does with Shards: from the socket through
+    # LeanWebsocket, which passes most lines on to the worker of their sender, until all workers have handled them.
+    # Compared to handling every message in this process, through the same LeanWebsocket and message_handler.
+    # Throughput only scales with the workers up to the rate at which this process passes lines on, given enough cores.
+    data = "".join(line + "\r\n" for line in lines).encode("UTF-8")
+    print(f"Shards, on {os.cpu_count()} cores:")
+    for n_workers in [0] + workers:
+        bot = make_bot()
+        bot.shard_count = n_workers
+        bot.get_channel()
+        ws = LeanWebsocket(host="", port=0, chan="#benchmark", nick="", auth="", callback=bot.message_handler,
+                           denied=lambda: bot.denied_users, forward=bot.forward_to_shards if n_workers else None)
+        ws.conn = StubSocket(data)
+        start = time.perf_counter()
+        while ws.conn.position < len(data):
+            ws.read()
+        received = time.perf_counter() - start
+        # Only returns once all workers have handled their lines
+        bot.collection.length(MessageTypes.TEXT)
+        duration = time.perf_counter() - start
+        if bot.shards is not None:
+            bot.shards.close()
+        name = f"{n_workers} workers" if n_workers else "no workers"
+        print(f"  {name:>12}: {len(lines) / duration:>12,.0f} messages/s, received at {len(lines) / received:>10,.0f} lines/s")
+
+def read_fields(m):
+    # Read the fields message_handler uses of a PRIVMSG, of which the badges only for commands
+    if m.type == "PRIVMSG":
+        if m.message.startswith("!"):
+            m.tags.get("badges", "")
+        return m.user, m.channel, m.message, m.tags.get("emotes", "")
+
+def receive_messages(data, callback):
+    # Receive data like TwitchWebsocket.run does, until all of it is received
+    conn = StubSocket(data)
+    data = ""
+    while conn.position < len(conn.data):
+        data += conn.recv(8192).decode("UTF-8")
+        lines = data.split("\r\n")
+        data = lines.pop()
+        for line in lines:
+            callback(Message(line))
+
+def receive_lean(data, callback):
+    # Receive data like LeanWebsocket.run does, until all of it is received
+    ws = LeanWebsocket(host="", port=0, chan="#benchmark", nick="", auth="", callback=callback,
+                       denied=lambda: CubieBot.normalize_names(DENIED_USERS))
+    ws.conn = StubSocket(data)
+    while ws.conn.position < len(ws.conn.data):
+        ws.read()
+
+def bench_parser(lines, repeat=3):
+    # Measure the cost of receiving and parsing lines, with TwitchWebsocket Messages and with LeanWebsocket.
+    # Allocations per line are the memory blocks still allocated for the received messages once their fields are read,
+    # as messages are kept until they are handled when queued, and short lived allocations are not counted.
+    data = "".join(line + "\r\n" for line in lines).encode("UTF-8")
+    print("Receiving:")
+    for name, receive in [("Message", receive_messages), ("LeanMessage", receive_lean)]:
+        duration = min(timeit.repeat(lambda: receive(data, read_fields), number=1, repeat=repeat))
+
+        messages = []
+        def keep(m):
+            read_fields(m)
+            messages.append(m)
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        receive(data, keep)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+        blocks = sys.getallocatedblocks() - blocks
+        print(f"  {name:<12} {len(lines) / duration:>12,.0f} lines/s {blocks / len(lines):>8.1f} allocations per line "
+              f"{current / len(lines):>8.0f} bytes per line, {len(messages):,} messages")
+
+def bench_startup(budget, repeat=5):
+    # Measure the cold start time of a new process importing and creating a CubieBot, against a budget in ms.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    def run(code):
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+            durations.append(time.perf_counter() - start)
+        return min(durations) * 1000
+    interpreter = run("pass")
+    startup = run("from TwitchCubieBot.CubieBot import CubieBot; CubieBot()")
+    print("Startup:")
+    print(f"  {interpreter:>12.1f} ms for the interpreter alone")
+    print(f"  {startup:>12.1f} ms to import and create a CubieBot, budget is {budget} ms" + (" (over budget!)" if startup > budget else ""))
+
+def bench_batch(n_lines, n_users):
+    # Measure the throughput of batch analysis of a chat log, if NumPy is installed.
+    from TwitchCubieBot import Batch
+    if Batch.np is None:
+        return
+    lines = generate_log(n_lines, n_users)
+    batch = Batch.Batch(make_bot())
+    start = time.perf_counter()
+    batch.process(lines)
+    batch.results()
+    duration = time.perf_counter() - start
+    print("Batch analysis:")
+    print(f"  {n_lines / duration:>12,.0f} lines/s")
+    print(f"  {duration / n_lines * 10_000_000:>12.1f} s for 10M lines")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CubieBot on generated chat.")
+    parser.add_argument("--messages", type=int, default=200_000, help="Amount of chat messages to generate.")
+    parser.add_argument("--users", type=int, default=50_000, help="Amount of different chatters.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="Collection sizes for command latency.")
+    parser.add_argument("--channels", type=int, default=1_000, help="Amount of idle channels to measure memory for.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Amounts of processes sharing a database.")
+    parser.add_argument("--startup-budget", type=float, default=150, help="Maximum cold start time in ms.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Results of commands are logged, which would otherwise clutter the output
+    logging.getLogger().setLevel(logging.WARNING)
+
+    lines = generate_chat(args.messages, args.users, args.seed)
+    print(f"{args.messages:,} messages from {args.users:,} chatters\n")
+    bench_handler(lines)
+    bench_parser(lines)
+    bench_metrics()
+    bench_commands(args.sizes)
+    bench_memory(lines)
+    bench_storage(max(args.sizes))
+    bench_repeats(max(args.sizes))
+    bench_channels(args.channels)
+    bench_restart(max(args.sizes))
+    bench_rolling(max(args.sizes))
+    bench_approximate(max(args.sizes))
+    bench_shared(lines, args.workers)
+    bench_sharding(lines, args.workers)
+    bench_startup(args.startup_budget)
+    bench_batch(args.messages, args.users)
+
+if __name__ == "__main__":
+    main()
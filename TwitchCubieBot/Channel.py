@@ -0,0 +1,25 @@
+from TwitchCubieBot.Data import Collection
+
+class Channel:
+    # State of one joined channel: its collection, polls, lookback time, permissions and command cooldown.
+    __slots__ = ("name", "collection", "polls", "lookback_time", "allowed_ranks", "allowed_people", "cooldowns")
+
+    def __init__(self, name, lookback_time, allowed_ranks, allowed_people, collection=None):
+        # Channel names are stored lowercase and without "#", like `m.channel`
+        self.name = Channel.normalize(name)
+        # Any Backend, by default an in-memory Collection
+        self.collection = Collection() if collection is None else collection
+        # Polls started with "!vote start", only created once a poll is started
+        self.polls = None
+        self.lookback_time = lookback_time
+        self.allowed_ranks = allowed_ranks
+        self.allowed_people = allowed_people
+        # Time until which each command is on cooldown, by command
+        self.cooldowns = {}
+
+    @staticmethod
+    def normalize(name):
+        return name.lstrip("#").lower()
+
+    def __repr__(self):
+        return f"#{self.name}"
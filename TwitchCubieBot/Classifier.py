@@ -0,0 +1,83 @@
+import math, re, string
+
+# A word is a number if, after removing percentages, replacing commas with dots
+# and disregarding everything after the first /, it matches this pattern.
+# Unlike float(), words like "nan", "inf" or "1_000" are not seen as numbers,
+# and neither are numbers like "1e999" that overflow to infinity.
+NUMBER_PATTERN = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+NUMBER_TABLE = str.maketrans({"%": None, ",": "."})
+# Characters a number can start with, to quickly skip regular words
+NUMBER_START = frozenset("+-.,%" + string.digits)
+LETTERS = frozenset(string.ascii_uppercase)
+
+class Classifier:
+    # Classifies a chat message as a number, a letter vote and/or an emote,
+    # while only splitting the message into words once.
+
+    def __init__(self):
+        # Emote id to emote text, e.g. {"25": "Kappa"}, filled as emotes are seen in chat
+        self.emote_names = {}
+
+    def classify(self, message, emotes=""):
+        # Returns a (number, letter, emote) tuple, with None for each of them that was not found.
+        words = message.split()
+        if not words:
+            return None, None, None
+        return self.find_number(words), self.find_letter(words), self.find_emote(message, emotes)
+
+    def find_number(self, words):
+        # Returns the first word that is a number as a float, e.g. 8.0 for "8/10", or -12.0 for "-12%".
+        for word in words:
+            if word[0] in NUMBER_START or word[0].isdigit():
+                word = word.translate(NUMBER_TABLE).partition("/")[0]
+                if NUMBER_PATTERN.fullmatch(word):
+                    number = float(word)
+                    if math.isfinite(number):
+                        return number
+        return None
+
+    def find_letter(self, words):
+        # Returns the letter that is voted for, e.g. "A" for "aaaaa" or "A please".
+        first_word = words[0].upper()
+        first_letter = first_word[0]
+
+        # If the first letter is a letter in the alphabet
+        # and the entire range until the first space contains only that letter
+        if first_letter not in LETTERS or first_word != first_letter * len(first_word):
+            return None
+
+        # Remove "I will/can/do" messages:
+        # If sentence starts with "I"
+        # and the sentence contains more than 1 word
+        # and the second word contains at least 2 letters.
+        if first_letter == "I" and len(first_word) == 1 and len(words) > 1 and len(words[1].upper()) > 2:
+            return None
+
+        # Remove "D I A L":
+        # If all words are 1 letter long
+        # and the sentence with all spaces removed is NOT equal to first letter placed len(words) in a row
+        if all(len(word) == 1 for word in words):
+            upper_words = [word.upper() for word in words]
+            if all(len(word) == 1 for word in upper_words) and "".join(upper_words) != len(words) * first_letter:
+                return None
+
+        return first_letter
+
+    def find_emote(self, message, emotes):
+        # Returns the id of the emote that is voted for, given the Twitch emotes tag.
+        # In the form of "678075:0-7/58765:9-19,107-117".
+        if not emotes:
+            return None
+        # As only one vote per sender is kept, the last emote in the tag is the one that counts,
+        # so the other emotes and ranges are never parsed.
+        # In the form of "58765", "9-19,107-117"
+        emote_id, _, ranges = emotes.rpartition("/")[2].partition(":")
+        if emote_id not in self.emote_names:
+            # In the form of "9", "19"
+            start, _, end = ranges.partition(",")[0].partition("-")
+            self.emote_names[emote_id] = message[int(start):int(end) + 1]
+        return emote_id
+
+    def emote_name(self, emote_id):
+        # Returns the text of an emote id, for use in chat.
+        return self.emote_names.get(emote_id, emote_id)
@@ -1,14 +1,33 @@
-from TwitchWebsocket import TwitchWebsocket
-import json, time, logging, os, string, sys
+import time, logging, signal, threading, zlib
 
 from TwitchCubieBot.Log import Log
 Log(__file__)
 
 from TwitchCubieBot.Settings import Settings
-from TwitchCubieBot.Data import Collection, MessageTypes
+from TwitchCubieBot.Channel import Channel
+from TwitchCubieBot.Classifier import Classifier
+from TwitchCubieBot.Ingestion import Ingestion
+from TwitchCubieBot.Data import MessageTypes
 from TwitchCubieBot.View import MessageSource, View
 
+# TwitchWebsocket and the optional Metrics, Persistence, Rolling and Shared modules are imported
+# once they are used, as importing them (and e.g. ssl, http.server and sqlite3) dominates startup time.
+
 class CubieBot:
+    # Names of the methods handling each command, by the first word of the message.
+    # Methods are looked up by name on use, so wrapped methods (e.g. by Metrics) are called.
+    COMMANDS = {"!average": "command_average", "!vote": "command_vote"}
+    # Seconds before the same command can be used again in the same channel.
+    # Prevents multiple people from attempting to call the same vote/average,
+    # and getting incorrect results the 2nd time.
+    COMMAND_COOLDOWN = 5
+    # Settings which are only read when starting, so changing them while running only logs a warning.
+    # Channel is included, as reloading only applies settings to the channels that were already joined.
+    RESTART_SETTINGS = ["Host", "Port", "Channel", "Nickname", "Authentication", "QueueSize", "Backpressure",
+                        "GlobalMessageLimit", "ChannelMessageLimit", "MetricsPort", "MetricsLogInterval",
+                        "PersistenceDirectory", "SnapshotInterval", "LiveInterval", "SharedDatabase", "SharedPartition",
+                        "SettingsReloadInterval", "Approximate", "Shards", "LeanParser"]
+
     def __init__(self):
         self.host = None
         self.port = None
@@ -20,27 +39,257 @@ class CubieBot:
         self.allowed_ranks = None
         self.allowed_people = None
         self.lookback_time = None
-        self.prev_command_time = 0
-        self.collection = Collection()
+        self.max_values = 0
+        self.poll_duration = 0
+        self.queue_size = None
+        self.backpressure = None
+        self.global_message_limit = None
+        self.channel_message_limit = None
+        self.metrics_port = None
+        self.metrics_log_interval = None
+        self.persistence_directory = None
+        self.snapshot_interval = None
+        self.live_interval = None
+        self.shared_database = None
+        # (index, count) of this process among the processes sharing the database
+        self.shared_partition = (0, 1)
+        self.settings_reload_interval = None
+        self.approximate = False
+        self.shard_count = 0
+        self.lean_parser = False
+        self.ingestion = None
+        self.metrics = None
+        self.persistence = None
+        self.publisher = None
+        self.shared_store = None
+        self.shards = None
+        # Sets of badge names by badges tag, as only a few distinct badge combinations are used
+        self._badges = {}
+        # Reloaded settings waiting to be applied by the thread handling messages, and the watcher providing them
+        self._pending_settings = None
+        self._settings_watch = None
+        # Values of the RESTART_SETTINGS when the settings were loaded, to warn when they change on reload
+        self._started_settings = None
+        # Joined channels by lowercase name without "#", each with their own collection
+        self.channels = {}
+        self.classifier = Classifier()
         self.view = View(self)
     
     def update_settings(self):
         # Fill previously initialised variables with data from the settings.txt file
-        s = Settings()
-        self.host, self.port, self.chan, self.nick, self.auth, self.denied_users, self.allowed_ranks, self.allowed_people, self.lookback_time = s.get_settings()
+        settings = Settings().get_settings()
+        self.host = settings["Host"]
+        self.port = settings["Port"]
+        # Channel is either one channel, or a list of channels. TwitchWebsocket joins the first one.
+        channels = settings["Channel"] if isinstance(settings["Channel"], list) else [settings["Channel"]]
+        self.chan = channels[0]
+        self.nick = settings["Nickname"]
+        self.auth = settings["Authentication"]
+        self.queue_size = settings["QueueSize"]
+        self.backpressure = settings["Backpressure"]
+        self.global_message_limit = settings["GlobalMessageLimit"]
+        self.channel_message_limit = settings["ChannelMessageLimit"]
+        self.metrics_port = settings["MetricsPort"]
+        self.metrics_log_interval = settings["MetricsLogInterval"]
+        self.persistence_directory = settings["PersistenceDirectory"]
+        self.snapshot_interval = settings["SnapshotInterval"]
+        self.live_interval = settings["LiveInterval"]
+        self.shared_database = settings["SharedDatabase"]
+        self.shared_partition = tuple(settings["SharedPartition"])
+        self.settings_reload_interval = settings["SettingsReloadInterval"]
+        self.approximate = settings["Approximate"]
+        self.shard_count = settings["Shards"]
+        self.lean_parser = settings["LeanParser"]
+        self._started_settings = {key: settings[key] for key in CubieBot.RESTART_SETTINGS}
+        self.apply_settings(settings, channels)
+
+    def apply_settings(self, settings, names=None):
+        # Apply the settings which can change while running: DeniedUsers, AllowedRanks, AllowedPeople,
+        # LookbackTime, MaxValues, PollDuration and ChannelSettings, for the channels in `names`, or for all current channels.
+        # Collections are kept. Their expiry queues are sorted by time rather than by expiry,
+        # so a changed LookbackTime takes effect on the next clean without rebuilding anything.
+        # All settings are read and checked before anything changes, so invalid settings are never half applied.
+        denied_users = CubieBot.normalize_names(settings["DeniedUsers"])
+        allowed_ranks = CubieBot.normalize_names(settings["AllowedRanks"])
+        allowed_people = CubieBot.normalize_names(settings["AllowedPeople"])
+        lookback_time = CubieBot.check_number("LookbackTime", settings["LookbackTime"])
+        max_values = CubieBot.check_number("MaxValues", settings["MaxValues"])
+        poll_duration = CubieBot.check_number("PollDuration", settings["PollDuration"])
+        self.update_channels(list(self.channels) if names is None else names, settings["ChannelSettings"],
+                             (lookback_time, allowed_ranks, allowed_people, max_values))
+        self.denied_users = denied_users
+        self.allowed_ranks = allowed_ranks
+        self.allowed_people = allowed_people
+        self.lookback_time = lookback_time
+        self.max_values = max_values
+        self.poll_duration = poll_duration
+
+    @staticmethod
+    def check_number(key, value):
+        # Returns the value of setting `key` if it is a number, and raises a ValueError otherwise
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{key} must be a number, not {value!r}.")
+        return value
+
+    @staticmethod
+    def ordinal(number):
+        # E.g. "1st", "12th", "22nd" or "99.9th"
+        text = f"{number:g}"
+        if number != int(number) or 11 <= int(number) % 100 <= 13:
+            return text + "th"
+        return text + {1: "st", 2: "nd", 3: "rd"}.get(int(number) % 10, "th")
+
+    @staticmethod
+    def normalize_names(names):
+        # Lowercase frozenset of user or rank names, for fast lookups
+        return frozenset(name.lower() for name in names)
+
+    def reload_settings(self, settings=None):
+        # Reload settings.txt while running. The new settings are applied before handling the next message,
+        # so a message is never handled with a mix of old and new settings.
+        try:
+            if settings is None:
+                try:
+                    settings = Settings().get_settings()
+                except ValueError:
+                    # Already logged, and the current settings are kept
+                    return
+            for key in CubieBot.RESTART_SETTINGS:
+                if self._started_settings is not None and settings[key] != self._started_settings[key]:
+                    logging.warning(f"Changing {key} requires a restart.")
+        except Exception as e:
+            # E.g. a missing setting. The current settings are kept until the file is fixed.
+            logging.error(f"Failed to reload settings: {e!r}")
+            return
+        self._pending_settings = settings
+        logging.info("Reloaded settings.")
+
+    def update_channels(self, names, channel_settings, defaults=None):
+        # Create or update a Channel for each name, with the LookbackTime, AllowedRanks and AllowedPeople
+        # from `channel_settings`, falling back to `defaults`: a (LookbackTime, AllowedRanks, AllowedPeople, MaxValues)
+        # tuple, or the current global settings if omitted.
+        # Every channel is checked and created before any existing channel changes.
+        lookback_time, allowed_ranks, allowed_people, max_values = defaults or \
+            (self.lookback_time, self.allowed_ranks, self.allowed_people, self.max_values)
+        channel_settings = {Channel.normalize(name): value for name, value in channel_settings.items()}
+        updates = []
+        for name in names:
+            name = Channel.normalize(name)
+            overrides = channel_settings.get(name, {})
+            channel_lookback_time = CubieBot.check_number("LookbackTime", overrides.get("LookbackTime", lookback_time))
+            channel_allowed_ranks = CubieBot.normalize_names(overrides.get("AllowedRanks", allowed_ranks))
+            channel_allowed_people = CubieBot.normalize_names(overrides.get("AllowedPeople", allowed_people))
+            # Keep existing channels, so their collections are kept
+            channel = self.channels.get(name) or self.create_channel(name, overrides.get("Approximate", self.approximate))
+            updates.append((name, channel, channel_lookback_time, channel_allowed_ranks, channel_allowed_people))
+
+        channels = {}
+        for name, channel, channel_lookback_time, channel_allowed_ranks, channel_allowed_people in updates:
+            channel.lookback_time = channel_lookback_time
+            channel.allowed_ranks = channel_allowed_ranks
+            channel.allowed_people = channel_allowed_people
+            # Values are capped, and expire while setting values as well as on commands
+            channel.collection.max_size = max_values
+            channel.collection.max_age = channel.lookback_time
+            if channel.collection.rolling is not None:
+                channel.collection.rolling.max_window = channel.lookback_time
+            channels[name] = channel
+        self.channels = channels
+
+    def get_channel(self, name=None):
+        # Get the Channel of the message, or of the first channel if no name is given.
+        name = Channel.normalize(name or self.chan or "")
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = self.create_channel(name)
+        return channel
+
+    def create_channel(self, name, approximate=None):
+        # Values are stored in memory, unless multiple bot processes share a database,
+        # messages are parsed and stored by worker processes, or only sketches of them are kept for huge channels
+        collection = None
+        if self.shared_database:
+            from TwitchCubieBot.Shared import SharedCollection, SharedStore
+            if self.shared_store is None:
+                self.shared_store = SharedStore(self.shared_database)
+            collection = SharedCollection(self.shared_store, Channel.normalize(name))
+        elif self.shard_count:
+            from TwitchCubieBot.Sharding import ShardedCollection, Shards
+            if self.shards is None:
+                self.shards = Shards(self.shard_count, self.classifier.emote_names)
+            collection = ShardedCollection(self.shards, Channel.normalize(name))
+        elif self.approximate if approximate is None else approximate:
+            from TwitchCubieBot.Approximate import ApproximateCollection
+            collection = ApproximateCollection(self.lookback_time)
+        channel = Channel(name, self.lookback_time, self.allowed_ranks, self.allowed_people, collection)
+        channel.collection.max_size = self.max_values
+        channel.collection.max_age = channel.lookback_time
+        if self.persistence is not None:
+            self.persistence.attach(channel)
+        if self.publisher is not None:
+            self.add_rolling(channel)
+        return channel
+
+    def add_rolling(self, channel):
+        # Keep live results of this channel, of which the changes are passed to the View on every publish
+        from TwitchCubieBot.Rolling import Rolling
+        rolling = channel.collection.rolling = Rolling(channel.lookback_time)
+        rolling.subscribe(lambda diff: self.view.live(diff, channel.name))
+
+    @property
+    def collection(self):
+        # Collection of the first channel
+        return self.get_channel().collection
+
+    def join_channels(self):
+        # Join all channels other than the first one, which TwitchWebsocket joins itself.
+        # This is done in the background, as Twitch only allows 20 joins per 10 seconds.
+        def join():
+            for name in list(self.channels):
+                if name != Channel.normalize(self.chan):
+                    self.ws.join_channel("#" + name)
+                    time.sleep(0.5)
+        threading.Thread(target=join, name="JoinChannels", daemon=True).start()
 
     def start(self):
-        self.ws = TwitchWebsocket(host=self.host, 
-                                  port=self.port,
-                                  chan=self.chan,
-                                  nick=self.nick,
-                                  auth=self.auth,
-                                  callback=self.message_handler,
-                                  capability=self.capability,
-                                  live=True)
+        self.start_services()
+
+        # Unless disabled with a QueueSize of 0, the websocket thread only queues messages,
+        # while a separate thread parses them and updates the collection.
+        callback = self.message_handler
+        if self.queue_size:
+            self.ingestion = Ingestion(self.message_handler, self.queue_size, self.backpressure)
+            self.ingestion.start()
+            callback = self.ingestion.put
+
+        # Chat messages are rate limited and sent from a separate thread
+        self.view.start_outbox(self.global_message_limit, self.channel_message_limit)
+
+        from TwitchCubieBot.Receiver import ChannelWebsocket, LeanWebsocket
+        if self.lean_parser or self.shards is not None:
+            # Only PRIVMSG lines of senders who are not denied are parsed, and only as far as needed
+            websocket, kwargs = LeanWebsocket, {"denied": lambda: self.denied_users}
+            if self.shards is not None:
+                # Most lines are passed on to the shards straight from the socket
+                kwargs["forward"] = self.forward_to_shards
+        else:
+            websocket, kwargs = ChannelWebsocket, {}
+        self.ws = websocket(host=self.host, 
+                            port=self.port,
+                            chan=self.chan,
+                            nick=self.nick,
+                            auth=self.auth,
+                            callback=callback,
+                            capability=self.capability,
+                            live=True,
+                            **kwargs)
         self.ws.start_nonblocking()
 
     def stop(self):
+        if self.ingestion is not None:
+            self.ingestion.stop()
+        self.view.stop_outbox()
+        self.stop_services()
         try:
             self.ws.join()
         except AttributeError:
@@ -48,129 +297,247 @@ class CubieBot:
             # In this case we have essentially already stopped
             pass
 
+    def start_services(self):
+        # Start everything enabled in the settings other than the connection to Twitch and the handling of messages,
+        # as these are shared by CubieBot and AsyncCubieBot.
+
+        # Apply changes to settings.txt while running
+        if self.settings_reload_interval:
+            self._settings_watch = Settings().watch(self.reload_settings, self.settings_reload_interval)
+
+        # Live results are only kept if they are published
+        if self.live_interval:
+            from TwitchCubieBot.Rolling import Publisher
+            self.publisher = Publisher(self, self.live_interval)
+            for channel in self.channels.values():
+                self.add_rolling(channel)
+            self.publisher.start()
+
+        # Restore the collections from before the previous shutdown or crash, unless persistence is disabled.
+        # A shared database already keeps its values across restarts.
+        if self.persistence_directory and not self.shared_database:
+            from TwitchCubieBot.Persistence import Persistence
+            self.persistence = Persistence(self, self.persistence_directory, self.snapshot_interval)
+            self.persistence.load()
+            self.persistence.start()
+
+        # Metrics are only collected if they are served or logged
+        if self.metrics_port or self.metrics_log_interval:
+            from TwitchCubieBot.Metrics import Metrics
+            self.metrics = Metrics(self)
+            self.metrics.instrument()
+            self.metrics.start(self.metrics_port, self.metrics_log_interval)
+
+    def stop_services(self):
+        if self._settings_watch is not None:
+            self._settings_watch.set()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.persistence is not None:
+            self.persistence.stop()
+        if self.publisher is not None:
+            self.publisher.stop()
+        if self.shared_store is not None:
+            self.shared_store.close()
+        if self.shards is not None:
+            self.shards.close()
+
     def message_handler(self, m):
         try:
-            if m.type == "366":
+            if self._pending_settings is not None:
+                settings, self._pending_settings = self._pending_settings, None
+                try:
+                    self.apply_settings(settings)
+                except Exception as e:
+                    logging.error(f"Failed to apply settings, keeping the current ones: {e!r}")
+
+            if m.type == "001":
+                # Successfully logged in, so other channels can be joined
+                self.join_channels()
+
+            elif m.type == "366":
                 logging.info(f"Successfully joined channel: #{m.channel}")
             
             elif m.type == "NOTICE":
                 logging.info(m.message)
                 
             elif m.type == "PRIVMSG":
-                # Look for commands.
-                if m.message.startswith("!average") and self.check_permissions(m) and self.check_timeout():
-                    self.command_average(m)
-                elif m.message.startswith("!vote") and self.check_permissions(m) and self.check_timeout():
-                    self.command_vote(m)
+                # Ignore (bot) users that are denied before anything else, so their messages cost almost nothing
+                if m.user in self.denied_users:
+                    return
+                channel = self.get_channel(m.channel)
+                # Look for commands. Other messages only cost a prefix check.
+                command = CubieBot.COMMANDS.get(m.message.partition(" ")[0]) if m.message.startswith("!") else None
+                if command is not None and self.check_command(m, channel, command, time.monotonic()):
+                    # When processes share a database, only the first one answers commands
+                    if self.shared_partition[0] == 0:
+                        getattr(self, command)(m, channel)
                 else:
                     # Parse message for potential numbers/votes and emotes.
-                    self.check_for_numbers(m.message, m.user)
-                    self.check_for_text(m.message, m.user)
-                    self.check_for_emotes(m)
+                    self.check_message(m, channel)
 
         except Exception as e:
             logging.error(e)
 
-    def check_timeout(self):
-        # Returns true if previous command was more than 5 seconds ago.
-        # Prevents multiple people from attempting to call the same vote/average, 
-        # and getting incorrect results the 2nd time
-        return self.prev_command_time + 5 < time.time()
-
-    def check_permissions(self, m):
-        for rank in self.allowed_ranks:
-            if rank in m.tags["badges"]:
-                return True
-        for name in self.allowed_people:
-            if m.user.lower() == name.lower():
-                return True
-        return False
+    def check_command(self, m, channel, command, now):
+        # Returns true if the command may be used, in which case its cooldown in this channel starts.
+        # The cooldown is checked before the permissions, as it is cheaper.
+        # `now` is a monotonic time in seconds, or the time of the message when replaying a log.
+        if channel.cooldowns.get(command, 0) > now or not self.check_permissions(m, channel):
+            return False
+        channel.cooldowns[command] = now + CubieBot.COMMAND_COOLDOWN
+        return True
+
+    def check_permissions(self, m, channel=None):
+        channel = channel or self.get_channel(m.channel)
+        return m.user.lower() in channel.allowed_people or not channel.allowed_ranks.isdisjoint(self.parse_badges(m.tags.get("badges", "")))
+
+    def parse_badges(self, badges):
+        # Returns the set of badge names in a badges tag like "moderator/1,subscriber/12",
+        # so "moderator" does not match e.g. a "moderator-partner" badge.
+        parsed = self._badges.get(badges)
+        if parsed is None:
+            if len(self._badges) >= 1024:
+                self._badges.clear()
+            parsed = self._badges[badges] = frozenset(badge.partition("/")[0] for badge in badges.split(",") if badge)
+        return parsed
 
     def check_denied_users(self, sender):
         # Check if sender is not a denied user (generally another bot).
+        # Twitch user names in messages are always lowercase, like the names in `denied_users`.
         return sender in self.denied_users
 
-    def command_average(self, m):
+    def command_average(self, m, channel=None):
+        channel = channel or self.get_channel(m.channel)
+        collection = channel.collection
         # Clean up the collection by removing old values.
-        self.collection.clean(self.lookback_time)
+        collection.clean(channel.lookback_time)
+
+        # Find out whether sender wants the median, mean, trimmed mean or a percentile.
+        method, name = self.check_average_type(m.message)
 
         # If there are numbers.
-        if self.collection.length(MessageTypes.NUMBERS) > 0:
+        if collection.length(MessageTypes.NUMBERS) > 0:
             # Calculate Average.
-            average = self.collection.average()
+            average = collection.average(method)
             
             # Send outputs.
-            out = f"/me The average is {average:.{0 if average % 1 == 0 else 2}f}."
+            out = self.format_average(average, name)
             source = MessageSource.AVERAGE_RESULTS
             
             # Clear out the saved data
-            self.collection.clear(MessageTypes.NUMBERS)
-
-            # Reset previous command time
-            self.prev_command_time = time.time()
+            collection.clear(MessageTypes.NUMBERS)
         else:
             out = "No recent numbers found to take the average from."
             source = MessageSource.AVERAGE_COMMAND_ERRORS
-        logging.info(out)
-        self.view.output(out, source)
+        logging.info(f"{channel}: {out}")
+        self.view.output(out, source, channel.name)
 
-    def command_vote(self, m):
+    def command_vote(self, m, channel=None):
+        channel = channel or self.get_channel(m.channel)
+        # "!vote start ..." and "!vote stop ..." manage polls instead
+        if self.check_poll_command(m.message):
+            return self.command_poll(m, channel)
+        collection = channel.collection
         # Clean up the collection by removing old values.
-        self.collection.clean(self.lookback_time)
+        collection.clean(channel.lookback_time)
         
         # Find out whether sender wants to vote using numbers, letters or emotes.
         message_type = self.check_vote_type(m.message)
         
         # If there are votes
-        if self.collection.length(message_type) > 0:
+        if collection.length(message_type) > 0:
             # Get the votes
-            votes = self.collection.vote(message_type)
-            # Turn votes into a message
-            if len(votes) == 1:
-                out = "/me {} won with {:.2f}%.".format(votes[0][0], votes[0][1] * 100)
-            else:
-                seperator = ", "
-                # If the vote is with emotes, we don't want commas directly after the emotes, or they will not turn into actual emotes in the chat.
-                if message_type == MessageTypes.EMOTES:
-                    seperator = " , "
-                out = "/me " + seperator.join([str(vote[0]) for vote in votes[:-1]]) + " and " + str(votes[-1][0]) + f" tied with {votes[0][1] * 100:.2f}% each."
+            votes = collection.vote(message_type)
+            out = self.format_vote(votes, message_type)
             source = MessageSource.VOTING_RESULTS
-            self.collection.clear(message_type)
-
-            # Reset previous command time
-            self.prev_command_time = time.time()
+            collection.clear(message_type)
         else:
             out = "No votes found."
             source = MessageSource.VOTING_COMMAND_ERRORS
-        logging.info(out)
-        self.view.output(out, source)
+        logging.info(f"{channel}: {out}")
+        self.view.output(out, source, channel.name)
+
+    def command_poll(self, m, channel=None):
+        channel = channel or self.get_channel(m.channel)
+        out, source = self.update_polls(m.message, channel, time.time())
+        logging.info(f"{channel}: {out}")
+        self.view.output(out, source, channel.name)
+
+    def update_polls(self, message, channel, now):
+        # Start a poll for "!vote start [name] [duration] options", or stop one for "!vote stop [name]".
+        # Returns the output and its MessageSource.
+        from TwitchCubieBot.Poll import Poll, Polls
+        words = message.split()
+        if words[1] == "start":
+            try:
+                poll = Poll.parse(words[2:], now, self.poll_duration, self.max_values)
+            except ValueError as e:
+                return str(e), MessageSource.VOTING_COMMAND_ERRORS
+            if channel.polls is None:
+                channel.polls = Polls()
+            channel.polls.start(poll, now)
+            return f"/me Started {'a poll' if poll.name is None else poll.name}, vote for {', '.join(poll.options())}.", MessageSource.VOTING_RESULTS
+
+        poll = channel.polls.stop(words[2].lower() if len(words) > 2 else None, now) if channel.polls else None
+        if poll is None:
+            return "No poll found.", MessageSource.VOTING_COMMAND_ERRORS
+        if poll.collection.length(poll.message_type) == 0:
+            return "No votes found.", MessageSource.VOTING_COMMAND_ERRORS
+        out = self.format_vote(poll.collection.vote(poll.message_type), poll.message_type)
+        if poll.name is not None:
+            out = out.replace("/me ", f"/me {poll.name}: ", 1)
+        return out, MessageSource.VOTING_RESULTS
+
+    def format_average(self, average, name):
+        return f"/me The {name} is {average:.{0 if average % 1 == 0 else 2}f}."
+
+    def format_vote(self, votes, message_type):
+        # Emotes are stored by id, so the names have to be used for the output
+        if message_type == MessageTypes.EMOTES:
+            votes = [(self.classifier.emote_name(value), percentage) for value, percentage in votes]
+        # Turn votes into a message
+        if len(votes) == 1:
+            return "/me {} won with {:.2f}%.".format(votes[0][0], votes[0][1] * 100)
+        seperator = ", "
+        # If the vote is with emotes, we don't want commas directly after the emotes, or they will not turn into actual emotes in the chat.
+        if message_type == MessageTypes.EMOTES:
+            seperator = " , "
+        return "/me " + seperator.join([str(vote[0]) for vote in votes[:-1]]) + " and " + str(votes[-1][0]) + f" tied with {votes[0][1] * 100:.2f}% each."
 
     def parse_number(self, message, sender):
         # Stripping message potentially containing a number of illegal characters.
         if self.check_denied_users(sender):
             return None
+        return self.classifier.find_number(message.split())
+
+    def check_average_type(self, message):
+        # Returns the method for Collection.average, and the name of the result used in the output.
+        message_list = message.split()
+        if len(message_list) == 2:
+            method = message_list[1].lower()
+            # If '!average mean'
+            if method == "mean":
+                return "mean", "mean"
+            # If '!average trimmed'
+            if method.startswith("trim"):
+                return "trimmed", "trimmed mean"
+            # If '!average p90'
+            if method.startswith("p"):
+                try:
+                    percentile = float(method[1:])
+                except ValueError:
+                    pass
+                else:
+                    if 0 < percentile <= 100:
+                        return f"p{percentile:g}", f"{CubieBot.ordinal(percentile)} percentile"
         
-        # Remove percentages, and replace commas with dots
-        remove = {"%":"", ",":"."}
-        for i in remove:
-            message = message.replace(i, remove[i])
-
-        # Split "8/10" by /, and disregard everything after the first /.
-        index = message.find("/")
-        if index != -1:
-            message = message[:index]
-
-        # Split by spaces, force message to be a list
-        message = message.split()
-        
-        # Check for each word if it's a number
-        for m in message:
-            try:
-                return float(m)
-            except ValueError:
-                pass
-        
-        return None
+        # Otherwise, the median:
+        return "median", "average"
+
+    def check_poll_command(self, message):
+        # Returns true for "!vote start ..." and "!vote stop ..."
+        return message.split()[1:2] in (["start"], ["stop"])
 
     def check_vote_type(self, message):
 
@@ -186,15 +553,76 @@ class CubieBot:
         # Otherwise:
         return MessageTypes.TEXT
 
+    def check_message(self, m, channel=None):
+        # Check the message for a number, a vote and an emote, while only splitting it once.
+        # Messages of denied users are already ignored by message_handler.
+        channel = channel or self.get_channel(m.channel)
+        collection = channel.collection
+        if self.shards is not None:
+            # The worker process of the sender parses and stores the message.
+            # It is only parsed here as well while polls are open, as otherwise it is passed on by forward_to_shards.
+            self.shards.put(m.user, m.full_message)
+            if not channel.polls:
+                return
+            number, letter, _ = self.classifier.classify(m.message)
+            channel.polls.add(m.user, number, letter, round(time.time()))
+            return
+        if self.shared_partition[1] > 1 and not self.check_partition(m.user):
+            # Another process sharing the database stores the values of this sender,
+            # while polls are only kept by the first process
+            if channel.polls:
+                number, letter, _ = self.classifier.classify(m.message)
+                channel.polls.add(m.user, number, letter, round(time.time()))
+            return
+
+        number, letter, emote = self.classifier.classify(m.message, m.tags.get("emotes", ""))
+        if self.metrics is not None:
+            # Count the found values per MessageTypes value, inline as this runs for every message
+            values = self.metrics.values
+            if letter is not None:
+                values[0] += 1
+            if number is not None:
+                values[1] += 1
+            if emote is not None:
+                values[2] += 1
+        if number is not None:
+            self.view.output(number, MessageSource.NUMBERS)
+            collection.set(m.user, number, MessageTypes.NUMBERS)
+        if letter is not None:
+            self.view.output(letter, MessageSource.VOTES)
+            collection.set(m.user, letter, MessageTypes.TEXT)
+        if emote is not None:
+            collection.set(m.user, emote, MessageTypes.EMOTES)
+        if channel.polls:
+            channel.polls.add(m.user, number, letter, round(time.time()))
+
+    def forward_to_shards(self, m):
+        # Called by the LeanWebsocket thread with every PRIVMSG LeanMessage of a sender who is not denied, when using Shards.
+        # The raw line is passed to the worker of its sender right away, so it is never decoded, queued or handled here,
+        # other than commands and messages in channels with open polls, for which this returns false.
+        # Lines received after a command that is still queued may thus be included in its results.
+        if m.startswith(b"!"):
+            return False
+        channel = self.channels.get(Channel.normalize(m.channel))
+        if channel is None or channel.polls:
+            return False
+        self.shards.put(m.user, m.raw)
+        return True
+
+    def check_partition(self, sender):
+        # Whether this process stores the values of `sender`, when multiple processes share a database.
+        # Uses crc32 rather than hash, as the hash of a string differs between processes.
+        index, count = self.shared_partition
+        return zlib.crc32(sender.encode("UTF-8")) % count == index
+
     def check_for_numbers(self, message, sender):
         # Check if the message contains a number.
-        for m in message.split():
-            value = self.parse_number(m, sender)
-            # Type of msg is only a float if a number was found.
-            if type(value) == float:
-                self.view.output(value, MessageSource.NUMBERS)
-                self.collection.set(sender, value, MessageTypes.NUMBERS)
-                return value
+        value = self.parse_number(message, sender)
+        # Type of msg is only a float if a number was found.
+        if type(value) == float:
+            self.view.output(value, MessageSource.NUMBERS)
+            self.collection.set(sender, value, MessageTypes.NUMBERS)
+            return value
         return False
 
     def check_for_text(self, message, sender):
@@ -202,27 +630,9 @@ class CubieBot:
         if self.check_denied_users(sender):
             return False
 
-        message_list = message.upper().split()
-        first_word = message_list[0] # Also guaranteed to be upper
-        first_letter = first_word[0] # Also guaranteed to be upper
-
-        # If the first letter is a letter in the alphabet
-        # and the entire range until the first space contains only that letter
-        if first_letter in string.ascii_uppercase and first_word == first_letter * len(first_word):
-            
-            # Remove "I will/can/do" messages:
-            # If sentence starts with "I"
-            # and the sentence contains more than 1 word
-            # and the second word contains at least 2 letters.
-            if first_letter == "I" and len(first_word) == 1 and len(message_list) > 1 and len(message_list[1]) > 2:
-                return False
-
-            # Remove "D I A L":
-            # If all words are 1 letter long
-            # and the sentence with all spaces removed is NOT equal to first letter placed len(message_list) in a row
-            if len([i for i in message_list if len(i) == 1]) == len(message_list) and "".join(message_list) != len(message_list) * first_letter:
-                return False
-            
+        words = message.split()
+        first_letter = self.classifier.find_letter(words) if words else None
+        if first_letter is not None:
             self.view.output(first_letter, MessageSource.VOTES)
             self.collection.set(sender, first_letter, MessageTypes.TEXT)
             return True
@@ -230,28 +640,17 @@ class CubieBot:
         return False
     
     def check_for_emotes(self, m):
-        emotes = m.tags["emotes"]
-        # If there are no emotes, return
-        if len(emotes) == 0:
-            return
-
-        # In the form of "678075:0-7/58765:9-19,107-117"
-        emote_list = emotes.split("/")
-        # In the form of ["678075:0-7", "58765:9-19,107-117"]
-        for emote in emote_list:
-            index_string = emote.split(":")[1]
-            # In the form of "9-19,107-117"
-            index_string_list = index_string.split(",")
-            # In the form of ["9-19", "107-117"]
-            for index in index_string_list:
-                start = int(index.split("-")[0])
-                end = int(index.split("-")[1]) + 1 # Add 1 for easy slicing
-                self.collection.set(m.user, m.message[start:end], MessageTypes.EMOTES)
+        emote = self.classifier.find_emote(m.message, m.tags.get("emotes", ""))
+        if emote is not None:
+            self.get_channel(m.channel).collection.set(m.user, emote, MessageTypes.EMOTES)
 
 if __name__ == "__main__":
     bot = CubieBot()
     bot.update_settings()
     bot.start()
+    # Settings can also be reloaded using `kill -HUP <pid>`, where supported
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: bot.reload_settings())
     # This method of endlessly sleeping, while the bot itself does not hold up the thread allows
     # other bots, such as my TwitchCubieBotGUI to start the bot more conveniently.
     try:
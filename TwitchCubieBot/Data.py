@@ -1,13 +1,19 @@
 
+from abc import ABC, abstractmethod
+from collections import deque
 from enum import Enum
-import time
+import bisect, itertools, logging, math, sys, time
+logger = logging.getLogger(__name__)
 
 class Message:
     # Message class to store information about a message.
-    def __init__(self, sender, message):
+    # Uses __slots__ as a collection may hold hundreds of thousands of these.
+    __slots__ = ("sender", "message", "timestamp")
+
+    def __init__(self, sender, message, timestamp=None):
         self.sender = sender
         self.message = message
-        self.timestamp = round(time.time())
+        self.timestamp = round(time.time()) if timestamp is None else timestamp
     
     def get_message(self):
         return self.message
@@ -24,58 +30,413 @@ class MessageTypes(Enum):
     NUMBERS = 1
     EMOTES = 2
 
-class Collection:
-    def __init__(self):
+NUMBERS = MessageTypes.NUMBERS.value
+
+def sorted_average(values, method="median"):
+    # Average of a sorted list of numbers. Method is either "median", "mean", "trimmed" for the mean of the middle 80% of the values,
+    # or a percentile like "p90".
+    n = len(values)
+    if n == 0:
+        return 0
+
+    if method == "mean":
+        return math.fsum(values) / n
+
+    if method == "trimmed":
+        # Remove the lowest and highest 10% of values
+        k = n // 10
+        return math.fsum(values[k:n - k]) / (n - 2 * k)
+
+    if method.startswith("p"):
+        # Nearest-rank percentile
+        percentile = float(method[1:])
+        return values[max(math.ceil(percentile / 100 * n) - 1, 0)]
+
+    # Median, taking the mean of the two middle values for even lengths
+    middle = n // 2
+    if n % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+class SortedNumbers:
+    # Numbers in sorted order, stored as consecutive sorted sublists of about LOAD numbers each,
+    # so inserting or removing a number only moves the numbers within one sublist rather than all of them.
+    # Supports len, iteration, and indexing and slicing by rank, so it can be passed to sorted_average.
+    LOAD = 1000
+
+    def __init__(self, values=()):
+        self.rebuild(values)
+
+    def rebuild(self, values):
+        # Replaces all numbers in one pass, which is much cheaper than adding or removing many of them one by one
+        values = sorted(values)
+        load = SortedNumbers.LOAD
+        self._lists = [values[i:i + load] for i in range(0, len(values), load)]
+        # Highest number of each sublist, to find the sublist of a number
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._len = len(values)
+        # Amount of numbers up to and including each sublist, only computed once indexed
+        self._offsets = None
+
+    def clear(self):
+        self.rebuild(())
+
+    def add(self, value):
+        lists, maxes = self._lists, self._maxes
+        self._len += 1
+        self._offsets = None
+        if not lists:
+            lists.append([value])
+            maxes.append(value)
+            return
+        i = bisect.bisect_left(maxes, value)
+        if i == len(lists):
+            # Higher than all numbers, as e.g. with increasing values
+            i -= 1
+            lists[i].append(value)
+            maxes[i] = value
+        else:
+            bisect.insort(lists[i], value)
+        if len(lists[i]) > 2 * SortedNumbers.LOAD:
+            sublist = lists[i]
+            half = len(sublist) // 2
+            lists[i:i + 1] = [sublist[:half], sublist[half:]]
+            maxes[i:i + 1] = [sublist[half - 1], sublist[-1]]
+
+    def remove(self, value):
+        lists, maxes = self._lists, self._maxes
+        # The first sublist with a maximum of at least `value` holds its first occurrence
+        i = bisect.bisect_left(maxes, value)
+        sublist = lists[i] if i < len(lists) else ()
+        j = bisect.bisect_left(sublist, value)
+        if j == len(sublist) or sublist[j] != value:
+            raise ValueError(f"{value} is not one of the numbers.")
+        del sublist[j]
+        self._len -= 1
+        self._offsets = None
+        if not sublist:
+            del lists[i]
+            del maxes[i]
+        elif j == len(sublist):
+            maxes[i] = sublist[-1]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._lists)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(itertools.islice(self, *index.indices(self._len)))
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("Index out of range.")
+        if self._offsets is None:
+            self._offsets = list(itertools.accumulate(len(sublist) for sublist in self._lists))
+        i = bisect.bisect_right(self._offsets, index)
+        return self._lists[i][index - self._offsets[i - 1] if i else index]
+
+class Backend(ABC):
+    """ Storage of the most recent value of every sender, per message type """
+
+    # Optional hooks, which only the in-memory Collection calls
+    journal = None
+    rolling = None
+    # Optional limits, which only the in-memory Collection applies
+    max_size = 0
+    max_age = None
+
+    @abstractmethod
+    def set(self, sender, message, message_type, timestamp=None):
+        pass
+
+    @abstractmethod
+    def clean(self, seconds):
+        # Removes values older than 'seconds' seconds
+        pass
+
+    @abstractmethod
+    def average(self, method="median"):
+        pass
+
+    @abstractmethod
+    def vote(self, message_type):
+        pass
+
+    @abstractmethod
+    def length(self, message_type):
+        pass
+
+    @abstractmethod
+    def clear(self, message_type):
+        pass
+
+class Collection(Backend):
+    # In-memory Backend, which only the current process can use.
+    def __init__(self, max_size=0, max_age=None):
         self.text = {}
         self.numbers = {}
         self.emotes = {}
 
         self._accessor = [self.text, self.numbers, self.emotes]
 
-    def set(self, sender, message, message_type):
-        self._accessor[message_type.value][sender] = Message(sender, message)
+        # Live amount of votes per value, for each message type.
+        # Kept up to date in set, clean and clear so voting never has to recount.
+        self._tallies = [{}, {}, {}]
+        # Cached highest tally for each message type, or None if it needs to be recomputed.
+        self._max = [0, 0, 0]
+
+        # Messages for each message type in the order they were set or refreshed, and thus sorted by timestamp,
+        # alongside the timestamp each was queued with. Messages that were overwritten by a newer message of
+        # the same sender, or refreshed since, are left in the queue, and are skipped once they expire.
+        # Queues are only created once needed, which keeps idle collections small.
+        self._expiry = [None, None, None]
+        self._expiry_times = [None, None, None]
+
+        # All current numbers in sorted order, so order statistics like the median don't need a sort.
+        self._sorted_numbers = SortedNumbers()
+
+        # Amount of values removed by clean, and by eviction once max_size is reached, for each message type
+        self.expired = [0, 0, 0]
+        self.evicted = [0, 0, 0]
+
+        # Maximum amount of senders per message type, or 0 for no limit. Once reached,
+        # the sender whose value was set or refreshed the longest ago is evicted.
+        self.max_size = max_size
+        # If set, values older than `max_age` seconds are also removed while setting values, once per second,
+        # so memory does not grow with every chatter when no command is used for a while.
+        self.max_age = max_age
+
+        # Timestamp shared by all messages set within the same second, rather than one int per message
+        self._timestamp = 0
+
+        # Optional function called with (type index, sender, value, timestamp) for every set,
+        # and with (type index, None, None, None) for every clear, e.g. to persist the collection.
+        self.journal = None
+
+        # Optional Rolling aggregates of this collection, updated on every set
+        self.rolling = None
+
+    def set(self, sender, message, message_type, timestamp=None):
+        # Timestamp is only given when restoring messages, and must not be older than previously set messages.
+        index = message_type.value
+        _dict = self._accessor[index]
+        if timestamp is None:
+            timestamp = round(time.time())
+        if timestamp != self._timestamp:
+            self._timestamp = timestamp
+            if self.max_age is not None:
+                self.clean(self.max_age)
+
+        previous = _dict.get(sender)
+        if previous is not None and previous.message == message:
+            # Fast path for a sender repeating their value, which only needs a newer timestamp
+            if previous.timestamp != self._timestamp:
+                self._refresh(index, previous)
+            return
+        if index == NUMBERS and not math.isfinite(message):
+            raise ValueError(f"Numbers must be finite, not {message}.")
+
+        # The hooks are called before anything changes, so if one of them fails the collection is left as it was
+        if self.journal is not None:
+            self.journal(index, sender, message, self._timestamp)
+        if self.rolling is not None:
+            self.rolling.add(index, message, self._timestamp)
+            if previous is not None:
+                self.rolling.remove(index, previous.message, previous.timestamp)
+
+        if previous is not None:
+            # Remove the previous vote of this sender from the tally
+            self._untally(index, previous.message)
+        # Share equal text and emote values between messages
+        if type(message) == str:
+            message = sys.intern(message)
+        _dict[sender] = Message(sender, message, self._timestamp)
+        self._tally(index, message)
+
+        self._enqueue(index, _dict[sender])
+        if previous is None and self.max_size and len(_dict) > self.max_size:
+            self._evict(index)
+
+    def restore(self, message_type, entries):
+        # Replace all values of the type with `entries`, a list of (sender, value, timestamp) tuples with one
+        # per sender, in order of their timestamp. Builds everything in one pass rather than setting every value,
+        # e.g. to restore the collection on startup. The journal is not called.
+        index = message_type.value
+        if self.max_size and len(entries) > self.max_size:
+            # Like set, only the most recent senders are kept
+            self.evicted[index] += len(entries) - self.max_size
+            entries = entries[-self.max_size:]
+        intern = sys.intern
+        messages = [Message(sender, intern(value) if type(value) == str else value, timestamp)
+                    for sender, value, timestamp in entries]
+        if index == NUMBERS and not all(math.isfinite(message.message) for message in messages):
+            raise ValueError("Numbers must be finite.")
+
+        _dict = self._accessor[index]
+        _dict.clear()
+        _dict.update((message.sender, message) for message in messages)
+        tally = self._tallies[index]
+        tally.clear()
+        for message in messages:
+            tally[message.message] = tally.get(message.message, 0) + 1
+        self._max[index] = None
+        self._expiry[index] = deque(messages)
+        self._expiry_times[index] = deque(message.timestamp for message in messages)
+        if index == NUMBERS:
+            self._sorted_numbers.rebuild(message.message for message in messages)
+        if messages:
+            self._timestamp = max(self._timestamp, messages[-1].timestamp)
+        if self.rolling is not None:
+            self.rolling.clear(index)
+            for message in messages:
+                self.rolling.add(index, message.message, message.timestamp)
+
+    def _refresh(self, index, message):
+        if self.journal is not None:
+            self.journal(index, message.sender, message.message, self._timestamp)
+        if self.rolling is not None:
+            self.rolling.add(index, message.message, self._timestamp)
+            self.rolling.remove(index, message.message, message.timestamp)
+        message.timestamp = self._timestamp
+        self._enqueue(index, message)
+
+    def _enqueue(self, index, message):
+        queue = self._expiry[index]
+        if queue is None:
+            queue = self._expiry[index] = deque()
+            self._expiry_times[index] = deque()
+        queue.append(message)
+        self._expiry_times[index].append(self._timestamp)
+        # If clean is not called for a while, overwritten messages would keep piling up in the queue
+        if len(queue) > 2 * len(self._accessor[index]) + 1024:
+            self._compact(index)
+
+    def _current(self, index, message, timestamp):
+        # Whether a queued message is still the value of its sender, and was not refreshed since it was queued
+        return message.timestamp == timestamp and self._accessor[index].get(message.sender) is message
+
+    def _compact(self, index):
+        # Drop all overwritten and refreshed messages from the expiry queue, while keeping the order
+        entries = [(message, timestamp) for message, timestamp in zip(self._expiry[index], self._expiry_times[index])
+                   if self._current(index, message, timestamp)]
+        self._expiry[index] = deque(message for message, _ in entries)
+        self._expiry_times[index] = deque(timestamp for _, timestamp in entries)
+
+    def _remove(self, index, message, removed=None):
+        # If a `removed` list is given, removed numbers are added to it rather than removed from the sorted numbers
+        del self._accessor[index][message.sender]
+        self._untally(index, message.message, removed)
+        if self.rolling is not None:
+            self.rolling.remove(index, message.message, message.timestamp)
+
+    def _evict(self, index):
+        # Remove the least recently set or refreshed value, as the queue is in that order
+        queue, times = self._expiry[index], self._expiry_times[index]
+        while True:
+            message, timestamp = queue.popleft(), times.popleft()
+            if self._current(index, message, timestamp):
+                break
+        self._remove(index, message)
+        self.evicted[index] += 1
+        # Log the first eviction, and every 1000th after that
+        if self.evicted[index] % 1000 == 1:
+            logger.warning(f"Reached the maximum of {self.max_size} {MessageTypes(index).name.lower()} values, "
+                           f"evicted {self.evicted[index]} values of the least recent senders so far.")
+
+    def _tally(self, index, value):
+        tally = self._tallies[index]
+        count = tally.get(value, 0) + 1
+        tally[value] = count
+        if index == NUMBERS:
+            self._sorted_numbers.add(value)
+        if self._max[index] is not None and count > self._max[index]:
+            self._max[index] = count
+
+    def _untally(self, index, value, removed=None):
+        tally = self._tallies[index]
+        count = tally[value] - 1
+        if count == 0:
+            tally.pop(value)
+        else:
+            tally[value] = count
+        if index == NUMBERS:
+            if removed is None:
+                self._sorted_numbers.remove(value)
+            else:
+                removed.append(value)
+        # If this value held the maximum, the maximum may have decreased
+        if count + 1 == self._max[index]:
+            self._max[index] = None
+
+    def _get_max(self, index):
+        # Recomputing only walks over the distinct values, not over every sender
+        if self._max[index] is None:
+            self._max[index] = max(self._tallies[index].values(), default=0)
+        return self._max[index]
 
     def clean(self, seconds):
         # Removes values older than 'seconds' seconds
+        cutoff = time.time() - seconds
+
+        for index in range(len(self._accessor)):
+            queue, times = self._expiry[index], self._expiry_times[index]
+            removed = [] if index == NUMBERS else None
+            # Only the messages that actually expired are visited, as the queue is sorted by timestamp
+            while times and times[0] < cutoff:
+                message, timestamp = queue.popleft(), times.popleft()
+                # Skip messages that have since been overwritten or refreshed by the same sender
+                if self._current(index, message, timestamp):
+                    self._remove(index, message, removed)
+                    self.expired[index] += 1
+            if removed:
+                self._remove_numbers(removed)
+
+    def _remove_numbers(self, removed):
+        # Remove expired numbers from the sorted numbers. If many expired at once,
+        # sorting the remaining numbers again is cheaper than removing every expired one.
+        if len(removed) * 16 > len(self.numbers):
+            self._sorted_numbers.rebuild(message.message for message in self.numbers.values())
+        else:
+            for value in removed:
+                self._sorted_numbers.remove(value)
 
-        for _dict in self._accessor:
-            # List of keys to remove, as we can't remove from a dict during iteration
-            to_remove = []
-
-            for key in _dict:
-                if _dict[key].outdated(seconds):
-                    # Remove the item from the dict
-                    to_remove.append(key)
-
-            # Remove items from dict
-            for key in to_remove:
-                _dict.pop(key)
-
-    def average(self):
-        if len(self.numbers) == 0:
-            return 0
-        values = sorted(self.numbers[key].get_message() for key in self.numbers)
-        median = values[round(len(values) / 2)]
-        return median
+    def average(self, method="median"):
+        return sorted_average(self._sorted_numbers, method)
     
     def vote(self, message_type):
-        # Make a dict for voting
-        vote_dict = {}
-        for key in self._accessor[message_type.value]:
-            value = self._accessor[message_type.value][key].get_message()
-            if value in vote_dict:
-                vote_dict[value] += 1
-            else:
-                vote_dict[value] = 1
+        index = message_type.value
+        tally = self._tallies[index]
 
-        # Get max and sum from the values
-        _max = max(vote_dict.values())
-        _sum = sum(vote_dict.values())
+        # Get max and sum from the live tally. Every sender has exactly one vote.
+        _max = self._get_max(index)
+        _sum = len(self._accessor[index])
         # Return the winning votes like: [(3, 0.4), (4, 0.4)] if the values 3 and 4 tied with 40% each.
-        return [(key, _max / _sum) for key in vote_dict if vote_dict[key] == _max]
+        # Ties are sorted by value, so the order does not depend on the order in which the votes came in.
+        return sorted((key, _max / _sum) for key in tally if tally[key] == _max)
 
     def length(self, message_type):
         return len(self._accessor[message_type.value])
+
+    def tally(self, message_type):
+        # Copy of the amount of votes per value, e.g. to merge with the tallies of other collections
+        return dict(self._tallies[message_type.value])
+
+    def sorted_numbers(self):
+        # Copy of all current numbers in sorted order
+        return list(self._sorted_numbers)
     
     def clear(self, message_type):
+        if self.journal is not None:
+            self.journal(message_type.value, None, None, None)
+        if self.rolling is not None:
+            self.rolling.clear(message_type.value)
+        self._tallies[message_type.value].clear()
+        self._max[message_type.value] = 0
+        self._expiry[message_type.value] = None
+        self._expiry_times[message_type.value] = None
+        if message_type == MessageTypes.NUMBERS:
+            self._sorted_numbers.clear()
         return self._accessor[message_type.value].clear()
\ No newline at end of file
@@ -0,0 +1,85 @@
+from collections import deque
+import logging, threading, time
+logger = logging.getLogger(__name__)
+
+class Ingestion(threading.Thread):
+    """ Bounded queue between the websocket thread and a thread which handles the messages in batches """
+
+    BACKPRESSURE = ("drop_oldest", "block")
+
+    def __init__(self, callback, max_size=10000, backpressure="drop_oldest", batch_size=256):
+        if backpressure not in Ingestion.BACKPRESSURE:
+            raise ValueError(f"Backpressure must be one of {Ingestion.BACKPRESSURE}, not {backpressure!r}.")
+        threading.Thread.__init__(self)
+        self.name = "Ingestion"
+        self.daemon = True
+
+        self.callback = callback
+        self.max_size = max_size
+        self.backpressure = backpressure
+        self.batch_size = batch_size
+
+        self.queue = deque()
+        lock = threading.Lock()
+        self._not_empty = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+        self._stop_event = threading.Event()
+
+        # Counters
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        # Amount of messages currently waiting to be handled
+        return len(self.queue)
+
+    def put(self, m):
+        # Called from the websocket thread, so this should never do more than queue the message.
+        with self._not_empty:
+            self.received += 1
+            if len(self.queue) >= self.max_size:
+                if self.backpressure == "block":
+                    while len(self.queue) >= self.max_size and not self._stop_event.is_set():
+                        self._not_full.wait()
+                else:
+                    self.queue.popleft()
+                    self.dropped += 1
+                    # Log the first drop, and every 1000th after that
+                    if self.dropped % 1000 == 1:
+                        logger.warning(f"Ingestion queue is full, dropped {self.dropped} messages so far.")
+            self.queue.append(m)
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+            self._not_empty.notify()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self._not_empty:
+                while not self.queue and not self._stop_event.is_set():
+                    self._not_empty.wait()
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self._not_full.notify_all()
+
+            for m in batch:
+                self.callback(m)
+            self.processed += len(batch)
+
+    def join_queue(self, timeout=None):
+        # Wait until all currently queued messages have been handled. Returns whether this succeeded.
+        with self._not_empty:
+            target = self.received - self.dropped
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.processed < target:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        with self._not_empty:
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
@@ -1,12 +1,26 @@
 import logging, os
-import logging.config
 
 class Log():
+    # Whether logging was already set up, as only the first call should configure it
+    configured = False
+
     def __init__(self, main_file):
+        if Log.configured:
+            return
+        Log.configured = True
+
+        this_file = os.path.basename(main_file)
+
+        # If you have a logging config like me, use it
+        if "PYTHON_LOGGING_CONFIG" in os.environ:
+            # Only imported when used, as logging.config is slow to import
+            from logging.config import fileConfig
+            fileConfig(os.environ.get("PYTHON_LOGGING_CONFIG"), defaults={"logfilename": this_file.replace(".py", ".log")})
+            return
+
         # Dynamically change size set up for name in the logger
         here = os.path.abspath(os.path.dirname(main_file))
-        this_file = os.path.basename(main_file)
-        
+
         # "root" is already 4
         max_name_size = 4
         # This try-except will help in the case of importing this as a module.
@@ -19,9 +33,5 @@ class Log():
         except FileNotFoundError:
             pass
 
-        # If you have a logging config like me, use it
-        if "PYTHON_LOGGING_CONFIG" in os.environ:
-            logging.config.fileConfig(os.environ.get("PYTHON_LOGGING_CONFIG"), defaults={"logfilename": this_file.replace(".py", ".log")})
-        else:
-            # If you don't, use a standard config that outputs some INFO in the console
-            logging.basicConfig(level=logging.INFO, format=f'[%(asctime)s] [%(name)-{max_name_size}s] [%(levelname)-8s] - %(message)s')
\ No newline at end of file
+        # If you don't, use a standard config that outputs some INFO in the console
+        logging.basicConfig(level=logging.INFO, format=f'[%(asctime)s] [%(name)-{max_name_size}s] [%(levelname)-8s] - %(message)s')
@@ -0,0 +1,174 @@
+import bisect, itertools, logging, threading, time
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Data import MessageTypes
+from TwitchCubieBot.View import MessageSource
+
+TEXT = MessageTypes.TEXT.value
+NUMBERS = MessageTypes.NUMBERS.value
+
+class Histogram:
+    # Latency histogram with fixed buckets, in nanoseconds.
+    BOUNDS = [500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, 1_000_000, 10_000_000, 100_000_000]
+
+    def __init__(self):
+        # One count per bucket, plus one for values above the last bound
+        self.counts = [0] * (len(Histogram.BOUNDS) + 1)
+        self.sum = 0
+
+    def observe(self, nanoseconds):
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, nanoseconds)] += 1
+        self.sum += nanoseconds
+
+class Metrics:
+    """ Counters and latency histograms of a CubieBot, in the Prometheus text format """
+
+    # Methods of which every call is timed. These are not called for every message.
+    TIMED = ["command_vote", "command_average"]
+
+    def __init__(self, bot, sample=32):
+        self.bot = bot
+        # message_handler, check_message and Classifier.classify are only timed for 1 in `sample` messages,
+        # as swapping in the timed versions makes Python undo its specialisation of the call sites,
+        # which costs several times more than reading the clock and updating the histograms.
+        self.sample = sample
+        # Amount of values found per MessageTypes, indexed by value
+        self.values = [0] * len(MessageTypes)
+        # Amount of View.output calls per MessageSource
+        self.outputs = {}
+        self.histograms = {}
+        self._server = None
+
+    def instrument(self):
+        # Replace the bot methods by timed versions, and count View outputs.
+        bot = self.bot
+        for name in Metrics.TIMED:
+            setattr(bot, name, self._timed(name, getattr(bot, name)))
+
+        handler = bot.message_handler
+        timed_handler = self._timed("message_handler", handler)
+        timed_check = self._timed("check_message", bot.check_message)
+        classifier = bot.classifier
+        timed_classify = self._timed("classify", classifier.classify)
+        sample = self.sample
+        calls = itertools.count(1)
+        def sampled_handler(m):
+            if next(calls) % sample:
+                return handler(m)
+            # Time check_message and the classifier as well, during this call only
+            bot.check_message = timed_check
+            classifier.classify = timed_classify
+            try:
+                return timed_handler(m)
+            finally:
+                del bot.check_message
+                del classifier.classify
+        bot.message_handler = sampled_handler
+
+        # Numbers and votes are already counted in `values`, so only the other outputs are counted here.
+        # These are compared by identity, as hashing an Enum member is relatively slow.
+        outputs = self.outputs
+        output = bot.view.output
+        numbers, votes = MessageSource.NUMBERS, MessageSource.VOTES
+        def counted_output(message, source, channel=None):
+            if source is not numbers and source is not votes:
+                outputs[source] = outputs.get(source, 0) + 1
+            output(message, source, channel)
+        bot.view.output = counted_output
+
+    def _timed(self, name, function):
+        # Exceptions are not timed, as message_handler logs them instead of raising.
+        histogram = self.histograms.setdefault(name, Histogram())
+        counts = histogram.counts
+        bounds = Histogram.BOUNDS
+        bisect_left = bisect.bisect_left
+        clock = time.perf_counter_ns
+        def timed(*args):
+            start = clock()
+            result = function(*args)
+            duration = clock() - start
+            counts[bisect_left(bounds, duration)] += 1
+            histogram.sum += duration
+            return result
+        return timed
+
+    def render(self):
+        # Return all metrics in the Prometheus text exposition format.
+        lines = ["# TYPE cubiebot_values_total counter"]
+        for message_type in MessageTypes:
+            lines.append(f'cubiebot_values_total{{type="{message_type.name}"}} {self.values[message_type.value]}')
+
+        lines.append("# TYPE cubiebot_outputs_total counter")
+        outputs = {**self.outputs, MessageSource.NUMBERS: self.values[NUMBERS], MessageSource.VOTES: self.values[TEXT]}
+        for source, count in sorted(outputs.items(), key=lambda item: item[0].name):
+            lines.append(f'cubiebot_outputs_total{{source="{source.name}"}} {count}')
+
+        lines.append(f"# HELP cubiebot_handler_seconds Handler latency. message_handler, check_message and classify are sampled 1 in {self.sample} messages.")
+        lines.append("# TYPE cubiebot_handler_seconds histogram")
+        for name, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(Histogram.BOUNDS + ["+Inf"], histogram.counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else f"{bound / 1e9:g}"
+                lines.append(f'cubiebot_handler_seconds_bucket{{handler="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'cubiebot_handler_seconds_sum{{handler="{name}"}} {histogram.sum / 1e9}')
+            lines.append(f'cubiebot_handler_seconds_count{{handler="{name}"}} {cumulative}')
+
+        lines.append("# TYPE cubiebot_collection_size gauge")
+        lines.append("# TYPE cubiebot_collection_expired_total counter")
+        lines.append("# TYPE cubiebot_collection_evicted_total counter")
+        for channel in list(self.bot.channels.values()):
+            for message_type in MessageTypes:
+                labels = f'channel="{channel.name}",type="{message_type.name}"'
+                lines.append(f"cubiebot_collection_size{{{labels}}} {channel.collection.length(message_type)}")
+                lines.append(f"cubiebot_collection_expired_total{{{labels}}} {channel.collection.expired[message_type.value]}")
+                lines.append(f"cubiebot_collection_evicted_total{{{labels}}} {channel.collection.evicted[message_type.value]}")
+
+        ingestion = self.bot.ingestion
+        if ingestion is not None:
+            lines.append("# TYPE cubiebot_ingestion_queue_depth gauge")
+            lines.append(f"cubiebot_ingestion_queue_depth {ingestion.depth}")
+            lines.append("# TYPE cubiebot_ingestion_dropped_total counter")
+            lines.append(f"cubiebot_ingestion_dropped_total {ingestion.dropped}")
+
+        outbox = self.bot.view.outbox
+        if outbox is not None:
+            limiter = outbox.limiter
+            lines.append("# TYPE cubiebot_outbound_total counter")
+            lines.append(f'cubiebot_outbound_total{{result="sent"}} {limiter.sent}')
+            lines.append(f'cubiebot_outbound_total{{result="coalesced"}} {limiter.coalesced}')
+            lines.append(f'cubiebot_outbound_total{{result="dropped"}} {limiter.dropped}')
+        return "\n".join(lines) + "\n"
+
+    def start(self, port=0, interval=0):
+        # Serve the metrics on http://127.0.0.1:<port>/metrics, and/or log them every `interval` seconds.
+        if port:
+            # Only imported when serving, as http.server is relatively slow to import
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            metrics = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode("UTF-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = HTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=self._server.serve_forever, name="Metrics", daemon=True).start()
+            logger.info(f"Serving metrics on http://127.0.0.1:{self._server.server_port}/metrics")
+
+        if interval:
+            def dump():
+                while True:
+                    time.sleep(interval)
+                    logger.info("Metrics:\n" + self.render())
+            threading.Thread(target=dump, name="MetricsDump", daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
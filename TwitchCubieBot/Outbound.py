@@ -0,0 +1,117 @@
+from collections import deque
+import logging, threading, time
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    # Allows `amount` messages per `seconds` seconds, with bursts of up to `amount` messages.
+    def __init__(self, amount, seconds):
+        self.rate = amount / seconds
+        self.capacity = amount
+        self.tokens = amount
+        self.last = time.monotonic()
+
+    def wait_time(self, now):
+        # Returns the amount of seconds until a message may be sent, which is 0 if it may be sent now.
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundLimiter:
+    """ Pending outbound chat messages, limited both globally and per channel """
+
+    def __init__(self, global_limit=(20, 30), channel_limit=(1, 1), max_pending=100):
+        # Limits are (amount, seconds) pairs, e.g. 20 messages per 30 seconds,
+        # as that is what Twitch allows for accounts that are not moderator.
+        self.global_bucket = TokenBucket(*global_limit)
+        self.channel_limit = channel_limit
+        self.channel_buckets = {}
+        self.max_pending = max_pending
+
+        # (message, channel) tuples in the order they should be sent
+        self.pending = deque()
+
+        # Counters
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, message, channel):
+        # Queue a message, unless the exact same message is already waiting to be sent to this channel,
+        # e.g. when multiple people use !vote at once, and "No votes found." would be sent repeatedly.
+        # Returns whether the message was queued.
+        if (message, channel) in self.pending:
+            self.coalesced += 1
+            return False
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+            logger.warning(f"Too many outbound messages are waiting, dropped {self.dropped} so far.")
+        self.pending.append((message, channel))
+        return True
+
+    def pop(self, now=None):
+        # Returns a ((message, channel), 0) tuple with a message that may be sent now,
+        # or (None, seconds) with the amount of seconds to wait before trying again.
+        now = time.monotonic() if now is None else now
+        if not self.pending:
+            return None, None
+
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        # Find the oldest message of a channel which has not reached its limit
+        for i, (message, channel) in enumerate(self.pending):
+            bucket = self.channel_buckets.get(channel)
+            if bucket is None:
+                bucket = self.channel_buckets[channel] = TokenBucket(*self.channel_limit)
+            channel_wait = bucket.wait_time(now)
+            if channel_wait == 0:
+                del self.pending[i]
+                bucket.take()
+                self.global_bucket.take()
+                self.sent += 1
+                return (message, channel), 0
+            wait = channel_wait if wait == 0 else min(wait, channel_wait)
+        return None, wait
+
+class Outbox(threading.Thread):
+    """ Thread sending the messages from an OutboundLimiter using `send(message, channel)` """
+
+    def __init__(self, send, limiter):
+        threading.Thread.__init__(self)
+        self.name = "Outbox"
+        self.daemon = True
+        self.send = send
+        self.limiter = limiter
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def put(self, message, channel):
+        with self._condition:
+            if self.limiter.put(message, channel):
+                self._condition.notify()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self._condition:
+                item, wait = self.limiter.pop()
+                if item is None:
+                    # Wait until either a new message is queued, or a limit allows sending
+                    self._condition.wait(wait)
+                    continue
+            try:
+                self.send(*item)
+            except Exception as e:
+                logger.error(f"Failed to send message: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
@@ -0,0 +1,171 @@
+import re
+
+# Minimal parsing of raw Twitch IRC lines, for when only PRIVMSG lines are of interest
+# and parsing every line into a TwitchWebsocket Message would cost too much.
+
+# A PRIVMSG line with the emotes and tmi-sent-ts tags, which Twitch sends in alphabetical order, up to the message
+PRIVMSG_PATTERN = re.compile(r"@(?:[^ ]*;)?emotes=([^; ]*)[^ ]*?;tmi-sent-ts=(\d+)[^ ]* :([^!@ ]+)![^ ]* PRIVMSG #([^ ]+) :")
+
+def parse_line(line):
+    # Returns a (tags, user, channel, message) tuple for a PRIVMSG line, or None for any other line.
+    # Tags are returned as a string starting with "@", to be used with `get_tag`.
+    if line.startswith("@"):
+        start = line.find(" :") + 2
+        tags = line[:start - 2]
+    else:
+        start = 1
+        tags = ""
+    end = line.find(" :", start)
+    # In the form of "user!user@user.tmi.twitch.tv PRIVMSG #channel"
+    user, _, command = line[start:end].partition("!")
+    _, _, command = command.partition(" ")
+    if not command.startswith("PRIVMSG #") or end < 0:
+        return None
+    message = line[end + 2:]
+    # Like TwitchWebsocket, "/me message" arrives as "\x01ACTION message\x01"
+    if message.startswith("\x01ACTION"):
+        message = "/me" + message[7:-1]
+    return tags, user, command[9:], message
+
+def parse_fields(line):
+    # Returns a (user, channel, message, emotes, sent) tuple for a PRIVMSG line, or None for any other line,
+    # where emotes and sent are the values of the emotes and tmi-sent-ts tags, or "" if missing.
+    # Faster than `parse_line` with `get_tag`, for the lines which match PRIVMSG_PATTERN.
+    match = PRIVMSG_PATTERN.match(line)
+    if match is None:
+        parsed = parse_line(line)
+        if parsed is None:
+            return None
+        tags, user, channel, message = parsed
+        return user, channel, message, get_tag(tags, "emotes"), get_tag(tags, "tmi-sent-ts")
+    emotes, sent, user, channel = match.groups()
+    message = line[match.end():]
+    if message.startswith("\x01ACTION"):
+        message = "/me" + message[7:-1]
+    return user, channel, message, emotes, sent
+
+def get_tag(tags, key):
+    # Returns the value of `key` in a tags string like "@badges=;emotes=25:0-4;tmi-sent-ts=1550060037421"
+    start = tags.find(";" + key + "=")
+    if start < 0:
+        if not tags.startswith("@" + key + "="):
+            return ""
+        start = 0
+    start += len(key) + 2
+    end = tags.find(";", start)
+    return tags[start:] if end < 0 else tags[start:end]
+
+# Parsing of raw lines as bytes, straight from the socket. Only PRIVMSG lines become messages,
+# and their fields are only decoded once used, so e.g. lines of denied senders are never decoded.
+
+class LeanTags:
+    """ The tags of a LeanMessage, of which a value is only decoded once it is used """
+    __slots__ = ("raw", "end", "_values")
+
+    def __init__(self, raw, end):
+        # The tags are at the start of `raw`, up to `end`
+        self.raw = raw
+        self.end = end
+        self._values = {}
+
+    def get(self, key, default=""):
+        value = self._values.get(key)
+        if value is None:
+            start = self.raw.find(b";" + key.encode() + b"=", 0, self.end)
+            if start < 0:
+                if not self.raw.startswith(b"@" + key.encode() + b"="):
+                    return default
+                start = 0
+            start += len(key) + 2
+            end = self.raw.find(b";", start, self.end)
+            value = self._values[key] = self.raw[start:self.end if end < 0 else end].decode("UTF-8", "replace")
+        return value
+
+class LeanMessage:
+    """ PRIVMSG line as bytes, with the attributes of a TwitchWebsocket Message that CubieBot uses """
+    __slots__ = ("raw", "user", "_channel_start", "_body", "_channel", "_message", "_tags")
+    type = "PRIVMSG"
+
+    def __init__(self, raw, user, channel_start, body):
+        self.raw = raw
+        self.user = user
+        # Positions of the channel name and of the message within the line
+        self._channel_start = channel_start
+        self._body = body
+        self._channel = None
+        self._message = None
+        self._tags = None
+
+    @property
+    def channel(self):
+        if self._channel is None:
+            self._channel = self.raw[self._channel_start:self._body - 2].decode("UTF-8")
+        return self._channel
+
+    @property
+    def message(self):
+        if self._message is None:
+            message = self.raw[self._body:].decode("UTF-8", "replace")
+            # Like TwitchWebsocket, "/me message" arrives as "\x01ACTION message\x01"
+            if message.startswith("\x01ACTION"):
+                message = "/me" + message[7:-1]
+            self._message = message
+        return self._message
+
+    def startswith(self, prefix):
+        # Whether the message starts with the bytes `prefix`, without decoding it
+        return self.raw.startswith(prefix, self._body)
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = LeanTags(self.raw, self.raw.find(b" ") if self.raw.startswith(b"@") else 0)
+        return self._tags
+
+    @property
+    def full_message(self):
+        return self.raw.decode("UTF-8", "replace")
+
+def parse_raw(line, denied=frozenset(), start=0, end=None):
+    # Returns a LeanMessage for a PRIVMSG line as bytes, or None for any other line,
+    # and for lines of senders in `denied`. Only line[start:end] is parsed, so that `line` can be a receive buffer,
+    # which is then only copied for the returned LeanMessage.
+    if end is None:
+        end = len(line)
+    if line.startswith(b"@", start, end):
+        prefix = line.find(b" ", start, end) + 1
+        if not prefix:
+            return None
+    else:
+        prefix = start
+    space = line.find(b" ", prefix, end)
+    if space < 0 or not line.startswith(b"PRIVMSG #", space + 1, end):
+        return None
+    body = line.find(b" :", space + 10, end) + 2
+    if body < 2:
+        return None
+    # In the form of ":user!user@user.tmi.twitch.tv"
+    bang = line.find(b"!", prefix, space)
+    user = line[prefix + 1:space if bang < 0 else bang].decode("UTF-8", "replace")
+    if user in denied:
+        return None
+    raw = line[start:end] if type(line) is bytes else bytes(memoryview(line)[start:end])
+    return LeanMessage(raw, user, space + 10 - start, body - start)
+
+def raw_type(line, start=0, end=None):
+    # Returns the type of a line as bytes, e.g. b"PING" for "PING :tmi.twitch.tv", or b"001" for ":tmi.twitch.tv 001 ...".
+    # Like parse_raw, only line[start:end] is read.
+    if end is None:
+        end = len(line)
+    if line.startswith(b"@", start, end):
+        prefix = line.find(b" ", start, end) + 1
+        if not prefix:
+            return b""
+    else:
+        prefix = start
+    if line.startswith(b":", prefix, end):
+        prefix = line.find(b" ", prefix, end) + 1
+        if not prefix:
+            return b""
+    space = line.find(b" ", prefix, end)
+    return bytes(line[prefix:end if space < 0 else space])
@@ -0,0 +1,212 @@
+import gc, logging, marshal, os, threading, time
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Data import Collection, MessageTypes
+
+# Snapshots and journals are written with marshal, which is compact, fast, and handles
+# all values stored in a Collection. The format is tied to the Python version,
+# so a snapshot written by another Python version is ignored when loading.
+# Reading many small objects straight from a file is slow with marshal, so the snapshot is read as a whole,
+# and every batch of journal records is written as a single marshalled bytes object.
+
+class Persistence(threading.Thread):
+    """ Periodic snapshots of all collections of a CubieBot, plus an append-only journal of all changes since """
+
+    def __init__(self, bot, directory, interval=60, flush_interval=1):
+        threading.Thread.__init__(self)
+        self.name = "Persistence"
+        self.daemon = True
+        self.bot = bot
+        self.directory = directory
+        # Seconds between snapshots, and between writing the journal to disk
+        self.interval = interval
+        self.flush_interval = flush_interval
+
+        # Journal records that have not yet been written to disk, as
+        # (channel, type index, sender, value, timestamp) tuples. Appending to a list
+        # is thread safe, so the thread updating the collections never waits for the disk.
+        self._pending = []
+        self.generation = 0
+        self._journal = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot")
+
+    def journal_path(self, generation):
+        return os.path.join(self.directory, f"journal.{generation}")
+
+    def attach(self, channel):
+        # Journal all changes to the collection of this channel
+        pending = self._pending
+        name = channel.name
+        def journal(index, sender, value, timestamp):
+            pending.append((name, index, sender, value, timestamp))
+        channel.collection.journal = journal
+
+    def load(self):
+        # Restore the collections of all configured channels from the snapshot and journals,
+        # skipping values that are older than the LookbackTime of their channel, and journal them from then on.
+        # Returns the amount of restored values.
+        # Garbage collection is paused meanwhile, as the many objects created while restoring would trigger it
+        # over and over, while none of them are garbage.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load()
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot = {"generation": 0, "channels": {}, "emote_names": {}}
+        try:
+            with open(self.snapshot_path(), "rb") as f:
+                snapshot = marshal.loads(f.read())
+        except FileNotFoundError:
+            pass
+        except (EOFError, ValueError, TypeError) as e:
+            logger.error(f"Ignoring unreadable snapshot: {e}")
+
+        self.generation = snapshot["generation"]
+        self.bot.classifier.emote_names.update(snapshot["emote_names"])
+        # Values sent before the cutoff of their channel are skipped. Channels that are no longer joined,
+        # or which do not store their values in a Collection, are skipped entirely.
+        now = time.time()
+        cutoffs = {name: now - channel.lookback_time for name, channel in self.bot.channels.items() if isinstance(channel.collection, Collection)}
+        message_types = list(MessageTypes)
+
+        # The latest value and timestamp of every sender per channel and message type, in the order they were set,
+        # which is the order in which they expire. The collections are then restored from these in one pass.
+        latest = {name: [{} for _ in message_types] for name in cutoffs}
+        # The newest timestamp per channel, as the journal may overlap with the snapshot by a second
+        newest = dict.fromkeys(cutoffs, 0)
+
+        for name, entries in snapshot["channels"].items():
+            if name not in cutoffs:
+                continue
+            for senders, values in zip(latest[name], entries):
+                values.sort(key=lambda value: value[2])
+                for sender, value, timestamp in values:
+                    if timestamp >= cutoffs[name]:
+                        senders[sender] = (value, timestamp)
+                if values:
+                    newest[name] = max(newest[name], values[-1][2])
+
+        for generation in self._journal_generations(self.generation):
+            for name, index, sender, value, timestamp in self._read_journal(generation):
+                if name not in cutoffs:
+                    continue
+                senders = latest[name][index]
+                if sender is None:
+                    senders.clear()
+                elif timestamp >= cutoffs[name]:
+                    # Never go back in time, and move the sender to the end, as set does
+                    timestamp = newest[name] = max(timestamp, newest[name])
+                    senders.pop(sender, None)
+                    senders[sender] = (value, timestamp)
+
+        for name, types in latest.items():
+            collection = self.bot.channels[name].collection
+            for message_type, senders in zip(message_types, types):
+                if senders:
+                    collection.restore(message_type, [(sender, value, timestamp) for sender, (value, timestamp) in senders.items()])
+
+        # Only journal changes made after restoring
+        for channel in self.bot.channels.values():
+            self.attach(channel)
+
+        restored = sum(channel.collection.length(message_type) for channel in self.bot.channels.values() for message_type in MessageTypes)
+        logger.info(f"Restored {restored} values from {self.directory}")
+        return restored
+
+    def _journal_generations(self, oldest):
+        # Generations of all journals starting at `oldest`, in order
+        generations = []
+        for fname in os.listdir(self.directory):
+            prefix, _, generation = fname.partition(".")
+            if prefix == "journal" and generation.isdigit() and int(generation) >= oldest:
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def _read_journal(self, generation):
+        with open(self.journal_path(generation), "rb") as f:
+            while True:
+                try:
+                    records = marshal.load(f)
+                    # Journals written by older versions hold the lists of records directly
+                    if isinstance(records, bytes):
+                        records = marshal.loads(records)
+                except EOFError:
+                    return
+                except (ValueError, TypeError):
+                    # The last batch may have been cut off by a crash
+                    logger.warning(f"Ignoring the incomplete end of {self.journal_path(generation)}")
+                    return
+                yield from records
+
+    def run(self):
+        # Start with a fresh snapshot, so the journals that were just replayed can be removed
+        self.snapshot()
+        next_snapshot = time.monotonic() + self.interval
+        while not self._stop_event.wait(self.flush_interval):
+            if time.monotonic() >= next_snapshot:
+                self.snapshot()
+                next_snapshot = time.monotonic() + self.interval
+            else:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        # Append all pending records to the current journal as a single batch. Requires the lock.
+        if not self._pending:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path(self.generation), "ab")
+        # Remove the records in place, as the journal functions hold on to this list
+        records = self._pending[:]
+        del self._pending[:len(records)]
+        marshal.dump(marshal.dumps(records), self._journal)
+        self._journal.flush()
+
+    def snapshot(self):
+        # Write all collections to a new snapshot, and start a new journal for the changes after it.
+        with self._lock:
+            self._write_pending()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self.generation += 1
+            # Copying a dict is atomic, so this is consistent even while messages are handled.
+            # Changes made after writing the pending records and before copying end up in both the
+            # snapshot and the new journal, which is harmless as replaying them sets the same values again.
+            channels = {}
+            for name, channel in list(self.bot.channels.items()):
+                if not isinstance(channel.collection, Collection):
+                    continue
+                channels[name] = [[(message.sender, message.message, message.timestamp) for message in _dict.copy().values()]
+                                  for _dict in channel.collection._accessor]
+            snapshot = {"generation": self.generation, "channels": channels, "emote_names": dict(self.bot.classifier.emote_names)}
+
+            # Write to a temporary file first, so a crash never leaves a partial snapshot behind
+            path = self.snapshot_path()
+            with open(path + ".tmp", "wb") as f:
+                marshal.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+            # Older journals are fully contained in the snapshot
+            for generation in self._journal_generations(0):
+                if generation < self.generation:
+                    os.remove(self.journal_path(generation))
+
+    def stop(self):
+        # Write everything to disk, so restarting loses nothing
+        self._stop_event.set()
+        self.snapshot()
@@ -0,0 +1,136 @@
+import bisect, re
+
+from TwitchCubieBot.Classifier import LETTERS
+from TwitchCubieBot.Data import Collection, MessageTypes
+
+# A number range option like "1-10", or a named one like "low=1-10". Both bounds are included.
+RANGE_PATTERN = re.compile(r"(?:(\w+)=)?([+-]?\d+(?:\.\d+)?)-([+-]?\d+(?:\.\d+)?)")
+# A duration like "90s" or "5m", after which the poll no longer accepts votes
+DURATION_PATTERN = re.compile(r"(\d+)([sm])")
+
+class Poll:
+    """ A poll of letters or number ranges, with the vote of every sender since it was started """
+    __slots__ = ("name", "letters", "ranges", "expires", "collection")
+
+    def __init__(self, name, letters, ranges, expires=None, max_size=0):
+        self.name = name
+        # Letters that can be voted for, e.g. "ABC"
+        self.letters = letters
+        # (option, low, high) tuples. If option is None, the number itself is the vote.
+        self.ranges = ranges
+        # Time after which votes are no longer accepted, or None to accept votes until the poll is stopped
+        self.expires = expires
+        # Votes never expire within a poll. Letters and named ranges are voted on as text, other ranges as numbers.
+        self.collection = Collection(max_size)
+
+    @staticmethod
+    def parse(words, now, duration=0, max_size=0):
+        # Parse the words after "!vote start", like ["guess", "2m", "low=1-10", "high=11-20"].
+        # Raises a ValueError with the usage if the options are invalid.
+        name = None
+        letters = ""
+        ranges = []
+        for word in words:
+            match = RANGE_PATTERN.fullmatch(word)
+            if match:
+                option, low, high = match.group(1), float(match.group(2)), float(match.group(3))
+                ranges.append((option, min(low, high), max(low, high)))
+            elif len(word) == 1 and word.upper() in LETTERS:
+                if word.upper() not in letters:
+                    letters += word.upper()
+            elif DURATION_PATTERN.fullmatch(word):
+                amount, unit = DURATION_PATTERN.fullmatch(word).groups()
+                duration = int(amount) * (60 if unit == "m" else 1)
+            elif name is None and not letters and not ranges:
+                name = word.lower()
+            else:
+                raise ValueError(f"Unknown poll option {word}.")
+
+        unnamed = any(option is None for option, _, _ in ranges)
+        if not letters and not ranges:
+            raise ValueError("A poll needs options, like \"!vote start A B C\" or \"!vote start guess 1-100\".")
+        if unnamed and (letters or len(ranges) > 1):
+            raise ValueError("A poll with a number range can not have other options.")
+        return Poll(name, letters, ranges, now + duration if duration else None, max_size)
+
+    @property
+    def message_type(self):
+        # Type of the votes in the collection
+        return MessageTypes.NUMBERS if self.ranges and self.ranges[0][0] is None else MessageTypes.TEXT
+
+    def options(self):
+        # Options as they are shown in chat, e.g. ["A", "B"] or ["low (1-10)"]
+        return list(self.letters) + [f"{low:g}-{high:g}" if option is None else f"{option} ({low:g}-{high:g})" for option, low, high in self.ranges]
+
+    def is_open(self, now):
+        return self.expires is None or now < self.expires
+
+class Polls:
+    """ The polls of one channel, indexed so matching a message costs the same however many polls are open """
+
+    def __init__(self):
+        # Polls by name, in the order they were started
+        self.polls = {}
+        # Bitmask of the positions in `_open` of the polls accepting each letter
+        self._letters = {}
+        self._open = []
+        # Sorted bounds of all ranges of open polls, as (low, 0) and (high, 1), so bisecting (number, 0) gives
+        # the amount of bounds at or below the number. `_segments` has the (poll, option) tuples for each amount.
+        self._bounds = []
+        self._segments = [()]
+        # Earliest time at which an open poll expires, or None
+        self._next_expiry = None
+
+    def __len__(self):
+        return len(self.polls)
+
+    def start(self, poll, now):
+        # Replaces a poll with the same name
+        self.polls.pop(poll.name, None)
+        self.polls[poll.name] = poll
+        self._index(now)
+
+    def stop(self, name, now):
+        # Removes and returns the poll with the given name, or the most recently started one if name is None
+        if name is None:
+            name = next(reversed(list(self.polls)), None)
+        poll = self.polls.pop(name, None)
+        self._index(now)
+        return poll
+
+    def _index(self, now):
+        # Rebuild the indexes for the polls which are open at `now`. Only needed on start, stop and expiry.
+        self._open = [poll for poll in self.polls.values() if poll.is_open(now)]
+        self._letters = {}
+        bounds = set()
+        for bit, poll in enumerate(self._open):
+            for letter in poll.letters:
+                self._letters[letter] = self._letters.get(letter, 0) | 1 << bit
+            for _, low, high in poll.ranges:
+                bounds.update(((low, 0), (high, 1)))
+        self._bounds = sorted(bounds)
+        self._segments = [[] for _ in range(len(self._bounds) + 1)]
+        for poll in self._open:
+            for option, low, high in poll.ranges:
+                # Every number from low up to high bisects into one of these segments
+                for segment in range(bisect.bisect_right(self._bounds, (low, 0)), bisect.bisect_right(self._bounds, (high, 0)) + 1):
+                    self._segments[segment].append((poll, option))
+        self._segments = [tuple(segment) for segment in self._segments]
+        self._next_expiry = min((poll.expires for poll in self._open if poll.expires is not None), default=None)
+
+    def add(self, sender, number, letter, timestamp):
+        # Add the number and letter found in a message to all open polls accepting them
+        if self._next_expiry is not None and timestamp >= self._next_expiry:
+            self._index(timestamp)
+        if letter is not None:
+            mask = self._letters.get(letter, 0)
+            while mask:
+                bit = mask & -mask
+                self._open[bit.bit_length() - 1].collection.set(sender, letter, MessageTypes.TEXT, timestamp)
+                mask ^= bit
+        if number is not None and self._bounds:
+            for poll, option in self._segments[bisect.bisect_right(self._bounds, (number, 0))]:
+                if option is None:
+                    poll.collection.set(sender, number, MessageTypes.NUMBERS, timestamp)
+                else:
+                    poll.collection.set(sender, option, MessageTypes.TEXT, timestamp)
@@ -0,0 +1,88 @@
+from TwitchWebsocket import Message, TwitchWebsocket
+import logging
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Parser import parse_raw, raw_type
+
+class ChannelWebsocket(TwitchWebsocket):
+    """ TwitchWebsocket which can send to any joined channel, not just the channel it joins first """
+
+    def send_message(self, message, channel=None):
+        # Like TwitchWebsocket.send_message, but to `channel` if given, as a lowercase name without "#".
+        # `chan` is never changed for this, as the websocket thread rejoins it when reconnecting.
+        if self.live:
+            self._send(f"PRIVMSG #{channel} :" if channel else f"PRIVMSG {self.chan.lower()} :", message)
+        else:
+            print(message)
+
+class LeanWebsocket(ChannelWebsocket):
+    """ TwitchWebsocket which only parses the lines CubieBot handles, straight from a reusable buffer """
+
+    # Types of the other lines which are still passed on, as TwitchWebsocket Messages
+    TYPES = frozenset((b"001", b"366", b"NOTICE"))
+
+    def __init__(self, *args, denied=None, forward=None, buffer_size=65536, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = "LeanWebsocket"
+        # Function returning the current set of denied senders, whose lines are dropped before being decoded
+        self.denied = denied or frozenset
+        # Optional function which is first passed every LeanMessage, e.g. to pass it on to the Shards right away,
+        # and which returns whether it did so. Only the other messages are passed to `callback`.
+        self.forward = forward
+        # Lines are parsed within the buffer, and only copied when they become a LeanMessage.
+        # `_end` is the amount of bytes in the buffer, which are always part of an incomplete line between reads.
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+    def run(self):
+        # Like TwitchWebsocket.run, reconnecting on errors
+        self.connect()
+        while not self.stopped():
+            try:
+                self.read()
+            except OSError as error:
+                logger.error(f"[OSError: {error}] - Attempting to reconnect.")
+                self.connect()
+                self._end = 0
+
+    def read(self):
+        # Receive once into the buffer, and handle all complete lines within it
+        buffer, end = self._buffer, self._end
+        if end == len(buffer):
+            # A line longer than the buffer, which can only be resized once it is no longer viewed
+            self._view.release()
+            buffer.extend(bytes(len(buffer)))
+            self._view = memoryview(buffer)
+        view = self._view
+        received = self.conn.recv_into(view[end:])
+        if not received:
+            raise OSError("Connection closed")
+        end += received
+
+        start = 0
+        denied = self.denied()
+        while True:
+            newline = buffer.find(b"\r\n", start, end)
+            if newline < 0:
+                break
+            self.handle(buffer, start, newline, denied)
+            start = newline + 2
+        # Move the incomplete line to the start of the buffer
+        if start:
+            buffer[:end - start] = view[start:end].tobytes()
+        self._end = end - start
+
+    def handle(self, buffer, start, end, denied):
+        # Handle the line in buffer[start:end]
+        message = parse_raw(buffer, denied, start, end)
+        if message is not None:
+            if self.forward is None or not self.forward(message):
+                self.callback(message)
+            return
+        # Lines of denied senders and e.g. USERNOTICE lines are dropped without decoding
+        kind = raw_type(buffer, start, end)
+        if kind == b"PING":
+            self.send_pong()
+        elif kind in LeanWebsocket.TYPES:
+            self.callback(Message(buffer[start:end].decode("UTF-8", "replace")))
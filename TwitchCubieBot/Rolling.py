@@ -0,0 +1,182 @@
+from collections import deque
+import logging, threading, time
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Data import MessageTypes
+from TwitchCubieBot.Sketch import QuantileSketch
+
+NUMBERS = MessageTypes.NUMBERS.value
+
+class Bucket:
+    # Aggregates of all current values that were set within one second
+    __slots__ = ("timestamp", "tallies", "sketch")
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        # Amount of votes per value, for each message type
+        self.tallies = [{}, {}, {}]
+        self.sketch = QuantileSketch()
+
+class Rolling:
+    """ Per second aggregates of a Collection, to read live results over a recent window of time """
+
+    def __init__(self, max_window):
+        # Buckets are kept for `max_window` seconds, which is the LookbackTime of the channel
+        self.max_window = max_window
+        # Buckets in order of their timestamp, and by timestamp
+        self._buckets = deque()
+        self._by_timestamp = {}
+        # Functions called with the changes since the previous publish, with the window they are subscribed to
+        self._subscribers = []
+
+    def add(self, index, value, timestamp):
+        # Called by Collection when a sender sets a value at `timestamp`.
+        # Every sender only counts towards the bucket of their latest message.
+        bucket = self._by_timestamp.get(timestamp)
+        if bucket is None:
+            bucket = self._by_timestamp[timestamp] = Bucket(timestamp)
+            self._buckets.append(bucket)
+            self._expire(timestamp)
+        tally = bucket.tallies[index]
+        tally[value] = tally.get(value, 0) + 1
+        if index == NUMBERS:
+            bucket.sketch.add(value)
+
+    def remove(self, index, value, timestamp):
+        # Called by Collection when a value set at `timestamp` is overwritten, refreshed or evicted
+        bucket = self._by_timestamp.get(timestamp)
+        # The bucket may already have been dropped
+        if bucket is None:
+            return
+        tally = bucket.tallies[index]
+        count = tally[value] - 1
+        if count:
+            tally[value] = count
+        else:
+            del tally[value]
+        if index == NUMBERS:
+            bucket.sketch.remove(value)
+
+    def _expire(self, now):
+        # Drop buckets which are older than the largest window
+        buckets = self._buckets
+        while buckets and buckets[0].timestamp < now - self.max_window:
+            del self._by_timestamp[buckets.popleft().timestamp]
+
+    def clear(self, index):
+        # Called by Collection.clear
+        for bucket in list(self._buckets):
+            bucket.tallies[index] = {}
+            if index == NUMBERS:
+                bucket.sketch = QuantileSketch()
+
+    def _window(self, window):
+        # Buckets within the last `window` seconds, newest first.
+        # The deque is copied in one step, so this may be called while another thread updates the buckets.
+        cutoff = time.time() - min(window or self.max_window, self.max_window)
+        for bucket in reversed(list(self._buckets)):
+            if bucket.timestamp < cutoff:
+                return
+            yield bucket
+
+    def tally(self, message_type, window=None):
+        # Amount of votes per value of the given type within the window
+        index = message_type.value
+        total = {}
+        for bucket in self._window(window):
+            for value, count in bucket.tallies[index].copy().items():
+                total[value] = total.get(value, 0) + count
+        return total
+
+    def shares(self, message_type, window=None):
+        # Fraction of the votes per value of the given type within the window
+        tally = self.tally(message_type, window)
+        _sum = sum(tally.values())
+        return {value: count / _sum for value, count in tally.items()}
+
+    def vote(self, message_type, window=None):
+        # Winning values in the same format as Collection.vote, e.g. [(3, 0.4), (4, 0.4)]
+        shares = self.shares(message_type, window)
+        _max = max(shares.values(), default=0)
+        return sorted((value, share) for value, share in shares.items() if share == _max)
+
+    def sketch(self, window=None):
+        # Sketch of all numbers within the window
+        sketch = QuantileSketch()
+        for bucket in self._window(window):
+            sketch.merge(bucket.sketch)
+        return sketch
+
+    def average(self, method="median", window=None):
+        # Method is either "median", "mean" or a percentile like "p90". Other than the mean, these are
+        # approximated within 1%. The median of an even amount of numbers is the lower of the middle two.
+        sketch = self.sketch(window)
+        if method == "mean":
+            return sketch.mean()
+        if method.startswith("p"):
+            return sketch.quantile(float(method[1:]) / 100)
+        return sketch.quantile(0.5)
+
+    def subscribe(self, callback, window=None):
+        # Call `callback` with the changes in results on every publish.
+        # Changes are a dict like {"TEXT": {"A": 0.5, "B": 0.0}, "median": 4.0}, where a share of 0.0
+        # means the value no longer has any votes. Only changed values are included.
+        self._subscribers.append([callback, window, {}])
+
+    def unsubscribe(self, callback):
+        self._subscribers = [subscriber for subscriber in self._subscribers if subscriber[0] != callback]
+
+    def results(self, window=None):
+        # Current shares per message type, plus the median and mean of the numbers
+        results = {message_type.name: self.shares(message_type, window) for message_type in MessageTypes}
+        sketch = self.sketch(window)
+        results["median"] = sketch.quantile(0.5)
+        results["mean"] = sketch.mean()
+        return results
+
+    def publish(self):
+        # Push the changes since the previous publish to every subscriber.
+        # This can run on another thread than the one calling `add` and `remove`: buckets are only dropped by `add`,
+        # and the results only read copies of the deque of buckets and of each tally and sketch store.
+        # Every copy is consistent by itself, so at worst the results miss some values set meanwhile, until the next publish.
+        for subscriber in self._subscribers:
+            callback, window, previous = subscriber
+            results = self.results(window)
+            diff = {}
+            for key, value in results.items():
+                if isinstance(value, dict):
+                    old = previous.get(key, {})
+                    changed = {item: share for item, share in value.items() if old.get(item) != share}
+                    changed.update((item, 0.0) for item in old if item not in value)
+                    if changed:
+                        diff[key] = changed
+                elif previous.get(key) != value:
+                    diff[key] = value
+            subscriber[2] = results
+            if diff:
+                callback(diff)
+
+class Publisher(threading.Thread):
+    """ Thread publishing the live results of every channel of a CubieBot """
+
+    def __init__(self, bot, interval):
+        threading.Thread.__init__(self)
+        self.name = "Publisher"
+        self.daemon = True
+        self.bot = bot
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            for channel in list(self.bot.channels.values()):
+                rolling = channel.collection.rolling
+                if rolling is None:
+                    continue
+                try:
+                    rolling.publish()
+                except Exception as e:
+                    logger.error(f"Failed to publish live results of {channel}: {e}")
+
+    def stop(self):
+        self._stop_event.set()
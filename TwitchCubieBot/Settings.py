@@ -1,22 +1,58 @@
 
-import logging, json, os, sys
+import logging, json, os, sys, threading
 logger = logging.getLogger(__name__)
 
 class Settings:
     """ Loads data from settings.txt into the bot """
     
     PATH = os.path.join(sys.path[0], "settings.txt")
+
+    # Settings that may be missing from older settings.txt files, with their default values
+    DEFAULTS = {
+        "QueueSize": 10000,
+        "Backpressure": "drop_oldest",
+        "ChannelSettings": {},
+        "GlobalMessageLimit": [20, 30],
+        "ChannelMessageLimit": [1, 1],
+        "MetricsPort": 0,
+        "MetricsLogInterval": 0,
+        "PersistenceDirectory": "",
+        "SnapshotInterval": 60,
+        "LiveInterval": 0,
+        "SharedDatabase": "",
+        "SharedPartition": [0, 1],
+        "SettingsReloadInterval": 1,
+        "MaxValues": 100000,
+        "PollDuration": 0,
+        "Approximate": False,
+        "Shards": 0,
+        "LeanParser": False
+    }
     
+    # Settings as last loaded, with the modification time and size of the file at that moment
+    _cache = None
+
+    @staticmethod
+    def _stat():
+        stat = os.stat(Settings.PATH)
+        return stat.st_mtime_ns, stat.st_size
+
     def get_settings(self):
-        logger.debug("Loading settings.txt file...")
         try:
+            # The file is only read again if it changed since it was last loaded
+            stat = Settings._stat()
+            if Settings._cache is not None and Settings._cache[0] == stat:
+                return dict(Settings._cache[1])
+
+            logger.debug("Loading settings.txt file...")
             # Try to load the file using json.
             # And pass the data to the Bot class instance if this succeeds.
             with open(Settings.PATH, "r") as f:
                 settings = f.read()
-                settings_dict = json.loads(settings)
+                settings_dict = {**Settings.DEFAULTS, **json.loads(settings)}
+                Settings._cache = (stat, settings_dict)
                 logger.debug("Settings loaded into Bot.")
-                return [settings_dict[key] for key in settings_dict]
+                return dict(settings_dict)
 
         except ValueError:
             logger.error("Error in settings file.")
@@ -36,7 +72,27 @@ class Settings:
                                     "DeniedUsers": ["streamelements", "marbiebot", "moobot"],
                                     "AllowedRanks": ["broadcaster", "moderator"],
                                     "AllowedPeople": [],
-                                    "LookbackTime": 30
+                                    "LookbackTime": 30,
+                                    **Settings.DEFAULTS
                                 }
                 f.write(json.dumps(standard_dict, indent=4, separators=(',', ': ')))
                 raise ValueError("Please fix your settings.txt file that was just generated.")
+
+    def watch(self, callback, interval=1):
+        # Call `callback` with the new settings whenever settings.txt changes, checking every `interval` seconds.
+        # Returns an Event which stops watching once set.
+        stopped = threading.Event()
+        def poll():
+            previous = Settings._cache[0] if Settings._cache is not None else None
+            while not stopped.wait(interval):
+                try:
+                    stat = Settings._stat()
+                    if stat == previous:
+                        continue
+                    previous = stat
+                    callback(self.get_settings())
+                except Exception as e:
+                    # Keep the current settings until the file is fixed, and keep watching
+                    logger.error(f"Failed to reload settings: {e!r}")
+        threading.Thread(target=poll, name="SettingsWatcher", daemon=True).start()
+        return stopped
@@ -0,0 +1,287 @@
+import heapq, logging, multiprocessing, threading, time
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Classifier import Classifier
+from TwitchCubieBot.Data import Backend, Collection, MessageTypes, sorted_average
+from TwitchCubieBot.Parser import get_tag, parse_line
+
+# Parsing and storing values in multiple worker processes, so it is not limited by one core.
+# Lines are sharded by sender, so every sender's values are only ever overwritten within one worker,
+# and the results of the workers can be merged exactly: their tallies add up, and their sorted numbers merge.
+
+def work(connection):
+    # Run by every worker process: handle batches of lines, and answer requests about the collections
+    classifier = Classifier()
+    collections = {}
+    settings = {}
+
+    def get_collection(name):
+        collection = collections.get(name)
+        if collection is None:
+            collection = collections[name] = Collection(*settings.get(name, (0, None)))
+        return collection
+
+    while True:
+        request = connection.recv()
+        kind = request[0]
+        if kind == "lines":
+            _, timestamp, lines = request
+            for line in lines:
+                # Like in CubieBot.message_handler, a malformed line is logged and skipped
+                try:
+                    # Lines passed on straight from the LeanWebsocket are still bytes
+                    if type(line) is bytes:
+                        line = line.decode("UTF-8", "replace")
+                    parsed = parse_line(line)
+                    if parsed is None:
+                        continue
+                    tags, user, name, message = parsed
+                    number, letter, emote = classifier.classify(message, get_tag(tags, "emotes"))
+                    if number is None and letter is None and emote is None:
+                        continue
+                    collection = get_collection(name)
+                    if number is not None:
+                        collection.set(user, number, MessageTypes.NUMBERS, timestamp)
+                    if letter is not None:
+                        collection.set(user, letter, MessageTypes.TEXT, timestamp)
+                    if emote is not None:
+                        collection.set(user, emote, MessageTypes.EMOTES, timestamp)
+                except Exception as e:
+                    logger.error(f"Failed to handle {line!r}: {e!r}")
+            continue
+        if kind == "stop":
+            connection.close()
+            return
+
+        # Errors are sent back, to be raised in the process making the request
+        try:
+            name = request[1]
+            collection = get_collection(name)
+            if kind == "set":
+                _, _, sender, value, index, timestamp = request
+                response = collection.set(sender, value, MessageTypes(index), timestamp)
+            elif kind == "configure":
+                settings[name] = request[2:]
+                collection.max_size, collection.max_age = request[2:]
+                response = None
+            elif kind == "clean":
+                expired = list(collection.expired)
+                collection.clean(request[2])
+                response = [after - before for after, before in zip(collection.expired, expired)]
+            elif kind == "tally":
+                message_type = MessageTypes(request[2])
+                tally = collection.tally(message_type)
+                # Emotes are stored by id, while their names are needed for the output
+                names = {key: classifier.emote_name(key) for key in tally} if message_type == MessageTypes.EMOTES else {}
+                response = (tally, names)
+            elif kind == "numbers":
+                response = collection.sorted_numbers()
+            elif kind == "length":
+                response = collection.length(MessageTypes(request[2]))
+            elif kind == "clear":
+                response = collection.clear(MessageTypes(request[2]))
+        except Exception as e:
+            response = e
+        connection.send(response)
+
+class Shards:
+    """ Worker processes which each parse and store the messages of the senders hashing to them """
+
+    def __init__(self, n_workers, emote_names=None, batch_size=512, timeout=10):
+        # Lines are sent to a worker in batches of `batch_size` lines, or whenever the second changes.
+        self.batch_size = batch_size
+        # Seconds to wait for the response of a worker, before it is considered hung and restarted
+        self.timeout = timeout
+        # Workers are never forked from this process, as they may be started while other threads run,
+        # and a child inheriting e.g. a held logging lock deadlocks once it logs.
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        # Emote names found by the workers are added to `emote_names`, e.g. of the Classifier of the bot
+        self.emote_names = {} if emote_names is None else emote_names
+        self._connections = [None] * n_workers
+        self._processes = [None] * n_workers
+        # Limits of each channel, sent again to a worker which is restarted
+        self._settings = {}
+        for index in range(n_workers):
+            self._start(index)
+        # Lines waiting to be sent to each worker, all received within the second of `_timestamp`
+        self._pending = [[] for _ in range(n_workers)]
+        self._timestamp = 0
+        # Connections are used by the thread handling messages, but also by e.g. Metrics
+        self._lock = threading.Lock()
+        logger.info(f"Started {n_workers} shards.")
+
+    def _start(self, index):
+        connection, child = self._context.Pipe()
+        process = self._context.Process(target=work, args=(child,), name=f"Shard{index}", daemon=True)
+        process.start()
+        child.close()
+        self._connections[index] = connection
+        self._processes[index] = process
+        for channel, limits in self._settings.items():
+            connection.send(("configure", channel) + limits)
+            connection.recv()
+
+    def _restart(self, index):
+        # Requires the lock. Replaces a worker which died or hung, whose values are lost.
+        process = self._processes[index]
+        process.join(1)
+        logger.error(f"Shard {index} stopped with exit code {process.exitcode}, "
+                     f"restarting it. The values of its senders are lost.")
+        self._connections[index].close()
+        self._start(index)
+
+    def _post(self, index, request):
+        # Requires the lock. A worker which died is noticed when it is next sent lines or a request.
+        if not self._processes[index].is_alive():
+            self._restart(index)
+        try:
+            self._connections[index].send(request)
+        except OSError:
+            self._restart(index)
+            self._connections[index].send(request)
+
+    def _receive(self, index, request):
+        # Requires the lock. Returns the response of a worker to `request`. A worker which died, or which did not
+        # respond within the timeout, is restarted and sent the request again once. Raises a TimeoutError after that.
+        for attempt in range(2):
+            connection = self._connections[index]
+            try:
+                if connection.poll(self.timeout):
+                    return connection.recv()
+                logger.error(f"Shard {index} did not respond to {request[0]!r} within {self.timeout} seconds.")
+                self._processes[index].kill()
+            except (OSError, EOFError):
+                pass
+            if attempt == 0:
+                self._restart(index)
+                self._connections[index].send(request)
+        raise TimeoutError(f"Shard {index} did not respond to {request[0]!r}.")
+
+    def put(self, sender, line):
+        # Send a raw PRIVMSG line, as str or UTF-8 bytes, to the worker of its sender
+        timestamp = round(time.time())
+        with self._lock:
+            if timestamp != self._timestamp:
+                # All values of a batch are stored with the same timestamp
+                self._flush()
+                self._timestamp = timestamp
+            index = hash(sender) % len(self._pending)
+            pending = self._pending[index]
+            pending.append(line)
+            if len(pending) >= self.batch_size:
+                self._send(index)
+
+    def _send(self, index):
+        # Requires the lock
+        self._post(index, ("lines", self._timestamp, self._pending[index]))
+        self._pending[index] = []
+
+    def _flush(self):
+        # Requires the lock
+        for index, pending in enumerate(self._pending):
+            if pending:
+                self._send(index)
+
+    def set(self, channel, sender, value, index, timestamp):
+        # Set a value directly, in the worker of its sender, after all pending lines
+        with self._lock:
+            self._flush()
+            worker = hash(sender) % len(self._connections)
+            self._post(worker, ("set", channel, sender, value, index, timestamp))
+            response = self._receive(worker, ("set", channel, sender, value, index, timestamp))
+        if isinstance(response, Exception):
+            raise response
+
+    def request(self, *request):
+        # Send a request to every worker, after all pending lines so they are included, and return their responses
+        with self._lock:
+            self._flush()
+            if request[0] == "configure":
+                self._settings[request[1]] = request[2:]
+            # All workers handle the request at the same time
+            for index in range(len(self._connections)):
+                self._post(index, request)
+            responses = []
+            for index in range(len(self._connections)):
+                try:
+                    responses.append(self._receive(index, request))
+                except TimeoutError as e:
+                    responses.append(e)
+        # Errors are only raised once every response is received, so none is left for the next request
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return responses
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            for connection in self._connections:
+                try:
+                    connection.send(("stop",))
+                except OSError:
+                    pass
+        for process in self._processes:
+            process.join()
+
+class ShardedCollection(Backend):
+    """ Backend merging the partial collections of one channel from all Shards """
+
+    def __init__(self, shards, channel):
+        self.shards = shards
+        self.channel = channel
+        self.expired = [0, 0, 0]
+        # Evictions happen within the workers
+        self.evicted = [0, 0, 0]
+        self._max_size = 0
+        self._max_age = None
+
+    # Limits are applied by every worker, so MaxValues applies per worker
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        self._max_size = max_size
+        self.shards.request("configure", self.channel, self._max_size, self._max_age)
+
+    @property
+    def max_age(self):
+        return self._max_age
+
+    @max_age.setter
+    def max_age(self, max_age):
+        self._max_age = max_age
+        self.shards.request("configure", self.channel, self._max_size, self._max_age)
+
+    def set(self, sender, message, message_type, timestamp=None):
+        # Values are mostly set by the workers from the lines passed to Shards.put, but can also be set directly
+        timestamp = round(time.time()) if timestamp is None else timestamp
+        self.shards.set(self.channel, sender, message, message_type.value, timestamp)
+
+    def clean(self, seconds):
+        for expired in self.shards.request("clean", self.channel, seconds):
+            for index, count in enumerate(expired):
+                self.expired[index] += count
+
+    def average(self, method="median"):
+        # The sorted numbers of the workers merge into all numbers in sorted order
+        return sorted_average(list(heapq.merge(*self.shards.request("numbers", self.channel))), method)
+
+    def vote(self, message_type):
+        tally = {}
+        for partial, names in self.shards.request("tally", self.channel, message_type.value):
+            for value, count in partial.items():
+                tally[value] = tally.get(value, 0) + count
+            self.shards.emote_names.update(names)
+        _max = max(tally.values(), default=0)
+        _sum = sum(tally.values())
+        return sorted((value, _max / _sum) for value, count in tally.items() if count == _max)
+
+    def length(self, message_type):
+        return sum(self.shards.request("length", self.channel, message_type.value))
+
+    def clear(self, message_type):
+        self.shards.request("clear", self.channel, message_type.value)
@@ -0,0 +1,161 @@
+import logging, math, sqlite3, threading, time
+logger = logging.getLogger(__name__)
+
+from TwitchCubieBot.Data import Backend, MessageTypes
+
+NUMBERS = MessageTypes.NUMBERS.value
+
+class SharedStore:
+    """ SQLite database in WAL mode, which multiple bot processes can use at the same time """
+
+    def __init__(self, path, batch_size=256, flush_interval=0.5):
+        # Writes are batched into one transaction per `batch_size` values or per `flush_interval` seconds,
+        # so other processes see new values after at most `flush_interval` seconds.
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            # The value column has no type, so numbers and text are stored and returned as they are
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS messages (
+                channel TEXT, type INTEGER, sender TEXT, value, timestamp INTEGER,
+                PRIMARY KEY (channel, type, sender)) WITHOUT ROWID""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (channel, type, timestamp)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS messages_value ON messages (channel, type, value)")
+            # Time of the last clear of each channel and type, so values set before it are not written afterwards
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS clears (
+                channel TEXT, type INTEGER, time REAL, PRIMARY KEY (channel, type)) WITHOUT ROWID""")
+
+        # Values that have not yet been written, by (channel, type index, sender), with the time they were set,
+        # so a sender setting multiple values within one batch results in one write.
+        self._pending = {}
+        self._next_flush = time.monotonic() + flush_interval
+        self._lock = threading.Lock()
+        # Pending values are also written when no more values are set, e.g. after a lull in chat
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="SharedStore", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write values to {self.path}: {e}")
+
+    def put(self, channel, index, sender, value, timestamp):
+        with self._lock:
+            self._pending[(channel, index, sender)] = (value, timestamp, time.time())
+            if len(self._pending) >= self.batch_size or time.monotonic() >= self._next_flush:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Write all pending values in one transaction, except those set before a clear of their
+        # channel and type, which may have been done by another process meanwhile. Requires the lock.
+        self._next_flush = time.monotonic() + self.flush_interval
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        with self.connection:
+            # Other processes can not clear in between reading the clears and writing the values
+            self.connection.execute("BEGIN IMMEDIATE")
+            clears = {(channel, index): cleared for channel, index, cleared in self.connection.execute("SELECT * FROM clears")}
+            rows = [(channel, index, sender, value, timestamp) for (channel, index, sender), (value, timestamp, set_time) in pending.items()
+                    if set_time >= clears.get((channel, index), 0)]
+            self.connection.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+
+    def query(self, query, parameters):
+        # Returns all rows of a query, after writing the pending values so they are included
+        with self._lock:
+            self._flush()
+            return self.connection.execute(query, parameters).fetchall()
+
+    def delete(self, query, parameters):
+        # Returns the amount of deleted rows
+        with self._lock:
+            self._flush()
+            with self.connection:
+                return self.connection.execute(query, parameters).rowcount
+
+    def clear(self, channel, index):
+        # Removes all values of a channel and type, including those other processes have yet to write
+        with self._lock:
+            self._flush()
+            with self.connection:
+                self.connection.execute("DELETE FROM messages WHERE channel = ? AND type = ?", (channel, index))
+                self.connection.execute("INSERT OR REPLACE INTO clears VALUES (?, ?, ?)", (channel, index, time.time()))
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
+        self.connection.close()
+
+class SharedCollection(Backend):
+    """ Backend storing the values of one channel in a SharedStore """
+
+    def __init__(self, store, channel):
+        self.store = store
+        self.channel = channel
+        # Amount of values removed by clean in this process, for each message type
+        self.expired = [0, 0, 0]
+        # The database is not capped, so nothing is evicted
+        self.evicted = [0, 0, 0]
+
+    def set(self, sender, message, message_type, timestamp=None):
+        self.store.put(self.channel, message_type.value, sender, message, round(time.time()) if timestamp is None else timestamp)
+
+    def clean(self, seconds):
+        # Expired values are removed by the database, using the timestamp index
+        cutoff = time.time() - seconds
+        for message_type in MessageTypes:
+            self.expired[message_type.value] += self.store.delete("DELETE FROM messages WHERE channel = ? AND type = ? AND timestamp < ?",
+                                                                  (self.channel, message_type.value, cutoff))
+
+    def _numbers(self, offset, limit):
+        # Numbers in sorted order, starting at `offset`
+        rows = self.store.query("SELECT value FROM messages WHERE channel = ? AND type = ? ORDER BY value LIMIT ? OFFSET ?",
+                                (self.channel, NUMBERS, limit, offset))
+        return [value for value, in rows]
+
+    def average(self, method="median"):
+        # Same methods as Collection.average, computed by the database
+        n = self.length(MessageTypes.NUMBERS)
+        if n == 0:
+            return 0
+
+        if method == "mean":
+            return self.store.query("SELECT AVG(value) FROM messages WHERE channel = ? AND type = ?", (self.channel, NUMBERS))[0][0]
+
+        if method == "trimmed":
+            k = n // 10
+            return math.fsum(self._numbers(k, n - 2 * k)) / (n - 2 * k)
+
+        if method.startswith("p"):
+            percentile = float(method[1:])
+            return self._numbers(max(math.ceil(percentile / 100 * n) - 1, 0), 1)[0]
+
+        # Median, taking the mean of the two middle values for even lengths
+        middle = self._numbers((n - 1) // 2, 2 - n % 2)
+        if n % 2 == 1:
+            return middle[0]
+        return (middle[0] + middle[1]) / 2
+
+    def vote(self, message_type):
+        tally = self.store.query("SELECT value, COUNT(*) FROM messages WHERE channel = ? AND type = ? GROUP BY value",
+                                 (self.channel, message_type.value))
+        _max = max((count for value, count in tally), default=0)
+        _sum = sum(count for value, count in tally)
+        return sorted((value, _max / _sum) for value, count in tally if count == _max)
+
+    def length(self, message_type):
+        return self.store.query("SELECT COUNT(*) FROM messages WHERE channel = ? AND type = ?", (self.channel, message_type.value))[0][0]
+
+    def clear(self, message_type):
+        self.store.clear(self.channel, message_type.value)
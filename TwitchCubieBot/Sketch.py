@@ -0,0 +1,218 @@
+import math
+
+class QuantileSketch:
+    """ Mergeable quantile sketch with a fixed relative accuracy, using logarithmically sized buckets """
+
+    def __init__(self, accuracy=0.01):
+        # Every quantile is within `accuracy` times the true value, e.g. within 1% for 0.01.
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Counts per bucket key, for positive and negative values separately
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        # Exact sum, so the mean is not approximated
+        self.sum = 0
+
+    def _key(self, value):
+        # Bucket k holds the values in (gamma^(k-1), gamma^k]
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key):
+        # Value in the middle of bucket k, which has the lowest relative error for all values in the bucket
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        # Adds `value` `count` times. A negative count removes previously added values.
+        # Infinity and NaN have no bucket, and are rejected before anything changes.
+        if not math.isfinite(value):
+            raise ValueError(f"Values must be finite, not {value}.")
+        if value > 0:
+            store, key = self.positive, self._key(value)
+        elif value < 0:
+            store, key = self.negative, self._key(-value)
+        else:
+            self.zero += count
+            self.count += count
+            self.sum += value * count
+            return
+        total = store.get(key, 0) + count
+        if total:
+            store[key] = total
+        else:
+            del store[key]
+        self.count += count
+        self.sum += value * count
+
+    def remove(self, value):
+        self.add(value, -1)
+
+    def merge(self, other):
+        # Adds all values of another sketch with the same accuracy to this one.
+        # The other sketch is copied first, so it may be updated by another thread meanwhile.
+        # The count is taken from the copies rather than from `other.count`, so it always matches the buckets,
+        # while the sum may include or miss a value that was being added or removed meanwhile.
+        zero = other.zero
+        count = zero
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, key_count in other_store.copy().items():
+                store[key] = store.get(key, 0) + key_count
+                count += key_count
+        self.zero += zero
+        self.count += count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        # Nearest-rank quantile for q between 0 and 1, like Collection.average("pXX")
+        if self.count == 0:
+            return 0
+        rank = max(math.ceil(q * self.count) - 1, 0)
+        # Walk the buckets from the lowest to the highest value
+        for key in sorted(self.negative, reverse=True):
+            rank -= self.negative[key]
+            if rank < 0:
+                return -self._value(key)
+        rank -= self.zero
+        if rank < 0:
+            return 0
+        for key in sorted(self.positive):
+            rank -= self.positive[key]
+            if rank < 0:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def trimmed_mean(self, proportion=0.1):
+        # Mean with the lowest and highest `proportion` of values removed, like Collection.average("trimmed")
+        k = int(self.count * proportion)
+        n = self.count - 2 * k
+        if n <= 0:
+            return 0
+        total = 0
+        rank = 0
+        # Walk the buckets from the lowest to the highest value, only adding ranks k up to k + n
+        buckets = [(-self._value(key), self.negative[key]) for key in sorted(self.negative, reverse=True)]
+        buckets.append((0, self.zero))
+        buckets += [(self._value(key), self.positive[key]) for key in sorted(self.positive)]
+        for value, count in buckets:
+            used = min(rank + count, k + n) - max(rank, k)
+            if used > 0:
+                total += value * used
+            rank += count
+        return total / n
+
+    def __len__(self):
+        return self.count
+
+class SpaceSaving:
+    """ Approximate counts of the most frequent values, using at most `capacity` counters """
+
+    def __init__(self, capacity=64):
+        # Every value occurring more than total / capacity times is kept, and every count
+        # is overestimated by at most total / capacity.
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+
+    def add(self, value, count=1):
+        self.total += count
+        counts = self.counts
+        if value in counts or len(counts) < self.capacity:
+            counts[value] = counts.get(value, 0) + count
+            return
+        # Replace the least frequent value, which inherits its count as possible overestimation
+        least = min(counts, key=counts.get)
+        counts[value] = counts.pop(least) + count
+
+    def merge(self, other):
+        # Counts of both, keeping the `capacity` highest
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.total += other.total
+        if len(self.counts) > self.capacity:
+            self.counts = dict(sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:self.capacity])
+
+class BloomFilter:
+    """ Set membership with false positives at the given rate, but never false negatives, in fixed memory """
+
+    def __init__(self, capacity=100_000, false_positive_rate=0.01):
+        # Optimal amount of bits and hashes for `capacity` items
+        self.bits = max(int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.bits / capacity * math.log(2)), 1)
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def positions(self, item):
+        # Bits of the item, using double hashing with both halves of the (cached) hash of the item.
+        # Filters with the same capacity and rate use the same positions, so they only need to be computed once.
+        h = hash(item) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, h >> 32 | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, positions):
+        # Adds the item with the given positions, and returns whether it may have been added before
+        array = self._array
+        seen = True
+        for position in positions:
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not array[byte] & bit:
+                seen = False
+                array[byte] |= bit
+        return seen
+
+    def has(self, positions):
+        array = self._array
+        for position in positions:
+            if not array[position >> 3] & 1 << (position & 7):
+                return False
+        return True
+
+    def __contains__(self, item):
+        return self.has(self.positions(item))
+
+class ScalableBloomFilter:
+    """ Bloom filter which adds larger filters once it is full, so the false positive rate stays below the given rate """
+
+    def __init__(self, capacity=100_000, false_positive_rate=0.01, max_filters=4):
+        # Every next filter holds twice the items at half the rate, so the rates add up to at most `false_positive_rate`.
+        # At most `max_filters` filters are kept, holding (2^max_filters - 1) * capacity items at that rate.
+        # Beyond that, items are added to the last filter regardless, so its false positive rate rises instead of the memory.
+        self.max_filters = max_filters
+        self.filters = [BloomFilter(capacity, false_positive_rate / 2)]
+        self._capacity = capacity
+        self._rate = false_positive_rate / 2
+        # Items in the last filter
+        self._count = 0
+
+    @staticmethod
+    def _positions(bloom, item, cache):
+        # Filters of the same size use the same positions, so with a shared `cache` dict they are only computed once
+        if cache is None:
+            return bloom.positions(item)
+        key = (bloom.bits, bloom.hashes)
+        positions = cache.get(key)
+        if positions is None:
+            positions = cache[key] = bloom.positions(item)
+        return positions
+
+    def has(self, item, cache=None):
+        return any(bloom.has(self._positions(bloom, item, cache)) for bloom in self.filters)
+
+    def add(self, item, cache=None):
+        # Adds the item, and returns whether it may have been added before
+        if self.has(item, cache):
+            return True
+        self.filters[-1].add(self._positions(self.filters[-1], item, cache))
+        self._count += 1
+        if self._count >= self._capacity and len(self.filters) < self.max_filters:
+            self._capacity *= 2
+            self._rate /= 2
+            self.filters.append(BloomFilter(self._capacity, self._rate))
+            self._count = 0
+        return False
+
+    def __contains__(self, item):
+        return self.has(item)
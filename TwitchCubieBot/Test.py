@@ -1,5 +1,27 @@
 import unittest
+from unittest import mock
+import asyncio, bisect, json, marshal, os, random, signal, tempfile, threading, time
+from TwitchWebsocket import Message
+
 from TwitchCubieBot.CubieBot import CubieBot
+from TwitchCubieBot.AsyncCubieBot import AsyncCubieBot
+from TwitchCubieBot import Batch
+from TwitchCubieBot.Approximate import ApproximateCollection
+from TwitchCubieBot.Classifier import Classifier
+from TwitchCubieBot.Data import Backend, Collection, MessageTypes, SortedNumbers
+from TwitchCubieBot.Ingestion import Ingestion
+from TwitchCubieBot.Metrics import Metrics
+from TwitchCubieBot.Outbound import OutboundLimiter
+from TwitchCubieBot.Parser import get_tag, parse_line, parse_raw, raw_type
+from TwitchCubieBot.Persistence import Persistence
+from TwitchCubieBot.Poll import Poll, Polls
+from TwitchCubieBot.Receiver import ChannelWebsocket, LeanWebsocket
+from TwitchCubieBot.Rolling import Rolling
+from TwitchCubieBot.Settings import Settings
+from TwitchCubieBot.Shared import SharedCollection, SharedStore
+from TwitchCubieBot.Sharding import Shards
+from TwitchCubieBot.Sketch import BloomFilter, QuantileSketch, ScalableBloomFilter, SpaceSaving
+from TwitchCubieBot.TestHelpers import StubSocket, StubWebsocket, generate_chat, generate_log, make_bot, make_line
 
 class TestCheckForText(unittest.TestCase):
 
@@ -139,5 +161,1118 @@ class TestCheckForNumbers(unittest.TestCase):
         result = False
         self.assertEqual(result, self.bot.check_for_numbers(message, self.sender))
 
+    def test_overflow(self):
+        message = "1e999"
+        result = False
+        self.assertEqual(result, self.bot.check_for_numbers(message, self.sender))
+
+    def test_neg_overflow(self):
+        message = "-1e999"
+        result = False
+        self.assertEqual(result, self.bot.check_for_numbers(message, self.sender))
+
+    def test_overflow_then_number(self):
+        message = "1e999 or 7"
+        result = 7
+        self.assertEqual(result, self.bot.check_for_numbers(message, self.sender))
+
+class TestClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = Classifier()
+
+    def test_number_and_letter(self):
+        self.assertEqual((8.0, "A", None), self.classifier.classify("a 8/10"))
+
+    def test_emote(self):
+        message = "Kappa hello PogChamp PogChamp"
+        self.assertEqual((None, None, "88"), self.classifier.classify(message, "25:0-4/88:12-19,21-28"))
+        self.assertEqual("PogChamp", self.classifier.emote_name("88"))
+
+    def test_emote_name_reused(self):
+        self.classifier.find_emote("Kappa", "25:0-4")
+        self.classifier.find_emote("hi Kappa", "25:3-7")
+        self.assertEqual({"25": "Kappa"}, self.classifier.emote_names)
+
+    def test_nan(self):
+        self.assertEqual((None, None, None), self.classifier.classify("nan inf"))
+
+    def test_empty(self):
+        self.assertEqual((None, None, None), self.classifier.classify(" "))
+
+class TestBackend(unittest.TestCase):
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Backend()
+
+        class Partial(Backend):
+            def set(self, sender, message, message_type, timestamp=None):
+                pass
+
+        with self.assertRaises(TypeError):
+            Partial()
+        for backend in [Collection, ApproximateCollection]:
+            self.assertIsInstance(backend(), Backend)
+
+class TestCollectionVote(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Collection()
+
+    def test_single_winner(self):
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.set("b", "A", MessageTypes.TEXT)
+        self.collection.set("c", "B", MessageTypes.TEXT)
+        self.assertEqual([("A", 2 / 3)], self.collection.vote(MessageTypes.TEXT))
+
+    def test_tie(self):
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.set("b", "B", MessageTypes.TEXT)
+        self.assertEqual([("A", 0.5), ("B", 0.5)], self.collection.vote(MessageTypes.TEXT))
+
+    def test_overwrite(self):
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.set("b", "A", MessageTypes.TEXT)
+        self.collection.set("c", "B", MessageTypes.TEXT)
+        self.collection.set("a", "B", MessageTypes.TEXT)
+        self.collection.set("b", "C", MessageTypes.TEXT)
+        self.assertEqual([("B", 2 / 3)], self.collection.vote(MessageTypes.TEXT))
+
+    def test_clear(self):
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.clear(MessageTypes.TEXT)
+        self.collection.set("b", "B", MessageTypes.TEXT)
+        self.assertEqual([("B", 1.0)], self.collection.vote(MessageTypes.TEXT))
+
+class TestCollectionClean(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Collection()
+
+    def test_expired(self):
+        self.collection.set("a", "A", MessageTypes.TEXT, round(time.time()) - 60)
+        self.collection.set("b", "B", MessageTypes.TEXT)
+        self.collection.clean(30)
+        self.assertEqual(1, self.collection.length(MessageTypes.TEXT))
+        self.assertEqual([("B", 1.0)], self.collection.vote(MessageTypes.TEXT))
+
+    def test_overwritten_not_expired(self):
+        self.collection.set("a", "A", MessageTypes.TEXT, round(time.time()) - 60)
+        self.collection.set("a", "B", MessageTypes.TEXT)
+        self.collection.clean(30)
+        self.assertEqual([("B", 1.0)], self.collection.vote(MessageTypes.TEXT))
+
+    def test_repeated_refreshed(self):
+        self.collection.set("a", "A", MessageTypes.TEXT, round(time.time()) - 60)
+        message = self.collection.text["a"]
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.clean(30)
+        # The same Message is kept, with a newer timestamp
+        self.assertIs(message, self.collection.text["a"])
+        self.assertEqual([("A", 1.0)], self.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([0, 0, 0], self.collection.expired)
+
+    def test_max_size(self):
+        self.collection.max_size = 2
+        now = round(time.time())
+        self.collection.set("a", "A", MessageTypes.TEXT, now - 2)
+        self.collection.set("b", "B", MessageTypes.TEXT, now - 1)
+        # Repeating a value makes "a" the most recent sender, so "b" is evicted
+        self.collection.set("a", "A", MessageTypes.TEXT, now)
+        with self.assertLogs("TwitchCubieBot.Data", "WARNING"):
+            self.collection.set("c", "C", MessageTypes.TEXT, now)
+        self.assertEqual(["a", "c"], sorted(self.collection.text))
+        self.assertEqual([("A", 0.5), ("C", 0.5)], self.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([1, 0, 0], self.collection.evicted)
+
+    def test_max_age(self):
+        self.collection.max_age = 30
+        self.collection.set("a", "A", MessageTypes.TEXT, round(time.time()) - 60)
+        # Expired values are removed once a value is set in a later second, without a command
+        self.collection.set("b", "B", MessageTypes.TEXT)
+        self.assertEqual(["b"], list(self.collection.text))
+        self.assertEqual([1, 0, 0], self.collection.expired)
+
+class TestCollectionAverage(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Collection()
+
+    def add(self, *values):
+        for i, value in enumerate(values):
+            self.collection.set(str(i), value, MessageTypes.NUMBERS)
+
+    def test_median_odd(self):
+        self.add(5.0, 1.0, 3.0)
+        self.assertEqual(3, self.collection.average())
+
+    def test_median_even(self):
+        self.add(4.0, 1.0, 3.0, 2.0)
+        self.assertEqual(2.5, self.collection.average())
+
+    def test_median_overwrite(self):
+        self.add(1.0, 2.0, 3.0)
+        self.collection.set("0", 10.0, MessageTypes.NUMBERS)
+        self.assertEqual(3, self.collection.average())
+
+    def test_median_expired(self):
+        self.collection.set("0", 1.0, MessageTypes.NUMBERS, round(time.time()) - 60)
+        self.collection.set("1", 2.0, MessageTypes.NUMBERS)
+        self.collection.set("2", 3.0, MessageTypes.NUMBERS)
+        self.collection.clean(30)
+        self.assertEqual(2.5, self.collection.average())
+
+    def test_mean(self):
+        self.add(1.0, 2.0, 9.0)
+        self.assertEqual(4, self.collection.average("mean"))
+
+    def test_percentile(self):
+        self.add(*[float(i) for i in range(1, 11)])
+        self.assertEqual(9, self.collection.average("p90"))
+
+    def test_trimmed(self):
+        self.add(*[float(i) for i in range(1, 10)], 1000.0)
+        self.assertEqual(5.5, self.collection.average("trimmed"))
+
+    def test_sorted_numbers(self):
+        # Many sublists, with values inserted, overwritten and removed in random order
+        rng = random.Random(0)
+        with mock.patch.object(SortedNumbers, "LOAD", 4):
+            numbers = SortedNumbers([5.0, 1.0, 3.0])
+            expected = [1.0, 3.0, 5.0]
+            for _ in range(2000):
+                if expected and rng.random() < 0.4:
+                    value = rng.choice(expected)
+                    numbers.remove(value)
+                    expected.remove(value)
+                else:
+                    value = float(rng.randint(0, 50))
+                    numbers.add(value)
+                    bisect.insort(expected, value)
+            self.assertEqual(expected, list(numbers))
+            self.assertEqual(expected[::7], [numbers[i] for i in range(0, len(expected), 7)])
+            self.assertEqual(expected[3:-3], numbers[3:-3])
+            self.assertEqual(expected[-1], numbers[-1])
+            with self.assertRaises(ValueError):
+                numbers.remove(51.0)
+
+    def test_many_expired(self):
+        # Expiring most numbers at once rebuilds the sorted numbers rather than removing each
+        now = round(time.time())
+        for i in range(100):
+            self.collection.set(str(i), float(i), MessageTypes.NUMBERS, now - 60)
+        self.collection.set("new", 1000.0, MessageTypes.NUMBERS, now)
+        self.collection.set("newer", 2000.0, MessageTypes.NUMBERS, now)
+        self.collection.clean(30)
+        self.assertEqual([1000.0, 2000.0], self.collection.sorted_numbers())
+        self.assertEqual(1500, self.collection.average())
+
+class TestIngestion(unittest.TestCase):
+
+    def test_block(self):
+        handled = []
+        ingestion = Ingestion(handled.append, max_size=10, backpressure="block")
+        ingestion.start()
+        for i in range(1000):
+            ingestion.put(i)
+        self.assertTrue(ingestion.join_queue(timeout=5))
+        ingestion.stop()
+        self.assertEqual(list(range(1000)), handled)
+        self.assertEqual(0, ingestion.dropped)
+
+    def test_drop_oldest(self):
+        handled = []
+        # Not started, so nothing is handled and the queue fills up
+        ingestion = Ingestion(handled.append, max_size=10)
+        for i in range(25):
+            ingestion.put(i)
+        self.assertEqual(15, ingestion.dropped)
+        self.assertEqual(list(range(15, 25)), list(ingestion.queue))
+
+    def test_invalid_backpressure(self):
+        with self.assertRaises(ValueError):
+            Ingestion(print, backpressure="drop_newest")
+
+class TestChannels(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = CubieBot()
+        self.bot.update_settings()
+        self.bot.chan = "#first"
+        self.bot.update_channels(["#first", "#Second"], {"#second": {"AllowedPeople": ["cubie"]}})
+        self.bot.ws = StubWebsocket("#first")
+
+    def test_routing(self):
+        self.bot.message_handler(Message(make_line("viewer", "A", channel="first")))
+        self.bot.message_handler(Message(make_line("viewer", "B", channel="second")))
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="second")))
+        self.assertEqual(["PRIVMSG #second :/me B won with 100.00%."], self.bot.ws.sent)
+        self.assertEqual([("A", 1.0)], self.bot.channels["first"].collection.vote(MessageTypes.TEXT))
+
+    def test_emote_vote(self):
+        self.bot.message_handler(Message(make_line("a", "Kappa Kappa", "25:0-4,6-10", channel="first")))
+        self.bot.message_handler(Message(make_line("b", "hi Kappa", "25:3-7", channel="first")))
+        self.bot.message_handler(Message(make_line("c", "LUL", "425618:0-2", channel="first")))
+        self.bot.message_handler(Message(make_line("cubie", "!vote emotes", channel="second")))
+        self.bot.command_vote(Message(make_line("cubie", "!vote emotes", channel="first")))
+        self.assertEqual(["PRIVMSG #second :No votes found.", "PRIVMSG #first :/me Kappa won with 66.67%."], self.bot.ws.sent)
+
+    def test_permissions(self):
+        self.bot.message_handler(Message(make_line("viewer", "A", channel="first")))
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="first")))
+        self.assertEqual([], self.bot.ws.sent)
+
+    def test_badges(self):
+        self.bot.update_channels(["#first"], {"#first": {"AllowedRanks": ["Moderator"], "AllowedPeople": []}})
+        self.assertTrue(self.bot.check_permissions(Message(make_line("mod", "!vote", badges="subscriber/12,moderator/1", channel="first"))))
+        self.assertFalse(self.bot.check_permissions(Message(make_line("mod", "!vote", badges="moderator-emeritus/1", channel="first"))))
+
+    def test_cooldown(self):
+        for user, message in [("viewer", "A"), ("cubie", "!vote"), ("viewer", "B"), ("cubie", "!vote"), ("cubie", "!average")]:
+            self.bot.message_handler(Message(make_line(user, message, channel="second")))
+        # The second !vote is on cooldown, so it is a regular message, while !average has its own cooldown
+        self.assertEqual(["PRIVMSG #second :/me A won with 100.00%.",
+                          "PRIVMSG #second :No recent numbers found to take the average from."], self.bot.ws.sent)
+        self.bot.channels["second"].cooldowns["command_vote"] -= CubieBot.COMMAND_COOLDOWN
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="second")))
+        self.assertEqual("PRIVMSG #second :/me B won with 100.00%.", self.bot.ws.sent[-1])
+
+    def test_not_live(self):
+        # Results for any channel are printed rather than sent when the websocket is not live
+        self.bot.ws = ChannelWebsocket("irc.chat.twitch.tv", 6667, "#first", "cubiebot", "oauth:", print, live=False)
+        self.bot.message_handler(Message(make_line("viewer", "B", channel="second")))
+        with mock.patch("builtins.print") as printed:
+            self.bot.message_handler(Message(make_line("cubie", "!vote", channel="second")))
+        printed.assert_called_once_with("/me B won with 100.00%.")
+
+    def test_send_to_channel(self):
+        # The websocket thread rejoins `chan` when reconnecting, so it is never changed to send to another channel
+        ws = self.bot.ws = ChannelWebsocket("irc.chat.twitch.tv", 6667, "#First", "cubiebot", "oauth:", print, live=True)
+        ws.conn = StubSocket(b"")
+        # The channel joined when reconnecting during each send
+        sent = []
+        ws.conn.send = lambda data: sent.append((ws.chan, data)) or len(data)
+        self.bot.message_handler(Message(make_line("viewer", "B", channel="second")))
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="second")))
+        self.bot.view.send_now("hello")
+        self.assertEqual([("#First", b"PRIVMSG #second :/me B won with 100.00%.\r\n"),
+                          ("#First", b"PRIVMSG #first :hello\r\n")], sent)
+
+    def test_percentile_names(self):
+        names = [self.bot.check_average_type(f"!average p{percentile}")[1] for percentile in ["1", "2", "3", "4", "11", "12", "13", "21", "22", "23", "99.9", "100"]]
+        self.assertEqual(["1st", "2nd", "3rd", "4th", "11th", "12th", "13th", "21st", "22nd", "23rd", "99.9th", "100th"],
+                         [name.split()[0] for name in names])
+
+    def test_denied_users(self):
+        self.bot.message_handler(Message(make_line("moobot", "A", channel="first")))
+        self.bot.message_handler(Message(make_line("moobot", "!vote", badges="moderator/1", channel="first")))
+        self.assertEqual(0, self.bot.channels["first"].collection.length(MessageTypes.TEXT))
+        self.assertEqual([], self.bot.ws.sent)
+
+    def test_reload_settings(self):
+        self.bot.message_handler(Message(make_line("viewer", "A", channel="first")))
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="first")))
+        settings = Settings().get_settings()
+        settings.update({"AllowedPeople": ["cubie"], "LookbackTime": 60, "ChannelSettings": {}})
+        self.bot.reload_settings(settings)
+        # Applied before handling the next message, keeping the collections
+        self.bot.message_handler(Message(make_line("cubie", "!vote", channel="first")))
+        self.assertEqual(["PRIVMSG #first :/me A won with 100.00%."], self.bot.ws.sent)
+        self.assertEqual(60, self.bot.channels["second"].lookback_time)
+
+    def test_restart_settings(self):
+        # Settings which are only read when starting are not applied, but warned about
+        settings = Settings().get_settings()
+        settings.update({"Channel": ["#first", "#third"], "Shards": 2, "LookbackTime": 60})
+        with self.assertLogs(level="WARNING") as logs:
+            self.bot.reload_settings(settings)
+        self.assertEqual(["Changing Channel requires a restart.", "Changing Shards requires a restart."],
+                         [record.getMessage() for record in logs.records if record.levelname == "WARNING"])
+        self.bot.message_handler(Message(make_line("viewer", "A", channel="first")))
+        self.assertEqual(["first", "second"], list(self.bot.channels))
+        self.assertEqual(60, self.bot.channels["first"].lookback_time)
+
+    def test_invalid_settings(self):
+        settings = Settings().get_settings()
+        settings.update({"AllowedPeople": ["viewer"], "ChannelSettings": {"#second": {"LookbackTime": "60"}}})
+        with self.assertLogs(level="ERROR"):
+            self.bot.reload_settings(settings)
+            self.bot.message_handler(Message(make_line("viewer", "A", channel="first")))
+        # Nothing was applied, not even the settings before the invalid one
+        self.assertEqual(frozenset(["cubie"]), self.bot.channels["second"].allowed_people)
+        self.assertNotIn("viewer", self.bot.allowed_people)
+        self.assertEqual(1, self.bot.channels["first"].collection.length(MessageTypes.TEXT))
+        # Missing settings are rejected on reload
+        del settings["Nickname"]
+        with self.assertLogs(level="ERROR"):
+            self.bot.reload_settings(settings)
+        self.assertIsNone(self.bot._pending_settings)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        bot = CubieBot()
+        bot.update_settings()
+        bot.chan = "#first"
+        bot.update_channels(["#first"], {})
+        bot.ws = StubWebsocket("#first")
+        bot.metrics = Metrics(bot, sample=1)
+        bot.metrics.instrument()
+        bot.message_handler(Message(make_line("viewer", "A please 5", channel="first")))
+        bot.message_handler(Message(make_line("cubie", "!vote", badges="broadcaster/1", channel="first")))
+        text = bot.metrics.render()
+        self.assertIn('cubiebot_values_total{type="TEXT"} 1', text)
+        self.assertIn('cubiebot_values_total{type="NUMBERS"} 1', text)
+        self.assertIn('cubiebot_outputs_total{source="VOTING_RESULTS"} 1', text)
+        self.assertIn('cubiebot_handler_seconds_count{handler="message_handler"} 2', text)
+        self.assertIn('cubiebot_handler_seconds_count{handler="check_message"} 1', text)
+        self.assertIn('cubiebot_handler_seconds_count{handler="classify"} 1', text)
+        self.assertIn('cubiebot_handler_seconds_count{handler="command_vote"} 1', text)
+        self.assertIn('cubiebot_collection_size{channel="first",type="NUMBERS"} 1', text)
+
+class TestPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_bot(self):
+        bot = CubieBot()
+        bot.update_settings()
+        bot.chan = "#first"
+        bot.lookback_time = 30
+        bot.update_channels(["#first"], {})
+        bot.persistence = Persistence(bot, self.directory.name)
+        bot.persistence.load()
+        return bot
+
+    def test_restore(self):
+        bot = self.make_bot()
+        collection = bot.collection
+        collection.set("a", "A", MessageTypes.TEXT)
+        collection.set("b", 5.0, MessageTypes.NUMBERS)
+        bot.persistence.snapshot()
+        # Changes after the snapshot are restored from the journal
+        collection.set("a", "B", MessageTypes.TEXT)
+        collection.set("c", 7.0, MessageTypes.NUMBERS)
+        bot.persistence.flush()
+
+        restored = self.make_bot()
+        self.assertEqual([("B", 1.0)], restored.collection.vote(MessageTypes.TEXT))
+        self.assertEqual(6.0, restored.collection.average())
+
+    def test_skip_outdated(self):
+        bot = self.make_bot()
+        bot.collection.set("a", "A", MessageTypes.TEXT, round(time.time()) - 60)
+        bot.collection.set("b", "B", MessageTypes.TEXT)
+        bot.collection.set("c", 5.0, MessageTypes.NUMBERS)
+        bot.collection.clear(MessageTypes.NUMBERS)
+        bot.persistence.stop()
+
+        restored = self.make_bot()
+        self.assertEqual([("B", 1.0)], restored.collection.vote(MessageTypes.TEXT))
+        self.assertEqual(0, restored.collection.length(MessageTypes.NUMBERS))
+
+    def test_restore_order(self):
+        # Senders are restored in the order they last set a value, so the least recent one is evicted first
+        bot = self.make_bot()
+        bot.collection.set("a", "A", MessageTypes.TEXT)
+        bot.collection.set("b", "B", MessageTypes.TEXT)
+        bot.persistence.snapshot()
+        bot.collection.set("a", "C", MessageTypes.TEXT)
+        bot.persistence.flush()
+
+        restored = self.make_bot()
+        restored.collection.max_size = 2
+        restored.collection.set("c", "C", MessageTypes.TEXT)
+        self.assertEqual([("C", 1.0)], restored.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([0, 0, 0], restored.collection.expired)
+
+    def test_old_journal(self):
+        # Journals with the records as lists, rather than as marshalled bytes, are still read
+        with open(os.path.join(self.directory.name, "journal.0"), "wb") as f:
+            marshal.dump([("first", 1, "a", 5.0, round(time.time()))], f)
+        restored = self.make_bot()
+        self.assertEqual(5.0, restored.collection.average())
+
+class TestRolling(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Collection()
+        self.collection.rolling = Rolling(30)
+
+    def test_sketch_accuracy(self):
+        sketch = QuantileSketch()
+        for value in range(-500, 1001):
+            sketch.add(value)
+        sketch.remove(1000)
+        self.assertAlmostEqual(249, sketch.quantile(0.5), delta=2.49)
+        self.assertAlmostEqual(-486, sketch.quantile(0.01), delta=4.86)
+        self.assertEqual(249.5, sketch.mean())
+
+    def test_sketch_merge_during_add(self):
+        # Merging while another thread is within `add`, which updated a bucket but not yet the count
+        other = QuantileSketch()
+        for value in [-1, 0, 1, 2]:
+            other.add(value)
+        other.positive[other._key(3)] = 1
+        merged = QuantileSketch()
+        merged.merge(other)
+        self.assertEqual(5, len(merged))
+        self.assertAlmostEqual(3, merged.quantile(1), delta=0.03)
+
+    def test_matches_collection(self):
+        now = round(time.time())
+        self.collection.set("a", "A", MessageTypes.TEXT, now - 2)
+        self.collection.set("b", "B", MessageTypes.TEXT, now - 1)
+        self.collection.set("a", "B", MessageTypes.TEXT, now)
+        for sender, value in zip("abcde", [1.0, 2.0, 3.0, 4.0, 100.0]):
+            self.collection.set(sender, value, MessageTypes.NUMBERS, now)
+        rolling = self.collection.rolling
+        self.assertEqual({"B": 2}, rolling.tally(MessageTypes.TEXT))
+        self.assertEqual(self.collection.vote(MessageTypes.TEXT), rolling.vote(MessageTypes.TEXT))
+        self.assertAlmostEqual(3.0, rolling.average(), delta=0.03)
+        self.assertEqual(22.0, rolling.average("mean"))
+
+    def test_window(self):
+        now = round(time.time())
+        self.collection.set("a", "A", MessageTypes.TEXT, now - 10)
+        self.collection.set("b", "B", MessageTypes.TEXT, now)
+        self.assertEqual([("B", 1.0)], self.collection.rolling.vote(MessageTypes.TEXT, window=5))
+        self.assertEqual({"A": 0.5, "B": 0.5}, self.collection.rolling.shares(MessageTypes.TEXT))
+
+    def test_publish_diffs(self):
+        diffs = []
+        self.collection.rolling.subscribe(diffs.append)
+        self.collection.set("a", "A", MessageTypes.TEXT)
+        self.collection.rolling.publish()
+        self.collection.rolling.publish()
+        self.collection.set("a", "B", MessageTypes.TEXT)
+        self.collection.rolling.publish()
+        # The first publish includes all results
+        self.assertEqual([{"TEXT": {"A": 1.0}, "median": 0, "mean": 0}, {"TEXT": {"B": 1.0, "A": 0.0}}], diffs)
+
+    def test_rejected_values(self):
+        # A failing set leaves the collection and its aggregates as they were
+        self.collection.set("a", 4.0, MessageTypes.NUMBERS)
+        for value in [float("inf"), float("-inf"), float("nan")]:
+            with self.assertRaises(ValueError):
+                self.collection.set("a", value, MessageTypes.NUMBERS)
+        self.collection.rolling = mock.Mock(add=mock.Mock(side_effect=RuntimeError))
+        with self.assertRaises(RuntimeError):
+            self.collection.set("a", 5.0, MessageTypes.NUMBERS)
+        self.collection.rolling = None
+        self.assertEqual(4.0, self.collection.average())
+        self.collection.set("a", 6.0, MessageTypes.NUMBERS)
+        self.collection.set("b", 8.0, MessageTypes.NUMBERS)
+        self.assertEqual(7.0, self.collection.average())
+        self.assertEqual(2, self.collection.length(MessageTypes.NUMBERS))
+
+class TestPolls(unittest.TestCase):
+
+    def setUp(self):
+        self.polls = Polls()
+        self.now = round(time.time())
+
+    def start(self, *words, now=None):
+        poll = Poll.parse(list(words), now or self.now)
+        self.polls.start(poll, now or self.now)
+        return poll
+
+    def test_parse(self):
+        poll = Poll.parse(["price", "2m", "cheap=0-10", "pricey=11-100"], 0)
+        self.assertEqual(("price", "", 120), (poll.name, poll.letters, poll.expires))
+        self.assertEqual(["cheap (0-10)", "pricey (11-100)"], poll.options())
+        self.assertRaises(ValueError, Poll.parse, ["guess", "1-10", "A"], 0)
+        self.assertRaises(ValueError, Poll.parse, ["guess"], 0)
+
+    def test_letters(self):
+        abc = self.start("A", "B", "C")
+        bd = self.start("other", "B", "D")
+        for sender, letter in [("a", "A"), ("b", "B"), ("c", "D"), ("d", "E")]:
+            self.polls.add(sender, None, letter, self.now)
+        self.assertEqual([("A", 0.5), ("B", 0.5)], abc.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([("B", 0.5), ("D", 0.5)], bd.collection.vote(MessageTypes.TEXT))
+
+    def test_ranges(self):
+        price = self.start("price", "cheap=0-10", "pricey=10.5-100")
+        guess = self.start("guess", "5-50")
+        for sender, number in [("a", 3.0), ("b", 10.0), ("c", 20.0), ("d", 20.0), ("e", 200.0)]:
+            self.polls.add(sender, number, None, self.now)
+        self.assertEqual({"cheap": 2, "pricey": 2}, price.collection._tallies[MessageTypes.TEXT.value])
+        self.assertEqual([(20.0, 2 / 3)], guess.collection.vote(MessageTypes.NUMBERS))
+
+    def test_expiry(self):
+        short = self.start("short", "10s", "A", "B", now=self.now - 20)
+        self.start("long", "A", "B", now=self.now - 20)
+        self.polls.add("a", None, "A", self.now)
+        self.assertEqual(0, short.collection.length(MessageTypes.TEXT))
+        self.assertEqual(1, self.polls.polls["long"].collection.length(MessageTypes.TEXT))
+        # Expired polls can still be stopped
+        self.assertIs(short, self.polls.stop("short", self.now))
+
+    def test_commands(self):
+        bot = CubieBot()
+        bot.update_settings()
+        bot.update_channels(["#first"], {"#first": {"AllowedPeople": ["cubie"]}})
+        bot.ws = StubWebsocket("#first")
+        for user, message in [("cubie", "!vote start A B"), ("cubie", "!vote start guess 1-10"),
+                              ("a", "A"), ("b", "5"), ("c", "C"), ("cubie", "!vote stop guess")]:
+            # Skip the cooldown of !vote
+            bot.channels["first"].cooldowns.clear()
+            bot.message_handler(Message(make_line(user, message, channel="first")))
+        # The letters poll is still open, and the other votes are kept as well
+        bot.channels["first"].cooldowns.clear()
+        bot.message_handler(Message(make_line("cubie", "!vote stop", channel="first")))
+        self.assertEqual(["PRIVMSG #first :/me Started a poll, vote for A, B.",
+                          "PRIVMSG #first :/me Started guess, vote for 1-10.",
+                          "PRIVMSG #first :/me guess: 5.0 won with 100.00%.",
+                          "PRIVMSG #first :/me A won with 100.00%."], bot.ws.sent)
+        self.assertEqual(2, bot.channels["first"].collection.length(MessageTypes.TEXT))
+
+class TestApproximate(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = ApproximateCollection(max_age=30)
+        self.now = round(time.time())
+
+    def test_space_saving(self):
+        counter = SpaceSaving(capacity=4)
+        for value in "AAAAABBBCDEFG":
+            counter.add(value)
+        # The frequent values are kept, and overestimated by at most 13 / 4 votes
+        self.assertEqual(5, counter.counts["A"])
+        self.assertLessEqual(counter.counts["B"] - 3, 13 / 4)
+        self.assertEqual(4, len(counter.counts))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        self.assertFalse(bloom.add(bloom.positions("user0")))
+        self.assertTrue(bloom.add(bloom.positions("user0")))
+        for i in range(1000):
+            bloom.add(bloom.positions(f"user{i}"))
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(10_000)), 300)
+
+    def test_scalable_bloom_filter(self):
+        # Past its initial capacity, the filter grows rather than seeing ever more senders as voted already
+        bloom = ScalableBloomFilter(capacity=100, false_positive_rate=0.01, max_filters=8)
+        self.assertLess(sum(bloom.add(f"user{i}") for i in range(2000)), 40)
+        self.assertGreater(len(bloom.filters), 1)
+        self.assertTrue(all(f"user{i}" in bloom for i in range(2000)))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(10_000)), 150)
+
+    def test_max_filters(self):
+        # Beyond the capacity of `max_filters` filters, memory stays the same while false positives increase
+        bloom = ScalableBloomFilter(capacity=100, false_positive_rate=0.01, max_filters=2)
+        for i in range(300):
+            bloom.add(f"user{i}")
+        size = sum(len(part._array) for part in bloom.filters)
+        for i in range(300, 3000):
+            bloom.add(f"user{i}")
+        self.assertEqual(2, len(bloom.filters))
+        self.assertEqual(size, sum(len(part._array) for part in bloom.filters))
+        self.assertTrue(all(f"user{i}" in bloom for i in range(3000)))
+        self.assertGreater(sum(f"other{i}" in bloom for i in range(10_000)), 150)
+
+    def test_many_senders(self):
+        collection = ApproximateCollection(max_age=30, expected_senders=100, max_filters=8)
+        for i in range(5000):
+            collection.set(str(i), "A", MessageTypes.TEXT, self.now)
+        self.assertLess(collection.ignored[MessageTypes.TEXT.value], 100)
+
+    def test_overflow(self):
+        # Infinite numbers are rejected before anything is counted
+        self.collection.set("a", 1.0, MessageTypes.NUMBERS, self.now)
+        for number in (float("inf"), float("-inf"), float("nan")):
+            with self.assertRaises(ValueError):
+                self.collection.set("b", number, MessageTypes.NUMBERS, self.now)
+        self.assertEqual(1, self.collection.length(MessageTypes.NUMBERS))
+        self.assertEqual([(1.0, 1.0)], self.collection.vote(MessageTypes.NUMBERS))
+        # "b" did not vote yet
+        self.collection.set("b", 3.0, MessageTypes.NUMBERS, self.now)
+        self.assertEqual(2.0, self.collection.average("mean"))
+
+    def test_first_vote(self):
+        self.collection.set("a", "A", MessageTypes.TEXT, self.now)
+        self.collection.set("a", "B", MessageTypes.TEXT, self.now)
+        self.collection.set("b", "B", MessageTypes.TEXT, self.now)
+        self.collection.set("c", "A", MessageTypes.TEXT, self.now)
+        self.assertEqual([("A", 2 / 3)], self.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([1, 0, 0], self.collection.ignored)
+
+    def test_average(self):
+        for i in range(1, 1001):
+            self.collection.set(str(i), float(i), MessageTypes.NUMBERS, self.now)
+        self.assertAlmostEqual(500, self.collection.average(), delta=5)
+        self.assertAlmostEqual(900, self.collection.average("p90"), delta=9)
+        self.assertEqual(500.5, self.collection.average("mean"))
+        self.assertAlmostEqual(500.5, self.collection.average("trimmed"), delta=5)
+
+    def test_expiry(self):
+        self.collection.set("a", "A", MessageTypes.TEXT, self.now - 60)
+        self.collection.set("b", "B", MessageTypes.TEXT, self.now)
+        # The slice of "a" was dropped, so "a" can vote again
+        self.collection.set("a", "B", MessageTypes.TEXT, self.now)
+        self.assertEqual([("B", 1.0)], self.collection.vote(MessageTypes.TEXT))
+        self.assertEqual([1, 0, 0], self.collection.expired)
+        self.collection.clear(MessageTypes.TEXT)
+        self.assertEqual(0, self.collection.length(MessageTypes.TEXT))
+
+class TestSharding(unittest.TestCase):
+
+    def replay(self, bot, lines):
+        # Handle the lines with the time of each message as the monotonic time, so cooldowns do not depend on the speed
+        # Only within CubieBot, as multiprocessing relies on the monotonic time to wait for the workers
+        now = [0]
+        with mock.patch("TwitchCubieBot.CubieBot.time", wraps=time) as patched:
+            patched.monotonic.side_effect = lambda: now[0]
+            for line in lines:
+                now[0] = int(get_tag(parse_line(line)[0], "tmi-sent-ts")) / 1000
+                bot.message_handler(Message(line))
+        return bot.ws.sent
+
+    def test_matches_single_process(self):
+        lines = generate_log(10_000, 500, per_second=20)
+        bot = make_bot()
+        bot.shard_count = 3
+        try:
+            sharded = self.replay(bot, lines)
+            self.assertEqual(3, len(bot.shards.request("length", "benchmark", MessageTypes.TEXT.value)))
+        finally:
+            bot.shards.close()
+        self.assertEqual(self.replay(make_bot(), lines), sharded)
+        self.assertGreater(len(sharded), 5)
+
+    def test_forward(self):
+        # With Shards, lines are passed on to the workers straight from the LeanWebsocket, while commands are still handled
+        bot = make_bot()
+        bot.shard_count = 2
+        bot.get_channel()
+        handled = []
+        def callback(m):
+            handled.append(m.message)
+            bot.message_handler(m)
+        ws = LeanWebsocket(host="", port=0, chan="#benchmark", nick="", auth="", callback=callback,
+                           denied=lambda: bot.denied_users, forward=bot.forward_to_shards)
+        lines = [make_line(user, text) for user, text in [("a", "A"), ("b", "A"), ("c", "7"), ("moobot", "B")]]
+        ws.conn = StubSocket("".join(line + "\r\n" for line in lines + [make_line("cubie", "!vote", badges="moderator/1")]).encode("UTF-8"))
+        try:
+            with self.assertRaises(OSError):
+                while True:
+                    ws.read()
+            self.assertEqual(["!vote"], handled)
+            self.assertEqual(["PRIVMSG #benchmark :/me A won with 100.00%."], bot.ws.sent)
+            self.assertEqual(1, bot.collection.length(MessageTypes.NUMBERS))
+        finally:
+            bot.shards.close()
+
+    def test_me_action(self):
+        # "/me 7" counts as 7 with TwitchWebsocket Messages, LeanMessages and in the shards alike
+        line = make_line("cubie", "\x01ACTION 7\x01")
+        self.assertEqual("/me 7", Message(line).message)
+        self.assertEqual("/me 7", parse_raw(line.encode("UTF-8")).message)
+        self.assertEqual("/me 7", parse_line(line)[3])
+        bots = [make_bot(), make_bot(), make_bot()]
+        bots[2].shard_count = 1
+        try:
+            bots[0].message_handler(Message(line))
+            bots[1].message_handler(parse_raw(line.encode("UTF-8")))
+            bots[2].message_handler(Message(line))
+            self.assertEqual([7.0, 7.0, 7.0], [bot.get_channel().collection.average() for bot in bots])
+        finally:
+            bots[2].shards.close()
+
+    def test_set(self):
+        # Values can also be set directly, like the check_for_* methods do
+        bot = make_bot()
+        bot.shard_count = 2
+        try:
+            self.assertEqual(7, bot.check_for_numbers("7", "cubie"))
+            self.assertTrue(bot.check_for_text("A", "cubie"))
+            bot.check_for_emotes(Message(make_line("cubie", "Kappa", emotes="25:0-4")))
+            bot.check_for_text("B", "other")
+            self.assertEqual(7.0, bot.collection.average())
+            self.assertEqual([("A", 0.5), ("B", 0.5)], bot.collection.vote(MessageTypes.TEXT))
+            self.assertEqual([("25", 1.0)], bot.collection.vote(MessageTypes.EMOTES))
+        finally:
+            bot.shards.close()
+
+    def test_failures(self):
+        shards = Shards(2)
+        try:
+            shards.request("configure", "benchmark", 0, None)
+            with self.assertLogs("TwitchCubieBot.Sharding", "ERROR"):
+                # A malformed emotes tag is logged by the worker, which keeps handling lines
+                for i in range(10):
+                    shards.put(f"user{i}", make_line(f"user{i}", "Kappa", emotes="25:x-4"))
+                    shards.put(f"user{i}", make_line(f"user{i}", "A"))
+                self.assertEqual(10, sum(shards.request("length", "benchmark", MessageTypes.TEXT.value)))
+                # A worker which died is restarted with the same settings, only losing its own values
+                shards._processes[0].kill()
+                shards._processes[0].join()
+                lengths = shards.request("length", "benchmark", MessageTypes.TEXT.value)
+            self.assertEqual(0, lengths[0])
+            self.assertGreater(lengths[1], 0)
+            self.assertEqual([(0, None)], list(shards._settings.values()))
+            for i in range(10):
+                shards.put(f"user{i}", make_line(f"user{i}", "B"))
+            self.assertEqual(10, sum(shards.request("length", "benchmark", MessageTypes.TEXT.value)))
+        finally:
+            shards.close()
+
+    @unittest.skipUnless(hasattr(signal, "SIGSTOP"), "Requires SIGSTOP")
+    def test_hung_worker(self):
+        # A worker which does not respond is killed and restarted, rather than blocking the bot
+        shards = Shards(2, timeout=0.5)
+        try:
+            shards.put("a", make_line("a", "A"))
+            os.kill(shards._processes[0].pid, signal.SIGSTOP)
+            with self.assertLogs("TwitchCubieBot.Sharding", "ERROR"):
+                lengths = shards.request("length", "benchmark", MessageTypes.TEXT.value)
+            self.assertEqual(2, len(lengths))
+            self.assertTrue(shards._processes[0].is_alive())
+        finally:
+            shards.close()
+
+class TestLeanWebsocket(unittest.TestCase):
+
+    def receive(self, lines, size, buffer_size=65536):
+        # Receive the lines in pieces of `size` bytes, returning the messages passed on and the data sent back
+        messages = []
+        ws = LeanWebsocket(host="", port=0, chan="#benchmark", nick="", auth="", callback=messages.append,
+                           denied=lambda: frozenset(["moobot"]), buffer_size=buffer_size)
+        ws.conn = StubSocket("".join(line + "\r\n" for line in lines).encode("UTF-8"), size)
+        with self.assertRaises(OSError):
+            while True:
+                ws.read()
+        return messages, ws.conn.sent
+
+    def test_matches_message(self):
+        lines = generate_chat(500, 50) + [make_line("cubie", "\x01ACTION waves 👋\x01", badges="moderator/1")]
+        expected = [Message(line) for line in lines if not line.split(" ", 2)[1].startswith(":moobot!")]
+        # Pieces which split lines and characters, and a buffer too small for a line
+        for size, buffer_size in [(8192, 65536), (7, 65536), (4096, 64)]:
+            messages, _ = self.receive(lines, size, buffer_size)
+            self.assertEqual(len(expected), len(messages))
+            for lean, message in zip(messages, expected):
+                self.assertEqual((message.type, message.user, message.channel, message.message, message.full_message),
+                                 (lean.type, lean.user, lean.channel, lean.message, lean.full_message))
+                for key in ["badges", "emotes", "tmi-sent-ts", "missing"]:
+                    self.assertEqual(message.tags.get(key, ""), lean.tags.get(key, ""))
+
+    def test_other_lines(self):
+        lines = ["PING :tmi.twitch.tv",
+                 ":tmi.twitch.tv 001 cubiebot :Welcome, GLHF!",
+                 "@msg-id=sub :tmi.twitch.tv USERNOTICE #benchmark :Subscribed PRIVMSG #benchmark :",
+                 ":cubiebot!cubiebot@cubiebot.tmi.twitch.tv JOIN #benchmark",
+                 "@badges=;emotes= :moobot!moobot@moobot.tmi.twitch.tv PRIVMSG #benchmark :A"]
+        messages, sent = self.receive(lines, 8192)
+        self.assertEqual([b"PONG \r\n"], sent)
+        self.assertEqual(["001"], [message.type for message in messages])
+
+    def test_within_buffer(self):
+        # Lines are parsed within a buffer holding other lines, and only PRIVMSG lines are copied
+        lines = [b"PING :tmi.twitch.tv", make_line("cubie", "A").encode("UTF-8"), b":tmi.twitch.tv 001 cubiebot :Welcome"]
+        buffer = bytearray(b"\r\n".join(lines) + b"\r\n@")
+        bounds = []
+        for line in lines:
+            start = buffer.find(line)
+            bounds.append((start, start + len(line)))
+        self.assertIsNone(parse_raw(buffer, frozenset(), *bounds[0]))
+        self.assertEqual([b"PING", b"PRIVMSG", b"001"], [raw_type(buffer, *bound) for bound in bounds])
+        message = parse_raw(buffer, frozenset(), *bounds[1])
+        self.assertEqual((bytes, lines[1]), (type(message.raw), message.raw))
+        self.assertEqual(("cubie", "benchmark", "A"), (message.user, message.channel, message.message))
+        self.assertIsNone(parse_raw(buffer, frozenset(["cubie"]), *bounds[1]))
+        self.assertIsNone(parse_raw(buffer, frozenset(), len(buffer) - 1, len(buffer)))
+
+    def test_bot(self):
+        lines = generate_log(2_000, 100, per_second=20)
+        bot = make_bot()
+        messages, _ = self.receive(lines, 8192)
+        with mock.patch("time.monotonic", lambda: 0):
+            for message in messages:
+                bot.message_handler(message)
+        expected = make_bot()
+        with mock.patch("time.monotonic", lambda: 0):
+            for line in lines:
+                expected.message_handler(Message(line))
+        self.assertEqual(expected.ws.sent, bot.ws.sent)
+        self.assertEqual(expected.get_channel().collection.length(MessageTypes.TEXT), bot.get_channel().collection.length(MessageTypes.TEXT))
+
+class TestSharedCollection(unittest.TestCase):
+    # Uses a temporary SQLite file as stand-in for a database shared by multiple processes
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "shared.db")
+        self.stores = [SharedStore(self.path), SharedStore(self.path)]
+        self.collections = [SharedCollection(store, "first") for store in self.stores]
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def test_matches_collection(self):
+        collection = Collection()
+        for i, value in enumerate([1.0, 7.0, 3.0, 4.0, 100.0, 2.0, 8.0, 5.0, 6.0, 9.0, 10.0, 11.0]):
+            collection.set(f"user{i}", value, MessageTypes.NUMBERS)
+            self.collections[i % 2].set(f"user{i}", value, MessageTypes.NUMBERS)
+            collection.set(f"user{i}", "AB"[i % 3 == 0], MessageTypes.TEXT)
+            self.collections[i % 2].set(f"user{i}", "AB"[i % 3 == 0], MessageTypes.TEXT)
+        self.stores[0].flush()
+        self.stores[1].flush()
+        for method in ["median", "mean", "trimmed", "p90"]:
+            self.assertEqual(collection.average(method), self.collections[0].average(method))
+        self.assertEqual(collection.vote(MessageTypes.TEXT), self.collections[1].vote(MessageTypes.TEXT))
+
+    def test_overwrite_and_clean(self):
+        now = round(time.time())
+        self.collections[0].set("a", "A", MessageTypes.TEXT, now - 60)
+        self.collections[0].set("b", "A", MessageTypes.TEXT, now - 60)
+        self.collections[0].set("c", "A", MessageTypes.TEXT, now)
+        self.stores[0].flush()
+        self.collections[1].set("a", "B", MessageTypes.TEXT, now)
+        self.collections[1].clean(30)
+        self.assertEqual([1, 0, 0], self.collections[1].expired)
+        self.assertEqual(2, self.collections[0].length(MessageTypes.TEXT))
+        self.collections[0].clear(MessageTypes.TEXT)
+        self.assertEqual(0, self.collections[1].length(MessageTypes.TEXT))
+
+    def test_flushed_without_new_values(self):
+        store = SharedStore(self.path, flush_interval=0.05)
+        try:
+            SharedCollection(store, "first").set("a", "A", MessageTypes.TEXT)
+            time.sleep(0.3)
+            self.assertEqual(1, self.collections[0].length(MessageTypes.TEXT))
+        finally:
+            store.close()
+
+    def test_clear_before_flush(self):
+        # Values another process set before a clear, but had not yet written, stay cleared
+        self.collections[0].set("a", "A", MessageTypes.TEXT)
+        self.collections[1].set("b", "B", MessageTypes.TEXT)
+        self.collections[1].clear(MessageTypes.TEXT)
+        self.collections[0].set("c", "C", MessageTypes.TEXT)
+        self.stores[0].flush()
+        self.assertEqual([("C", 1.0)], self.collections[1].vote(MessageTypes.TEXT))
+
+    def test_partitions(self):
+        # Two processes sharing a database, each receiving all messages, give the same results as one bot
+        lines = generate_log(5_000, 200, per_second=20)
+        bots = [make_bot(), make_bot()]
+        for index, bot in enumerate(bots):
+            bot.shared_database = self.path
+            bot.shared_partition = (index, 2)
+            # Values are written right away, so they are included when the first process answers a command
+            bot.shared_store = SharedStore(self.path, batch_size=1)
+        expected = make_bot()
+        now = [0]
+        try:
+            with mock.patch("time.time", lambda: now[0]), mock.patch("time.monotonic", lambda: now[0]):
+                for line in lines:
+                    now[0] = int(get_tag(parse_line(line)[0], "tmi-sent-ts")) / 1000
+                    for bot in bots + [expected]:
+                        bot.message_handler(Message(line))
+            self.assertEqual(expected.ws.sent, bots[0].ws.sent)
+            self.assertEqual([], bots[1].ws.sent)
+            self.assertGreater(len(expected.ws.sent), 2)
+        finally:
+            for bot in bots:
+                bot.shared_store.close()
+
+class TestSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Settings.PATH
+        Settings.PATH = os.path.join(self.directory.name, "settings.txt")
+        self.write({"LookbackTime": 30})
+
+    def tearDown(self):
+        Settings.PATH = self.path
+        Settings._cache = None
+        self.directory.cleanup()
+
+    def write(self, settings, mtime_ns=None):
+        with open(Settings.PATH, "w") as f:
+            f.write(json.dumps(settings))
+        if mtime_ns is not None:
+            os.utime(Settings.PATH, ns=(mtime_ns, mtime_ns))
+
+    def test_cached(self):
+        self.assertEqual(30, Settings().get_settings()["LookbackTime"])
+        # Same size and modification time, so the file is not read again
+        self.write({"LookbackTime": 60}, os.stat(Settings.PATH).st_mtime_ns)
+        self.assertEqual(30, Settings().get_settings()["LookbackTime"])
+        self.write({"LookbackTime": 90}, os.stat(Settings.PATH).st_mtime_ns + 1)
+        self.assertEqual(90, Settings().get_settings()["LookbackTime"])
+
+    def test_watch(self):
+        Settings().get_settings()
+        changed = threading.Event()
+        received = []
+        stopped = Settings().watch(lambda settings: received.append(settings) or changed.set(), interval=0.01)
+        self.write({"LookbackTime": 60}, os.stat(Settings.PATH).st_mtime_ns + 1)
+        self.assertTrue(changed.wait(5))
+        stopped.set()
+        self.assertEqual(60, received[0]["LookbackTime"])
+
+    def test_watch_errors(self):
+        # Watching continues after the callback raised an error
+        Settings().get_settings()
+        changed = threading.Event()
+        received = []
+        def callback(settings):
+            received.append(settings)
+            changed.set()
+            settings["Nickname"]
+        stopped = Settings().watch(callback, interval=0.01)
+        with self.assertLogs("TwitchCubieBot.Settings", level="ERROR"):
+            self.write({"LookbackTime": 60}, os.stat(Settings.PATH).st_mtime_ns + 1)
+            self.assertTrue(changed.wait(5))
+            changed.clear()
+            self.write({"LookbackTime": 90}, os.stat(Settings.PATH).st_mtime_ns + 1)
+            self.assertTrue(changed.wait(5))
+        stopped.set()
+        self.assertEqual([60, 90], [settings["LookbackTime"] for settings in received])
+
+@unittest.skipUnless(Batch.np, "Batch analysis requires NumPy")
+class TestBatch(unittest.TestCase):
+
+    def test_parse_line(self):
+        tags, user, channel, message = parse_line(make_line("cubie", "Kappa :)", "25:0-4", channel="first", sent=1000))
+        self.assertEqual(("cubie", "first", "Kappa :)"), (user, channel, message))
+        self.assertEqual("25:0-4", get_tag(tags, "emotes"))
+        self.assertEqual("1000", get_tag(tags, "tmi-sent-ts"))
+        self.assertIsNone(parse_line(":tmi.twitch.tv 366 cubiebot #first :End of /NAMES list"))
+
+    def test_matches_live(self):
+        self.check_matches_live(0)
+
+    def test_matches_live_max_values(self):
+        # Fewer than the senders within the LookbackTime, so values are evicted
+        self.check_matches_live(100)
+
+    def check_matches_live(self, max_values):
+        lines = generate_log(20_000, 500, per_second=20)
+        # Handle the log live, with the time of each message as the current time
+        bot = make_bot()
+        bot.max_values = max_values
+        now = [0]
+        with mock.patch("time.time", lambda: now[0]), mock.patch("time.monotonic", lambda: now[0]):
+            for line in lines:
+                now[0] = int(get_tag(parse_line(line)[0], "tmi-sent-ts")) / 1000
+                bot.message_handler(Message(line))
+        live = [sent.partition(" :")[2] for sent in bot.ws.sent]
+
+        self.assertEqual(bool(max_values), sum(bot.get_channel().collection.evicted) > 0)
+
+        bot = make_bot()
+        bot.max_values = max_values
+        batch = Batch.Batch(bot)
+        batch.process(lines)
+        self.assertEqual(live, [out for timestamp, channel, out in batch.results()])
+        self.assertGreater(len(live), 5)
+
+class TestOutboundLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = OutboundLimiter(global_limit=(3, 30), channel_limit=(1, 1))
+        self.now = time.monotonic()
+
+    def test_coalesce(self):
+        self.assertTrue(self.limiter.put("No votes found.", "a"))
+        self.assertFalse(self.limiter.put("No votes found.", "a"))
+        self.assertTrue(self.limiter.put("No votes found.", "b"))
+        self.assertEqual(1, self.limiter.coalesced)
+        self.assertEqual(2, len(self.limiter.pending))
+
+    def test_channel_limit(self):
+        self.limiter.put("1", "a")
+        self.limiter.put("2", "a")
+        self.limiter.put("3", "b")
+        self.assertEqual((("1", "a"), 0), self.limiter.pop(self.now))
+        # Channel "a" has to wait, but "b" does not
+        self.assertEqual((("3", "b"), 0), self.limiter.pop(self.now))
+        item, wait = self.limiter.pop(self.now)
+        self.assertIsNone(item)
+        self.assertGreater(wait, 0)
+        self.assertEqual((("2", "a"), 0), self.limiter.pop(self.now + 2))
+
+    def test_global_limit(self):
+        for i in range(4):
+            self.limiter.put(str(i), str(i))
+        for i in range(3):
+            self.assertEqual(((str(i), str(i)), 0), self.limiter.pop(self.now))
+        item, wait = self.limiter.pop(self.now)
+        self.assertIsNone(item)
+        self.assertAlmostEqual(10, wait, delta=0.1)
+
+class FakeIRCServer:
+    # Local stand-in for Twitch chat, which sends `lines` after login and stores what the bot sends.
+    def __init__(self, lines):
+        self.lines = lines
+        self.received = []
+        self.privmsg = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        writer.write(b":tmi.twitch.tv 001 cubiebot :Welcome, GLHF!\r\n")
+        for line in self.lines:
+            writer.write(line.encode() + b"\r\n")
+        await writer.drain()
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            self.received.append(line)
+            if line.startswith("PRIVMSG"):
+                self.privmsg.set()
+
+class TestAsyncCubieBot(unittest.TestCase):
+
+    async def run_bot(self, lines, **settings):
+        server = FakeIRCServer(lines)
+        port = await server.start()
+        bot = AsyncCubieBot()
+        bot.update_settings()
+        bot.host = "127.0.0.1"
+        bot.port = port
+        bot.chan = "#first"
+        bot.update_channels(["#first"], {})
+        for key, value in settings.items():
+            setattr(bot, key, value)
+        await bot.start()
+        await asyncio.wait_for(server.privmsg.wait(), 5)
+        await bot.stop()
+        server.server.close()
+        return bot, server.received
+
+    def test_vote(self):
+        lines = [make_line("a", "A", channel="first"), make_line("b", "a please", channel="first"), make_line("cubie", "!vote", badges="broadcaster/1", channel="first")]
+        _, received = asyncio.run(self.run_bot(lines))
+        self.assertIn("JOIN #first", received)
+        self.assertEqual("PRIVMSG #first :/me A won with 100.00%.", received[-1])
+
+    def test_services(self):
+        # Metrics, live results and settings reloading are started like for the threaded bot
+        lines = [make_line("a", "A", channel="first"), make_line("cubie", "!vote", badges="broadcaster/1", channel="first")]
+        with mock.patch.object(Metrics, "start"):
+            bot, _ = asyncio.run(self.run_bot(lines, metrics_log_interval=60, live_interval=60, settings_reload_interval=60))
+        self.assertEqual(1, bot.metrics.values[MessageTypes.TEXT.value])
+        self.assertIsNotNone(bot.get_channel().collection.rolling)
+        # And stopped with the bot
+        self.assertTrue(bot._settings_watch.is_set())
+        self.assertTrue(bot.publisher._stop_event.is_set())
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,107 @@
+import random
+
+from TwitchCubieBot.CubieBot import CubieBot
+
+# Generated chat and stand-ins for the connection to Twitch, shared by the tests and the benchmark.
+# Like Test.py and Benchmark.py, this module is installed with the package, but the bot itself never imports it,
+# so these stand-ins are never used while connected to Twitch.
+
+EMOTES = ["Kappa", "PogChamp", "LUL", "monkaS", "Kreygasm", "BibleThump"]
+WORDS = ["hello", "chat", "what", "is", "this", "gg", "lol", "nice", "play", "that", "was", "close"]
+DENIED_USERS = ["streamelements", "marbiebot", "moobot"]
+BADGES = ["", "subscriber/12", "subscriber/0,premium/1", "vip/1", "moderator/1"]
+
+class StubWebsocket:
+    # Stand-in for TwitchWebsocket that keeps sent messages instead of sending them.
+    def __init__(self, chan="#benchmark"):
+        self.chan = chan
+        self.sent = []
+
+    def send_message(self, message, channel=None):
+        self._send(f"PRIVMSG #{channel} :" if channel else f"PRIVMSG {self.chan} :", message)
+
+    def _send(self, command, message):
+        self.sent.append(command + message)
+
+class StubSocket:
+    # Stand-in for a socket, receiving `data` in pieces of at most `size` bytes, and keeping sent data.
+    def __init__(self, data, size=8192):
+        self.data = data
+        self.size = size
+        self.position = 0
+        self.sent = []
+
+    def recv(self, size):
+        data = self.data[self.position:self.position + min(size, self.size)]
+        self.position += len(data)
+        return data
+
+    def recv_into(self, view):
+        data = self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+def make_line(sender, text, emotes="", badges="", channel="benchmark", sent=1550060037421):
+    # Create a raw IRC PRIVMSG line, as it is received from Twitch. `sent` is the time in milliseconds.
+    return (f"@badges={badges};color=#00FF7F;display-name={sender};emotes={emotes};flags=;id=d315b88f;mod=0;"
+            f"room-id=70624819;subscriber=1;tmi-sent-ts={sent};turbo=0;user-id=94714716;user-type= "
+            f":{sender}!{sender}@{sender}.tmi.twitch.tv PRIVMSG #{channel} :{text}")
+
+def make_text(rng):
+    # Generate the text and emotes tag of one chat message.
+    kind = rng.random()
+    if kind < 0.25:
+        # Letter spam, like "A", "aaaa" or "B please"
+        letter = rng.choice("ABCD")
+        return rng.choice([letter, letter.lower() * rng.randint(1, 6), f"{letter} please"]), ""
+    if kind < 0.45:
+        # Numbers, like "8/10", "-3.5" or "75%"
+        return rng.choice([f"{rng.randint(0, 10)}/10", f"{rng.uniform(-10, 10):.1f}", f"{rng.randint(0, 100)}%"]), ""
+    if kind < 0.75:
+        # Emote spam, with one or more emotes and the corresponding emotes tag
+        emote = rng.choice(EMOTES)
+        count = rng.randint(1, 4)
+        ranges = ",".join(f"{i * (len(emote) + 1)}-{i * (len(emote) + 1) + len(emote) - 1}" for i in range(count))
+        return " ".join([emote] * count), f"{EMOTES.index(emote) + 1}:{ranges}"
+    # Regular chat
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))), ""
+
+def generate_chat(n_messages, n_users, seed=0, channel="benchmark"):
+    # Generate `n_messages` raw IRC lines from `n_users` different chatters, including denied users.
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n_messages):
+        sender = rng.choice(DENIED_USERS) if rng.random() < 0.02 else f"user{rng.randrange(n_users)}"
+        text, emotes = make_text(rng)
+        lines.append(make_line(sender, text, emotes, rng.choice(BADGES), channel))
+    return lines
+
+COMMANDS = ["!vote", "!vote emotes", "!vote numbers", "!average", "!average mean", "!average trimmed", "!average p90",
+            "!vote start A B C", "!vote start guess 2m low=0-50 high=51-100", "!vote stop", "!vote stop guess"]
+
+def generate_log(n_messages, n_users, seed=0, per_second=100, start=1_550_000_000_000):
+    # Generate a chat log of `n_messages` raw IRC lines sent `per_second` messages per second,
+    # with a command of the broadcaster every 1000 messages on average.
+    rng = random.Random(seed)
+    lines = []
+    for i, line in enumerate(generate_chat(n_messages, n_users, seed)):
+        sent = start + i * 1000 // per_second
+        if rng.random() < 0.001:
+            lines.append(make_line("cubiedev", rng.choice(COMMANDS), badges="broadcaster/1", sent=sent))
+        lines.append(line.replace("tmi-sent-ts=1550060037421", f"tmi-sent-ts={sent}"))
+    return lines
+
+def make_bot():
+    # Create a CubieBot without a settings file or connection.
+    bot = CubieBot()
+    bot.chan = "#benchmark"
+    bot.denied_users = CubieBot.normalize_names(DENIED_USERS)
+    bot.allowed_ranks = CubieBot.normalize_names(["broadcaster", "moderator"])
+    bot.allowed_people = frozenset()
+    bot.lookback_time = 30
+    bot.ws = StubWebsocket()
+    return bot
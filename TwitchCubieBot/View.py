@@ -3,6 +3,8 @@ from enum import Enum, auto
 import logging, json
 logger = logging.getLogger(__name__)
 
+from TwitchCubieBot.Outbound import OutboundLimiter, Outbox
+
 class MessageSource(Enum):
     AVERAGE_RESULTS = auto()
     AVERAGE_COMMAND_ERRORS = auto()
@@ -16,8 +18,33 @@ class View:
     def __init__(self, bot):
         self.bot = bot
         self.send_to_chat = [MessageSource.AVERAGE_RESULTS, MessageSource.AVERAGE_COMMAND_ERRORS, MessageSource.VOTING_RESULTS, MessageSource.VOTING_COMMAND_ERRORS]
+        # If started, messages are rate limited and sent from a separate thread
+        self.outbox = None
+
+    def start_outbox(self, global_limit, channel_limit):
+        self.outbox = Outbox(self.send_now, OutboundLimiter(global_limit, channel_limit))
+        self.outbox.start()
+
+    def stop_outbox(self):
+        if self.outbox is not None:
+            self.outbox.stop()
     
-    def output(self, message, source):
+    def output(self, message, source, channel=None):
         if source in self.send_to_chat:
             if hasattr (self.bot, "ws") and self.bot.ws != None:
-                self.bot.ws.send_message(message)
+                self.send(message, channel)
+
+    def live(self, diff, channel=None):
+        # Changes in the live results of a channel, like {"TEXT": {"A": 0.5, "B": 0.0}, "median": 4.0}.
+        # Override this to e.g. update an overlay.
+        logger.debug(f"#{channel}: {json.dumps(diff, default=str)}")
+
+    def send(self, message, channel=None):
+        if self.outbox is not None:
+            self.outbox.put(message, channel)
+        else:
+            self.send_now(message, channel)
+
+    def send_now(self, message, channel=None):
+        # Send to the channel the message came from, which is not necessarily the channel the websocket joined first
+        self.bot.ws.send_message(message, channel)
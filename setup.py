@@ -28,7 +28,8 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    # Offline analysis of chat logs, using `python -m TwitchCubieBot.Batch`
+    'batch': ['numpy'],
 }
 
 # The rest you shouldn't have to touch too much :)